@@ -1,8 +1,15 @@
 #!/bin/bash
 # to create zip files for lambda
+# every lambda function needs the modules shared by all handlers
+shared="src/common.py src/ledger.py src/limiter.py src/metrics.py src/tracing.py"
 rm -f bin/*
-for filename in src/*; do
+for filename in src/src_*.py src/dst_*.py; do
   filename_no_folder=$(basename -- "$filename")
   filename_no_extension="${filename_no_folder%.*}"
-  zip -jr -Z store bin/$filename_no_extension.zip $filename src/common.py
+  zip -jr -Z store bin/$filename_no_extension.zip $filename $shared
 done
+# the dispatcher runs all stages of the step function, so it needs them all.
+# It is built from the sources alone, so it does not depend on the loop above.
+dispatcher="src/src_dispatcher.py src/src_schedule_copy.py src/src_copy_snapshot.py src/src_check_copy_status.py src/src_share_snapshot.py src/dst_copy_snapshot.py src/src_delete_snapshot.py"
+rm -f bin/src_dispatcher.zip
+zip -jr -Z store bin/src_dispatcher.zip $dispatcher $shared
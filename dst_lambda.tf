@@ -8,15 +8,23 @@ resource "aws_lambda_function" "dst_delete_old_snapshots" {
   handler          = "dst_delete_old_snapshots.lambda_handler"
   memory_size      = 128
   role             = aws_iam_role.dst_delete_old_snapshots_role.arn
-  runtime          = "python3.6"
+  runtime          = var.lambda_runtime
   source_code_hash = filebase64sha256("${path.module}/bin/dst_delete_old_snapshots.zip")
   timeout          = 300
 
   environment {
     variables = {
-      "LOGLEVEL"   = var.log_level
-      "DST_REGION" = var.dst_region
-      "RETENTION"  = var.retention
+      "LOGLEVEL"        = var.log_level
+      "DST_REGION"      = var.dst_region
+      "RETENTION"       = var.retention
+      "DELETE_WORKERS"  = var.delete_workers
+      "DRY_RUN"         = var.retention_dry_run
+      "KEEP_DAILY"      = var.keep_daily
+      "KEEP_WEEKLY"     = var.keep_weekly
+      "KEEP_MONTHLY"    = var.keep_monthly
+      "MAX_AGE_DAYS"    = var.max_age_days
+      "API_RATE_LIMITS" = lookup(var.function_api_rate_limits, "dst_delete_old_snapshots", var.api_rate_limits)
+      "TRACE_EXPORTER"  = var.trace_exporter
     }
   }
 }
@@ -1,21 +1,153 @@
+variable "api_rate_limits" {
+  default = "rds=10,sns=50,stepfunctions=20"
+}
+
+variable "audit_schedule_expression" {
+  default = "rate(6 hours)"
+}
+
 variable "backup_last" {
 }
 
+variable "backfill_schedule_expression" {
+  default = "rate(15 minutes)"
+}
+
+variable "backfill_wave_size" {
+  default = 20
+}
+
+variable "batch_concurrency" {
+  default = 2
+}
+
+variable "batch_size" {
+  default = 1
+}
+
+variable "batch_workers" {
+  default = 8
+}
+
+variable "check_schedule_expression" {
+  default = ""
+}
+
+variable "copy_budget" {
+  default = 5
+}
+
+variable "copy_check_max_wait" {
+  default = 1800
+}
+
+variable "copy_check_min_wait" {
+  default = 60
+}
+
+variable "copy_timeout_hours" {
+  default = 72
+}
+
+variable "delete_workers" {
+  default = 8
+}
+
+variable "destinations" {
+  type = list(object({
+    account_id = string
+    region     = string
+    role_arn   = string
+  }))
+  default = []
+}
+
+variable "dispatcher" {
+  default = false
+}
+
+variable "dispatcher_provisioned_concurrency" {
+  default = 0
+}
+
 variable "dst_account_id" {
 }
 
 variable "dst_region" {
 }
 
+variable "event_queue" {
+  default = false
+}
+
+variable "event_queue_batch_size" {
+  default = 10
+}
+
+variable "function_api_rate_limits" {
+  type    = map(string)
+  default = {
+    "dst_delete_old_snapshots" = "rds=40,sns=50,stepfunctions=20"
+    "src_audit_replication"    = "rds=40,sns=50,stepfunctions=20"
+    "src_backfill_snapshots"   = "rds=40,sns=50,stepfunctions=20"
+    "src_check_aurora_backups" = "rds=40,sns=50,stepfunctions=20"
+  }
+}
+
+variable "incremental" {
+  default = false
+}
+
+variable "keep_daily" {
+  default = 0
+}
+
+variable "keep_monthly" {
+  default = 0
+}
+
+variable "keep_weekly" {
+  default = 0
+}
+
+variable "lambda_runtime" {
+  default = "python3.12"
+}
+
 variable "log_level" {
 }
 
+variable "max_age_days" {
+  default = 0
+}
+
+variable "max_lag_hours" {
+  default = 26
+}
+
 variable "pattern" {
 }
 
+variable "priority_tiers" {
+  type    = list(string)
+  default = []
+}
+
+variable "publish_batch_size" {
+  default = 10
+}
+
 variable "retention" {
 }
 
+variable "retention_dry_run" {
+  default = false
+}
+
+variable "scan_workers" {
+  default = 8
+}
+
 variable "schedule_expression" {
 }
 
@@ -25,3 +157,12 @@ variable "src_account_id" {
 variable "src_region" {
 }
 
+variable "src_regions" {
+  type    = list(string)
+  default = []
+}
+
+variable "trace_exporter" {
+  default = ""
+}
+
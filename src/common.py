@@ -1,5 +1,795 @@
+import os
+import re
+import json
+import hashlib
+import threading
+import time
+import logging
+
+from collections import namedtuple
+from datetime import datetime, timezone
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import botocore.session
+
+from botocore.config import Config
+from botocore.credentials import (
+    AssumeRoleCredentialFetcher,
+    CredentialProvider,
+    DeferredRefreshableCredentials
+)
+
+from limiter import *
+from metrics import *
+from tracing import *
+
 class SnapshotSharingException(Exception):
     pass
 
 class SnapshotNotFoundException(Exception):
     pass
+
+class SnapshotCopyFailedException(Exception):
+    pass
+
+# Prefix of the intermediate snapshot copies in the source account
+LOCAL_COPY_PREFIX = 'rds-replication-'
+
+# Error codes of copy and delete calls for snapshots which were already copied
+# or deleted, e.g. by an earlier attempt of a batch
+ALREADY_EXISTS_ERRORS = ('DBSnapshotAlreadyExists', 'DBClusterSnapshotAlreadyExistsFault')
+NOT_FOUND_ERRORS      = ('DBSnapshotNotFound', 'DBClusterSnapshotNotFoundFault')
+
+def paginate(method, result_key, **kwargs):
+    """Yields every item of a paginated RDS describe call, page by page
+
+    Arguments:
+        method {callable} -- client method, e.g. RDS.describe_db_snapshots
+        result_key {str} -- key of the item list in the response
+        kwargs -- arguments passed on to every call
+
+    Returns:
+        generator -- items of all pages
+    """
+    while True:
+        response = method(**kwargs)
+        for item in response.get(result_key, []):
+            yield item
+        marker = response.get('Marker')
+        if not marker:
+            return
+        kwargs['Marker'] = marker
+
+def run_concurrently(function, items, max_workers):
+    """Calls function for every item on a bounded thread pool
+
+    Arguments:
+        function {callable} -- called with a single item
+        items {iterable} -- items to process
+        max_workers {int} -- maximum number of threads
+
+    Returns:
+        list -- results in the order of items
+    """
+    items = list(items)
+    if not items:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items)))) as executor:
+        return list(executor.map(function, items))
+
+def handle_batch(function, event, max_workers):
+    """Runs a pipeline step for one snapshot or for a batch of snapshots
+
+    A batch is an event with a 'Snapshots' list of single snapshot events,
+    which are processed concurrently. If any of them fails, the first
+    exception is raised so the step function retries the whole batch, which is
+    why every step has to be safe to repeat for snapshots it already handled.
+    Once the retries are exhausted the step function deletes the copies of
+    all snapshots of the batch, see the cleanup of src_delete_snapshot.
+
+    Arguments:
+        function {callable} -- called with a single snapshot event
+        event {dict} -- single snapshot event or batch
+        max_workers {int} -- maximum number of threads
+
+    Returns:
+        dict -- result of function, or the batch with the results of function
+    """
+    if 'Snapshots' not in event:
+        return function(event)
+    def call(snapshot_event):
+        try:
+            return function(snapshot_event)
+        except Exception as e:
+            return e
+    results = run_concurrently(call, event['Snapshots'], max_workers)
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    return dict(event, Snapshots=results)
+
+def chunks(items, size):
+    """Splits a list into lists of at most size items
+
+    Arguments:
+        items {list} -- items to split
+        size {int} -- maximum length of a chunk
+
+    Returns:
+        list -- chunks
+    """
+    size = max(1, size)
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+def error_code(exception):
+    """Returns the AWS error code of an exception raised by a client call
+
+    Arguments:
+        exception {Exception} -- Exception raised by boto3
+
+    Returns:
+        str -- Error code, e.g. 'DBSnapshotNotFound', or None
+    """
+    return getattr(exception, 'response', {}).get('Error', {}).get('Code')
+
+def estimate_wait_seconds(percent_progress, elapsed_seconds, minimum, maximum):
+    """Estimates how long to wait before checking a snapshot copy again
+
+    With progress information the remaining time is extrapolated from the
+    elapsed time. Without it we wait as long as the copy has already taken,
+    so the number of checks only grows logarithmically with the copy time.
+
+    Arguments:
+        percent_progress {int} -- PercentProgress of the copy, 0-100
+        elapsed_seconds {float} -- seconds since the copy started
+        minimum {int} -- lower bound of the wait
+        maximum {int} -- upper bound of the wait
+
+    Returns:
+        int -- seconds to wait
+    """
+    if 0 < percent_progress < 100 and elapsed_seconds > 0:
+        remaining = elapsed_seconds * (100 - percent_progress) / percent_progress
+    else:
+        remaining = elapsed_seconds
+    return int(min(max(remaining, minimum), maximum))
+
+# What the pipeline knows about a snapshot. It is filled from the first describe
+# call or copy response and travels in the step function payload as a dict, so
+# later steps only describe a snapshot when they need its current status.
+SnapshotDescriptor = namedtuple('SnapshotDescriptor', [
+    'arn', 'identifier', 'kind', 'engine', 'encrypted', 'kms_key_id', 'allocated_storage', 'status'
+])
+
+def snapshot_descriptor(snapshot):
+    """Builds the descriptor of a snapshot
+
+    Arguments:
+        snapshot {dict} -- DBSnapshot or DBClusterSnapshot of a describe or copy response
+
+    Returns:
+        SnapshotDescriptor -- descriptor of the snapshot
+    """
+    if 'DBClusterSnapshotIdentifier' in snapshot:
+        arn, identifier, kind = snapshot.get('DBClusterSnapshotArn'), snapshot['DBClusterSnapshotIdentifier'], 'cluster'
+    else:
+        arn, identifier, kind = snapshot.get('DBSnapshotArn'), snapshot['DBSnapshotIdentifier'], 'instance'
+    return SnapshotDescriptor(
+        arn               = arn,
+        identifier        = identifier,
+        kind              = kind,
+        engine            = snapshot.get('Engine'),
+        encrypted         = snapshot.get('StorageEncrypted', snapshot.get('Encrypted', False)),
+        kms_key_id        = snapshot.get('KmsKeyId'),
+        allocated_storage = snapshot.get('AllocatedStorage'),
+        status            = snapshot.get('Status')
+    )
+
+def descriptor_of(event, key='Snapshot'):
+    """Returns the descriptor a step function payload carries
+
+    Arguments:
+        event {dict} -- Snapshot event, or its local_copies or dst_copies
+        key {str} -- 'Snapshot' for the source snapshot, else the region or
+                     destination key of a copy
+
+    Returns:
+        SnapshotDescriptor -- descriptor, or None if the payload has none
+    """
+    if not event.get(key):
+        return None
+    return SnapshotDescriptor(**dict((field, event[key].get(field)) for field in SnapshotDescriptor._fields))
+
+# An account snapshots are replicated to, role_arn is assumed to copy the
+# shared snapshot into the account
+Destination = namedtuple('Destination', ['account', 'region', 'role_arn'])
+
+def get_destinations():
+    """Returns the destinations of the replication
+
+    DESTINATIONS is a JSON list of {"account_id", "region", "role_arn"}
+    objects. Without it there is a single destination, DST_ACCOUNT in
+    DST_REGION reached with the role DST_ARN.
+
+    Returns:
+        list -- Destination tuples
+    """
+    destinations = os.getenv('DESTINATIONS', '').strip()
+    if destinations:
+        return [
+            Destination(str(destination['account_id']), destination['region'], destination.get('role_arn'))
+            for destination in json.loads(destinations)
+        ]
+    return [Destination(
+        os.getenv('DST_ACCOUNT', '').strip(),
+        os.getenv('DST_REGION', '').strip(),
+        os.getenv('DST_ARN', '').strip() or None
+    )]
+
+def destination_regions(destinations):
+    """Returns the regions of destinations, each once and in order
+
+    Every region gets one intermediate copy, which is shared with all
+    destination accounts in that region.
+
+    Arguments:
+        destinations {list} -- Destination tuples
+
+    Returns:
+        list -- region names
+    """
+    regions = []
+    for destination in destinations:
+        if destination.region not in regions:
+            regions.append(destination.region)
+    return regions
+
+def destination_key(destination):
+    """Returns the key of a destination in the step function payload"""
+    return '{}:{}'.format(destination.account, destination.region)
+
+# kind, describe method, result key, snapshot identifier key and database
+# identifier key of both kinds of snapshots
+SNAPSHOT_KINDS = (
+    ('instance', 'describe_db_snapshots', 'DBSnapshots', 'DBSnapshotIdentifier', 'DBInstanceIdentifier'),
+    ('cluster', 'describe_db_cluster_snapshots', 'DBClusterSnapshots', 'DBClusterSnapshotIdentifier', 'DBClusterIdentifier'),
+)
+
+def iter_rds_snapshots(rds, snapshot_type):
+    """Streams the instance and cluster snapshots of a region, following pagination
+
+    Snapshots which are still being created have no create time yet and are
+    left out.
+
+    Arguments:
+        rds {LazyClient} -- RDS client of the region
+        snapshot_type {str} -- 'automated' or 'manual'
+
+    Returns:
+        generator -- (kind, snapshot identifier, database identifier, snapshot) tuples
+    """
+    for kind, method, result_key, identifier_key, database_key in SNAPSHOT_KINDS:
+        for snapshot in paginate(getattr(rds, method), result_key, SnapshotType=snapshot_type):
+            if 'SnapshotCreateTime' in snapshot:
+                yield kind, snapshot[identifier_key], snapshot[database_key], snapshot
+
+def get_source_regions(home_region):
+    """Returns the regions whose snapshots are replicated
+
+    SOURCE_REGIONS is a comma separated list of further regions, besides
+    home_region, the region the replication is deployed in.
+
+    Arguments:
+        home_region {str} -- region the replication is deployed in
+
+    Returns:
+        list -- region names, home_region first
+    """
+    regions = [home_region]
+    for region in os.getenv('SOURCE_REGIONS', '').split(','):
+        region = region.strip()
+        if region and region not in regions:
+            regions.append(region)
+    return regions
+
+def region_of(arn):
+    """Returns the region of an ARN, None if there is no ARN"""
+    if not arn:
+        return None
+    return arn.split(':')[3]
+
+def replica_name(identifier, region, home_region):
+    """Returns the name of the copies of a snapshot, without their prefix
+
+    Copies are named after the source identifier with ':' replaced by '-'.
+    Snapshots of other regions than home_region are prefixed with their
+    region, as automated snapshots of databases with the same name in
+    different regions have the same identifier.
+
+    Arguments:
+        identifier {str} -- source snapshot identifier
+        region {str} -- region of the source snapshot, None for home_region
+        home_region {str} -- region the replication is deployed in
+
+    Returns:
+        str -- name of the copies
+    """
+    name = identifier.replace(':', '-')
+    if region and region != home_region:
+        name = '{}-{}'.format(region, name)
+    return name
+
+# A region replica_name puts in front of the snapshot identifier, e.g.
+# eu-west-1 or us-gov-west-1. Snapshot identifiers of RDS begin with 'rds-'.
+REPLICA_REGION = re.compile('^([a-z]{2}(?:-[a-z]+)+-[0-9]+)-')
+
+def replica_region(name):
+    """Returns the source region of a replica_name, None for the home region
+
+    Arguments:
+        name {str} -- replica_name, or copy identifier without prefix
+
+    Returns:
+        str -- region, None if the name has no region in front
+    """
+    match = REPLICA_REGION.match(name)
+    return match.group(1) if match else None
+
+def replication_prefix(src_account):
+    """Returns the prefix of the snapshots replicated from src_account, see dst_copy_snapshot"""
+    return 'replication-{}-'.format(src_account)
+
+def replica_key(kind, identifier):
+    """Returns the key a source snapshot and its copies have in common
+
+    The key of a copy is that of its source once its prefix is removed, see
+    replica_name.
+
+    Arguments:
+        kind {str} -- 'instance' or 'cluster'
+        identifier {str} -- replica_name of the source, or copy identifier
+                            without prefix
+
+    Returns:
+        tuple -- kind and identifier
+    """
+    return kind, identifier.replace(':', '-')
+
+# Clients are created on first use, so a handler only pays for the clients it
+# actually calls. Connection pools are sized for the thread pools used by the
+# handlers. Throttling is handled by the rate limiters below, so botocore only
+# adds its exponential backoff with jitter between the attempts.
+CLIENT_CONFIG = Config(
+    max_pool_connections = int(os.getenv('MAX_POOL_CONNECTIONS', '16').strip()),
+    connect_timeout      = 5,
+    read_timeout         = 60,
+    retries              = {
+        'mode'         : 'standard',
+        'max_attempts' : int(os.getenv('MAX_ATTEMPTS', '8').strip())
+    }
+)
+
+def _limit_client(client, service):
+    """Sends every request of a client through the rate limiter of its service
+
+    The hooks run for every attempt, so retries by botocore take a token, too.
+    """
+    limiter = get_rate_limiter(service)
+    if not limiter:
+        return
+
+    def before_send(**kwargs):
+        waiting_from = time.time()
+        if limiter.acquire():
+            TRACER.record_span('ratelimit.wait', waiting_from, time.time(), attributes={'rpc.service': service})
+
+    def needs_retry(response=None, operation=None, **kwargs):
+        if not is_throttling_response(response):
+            return
+        limiter.throttled()
+        count = count_throttle(service, operation.name)
+        logging.getLogger().warning('Throttled: %s.%s (%s times)', service, operation.name, count)
+
+    def after_call(http_response=None, **kwargs):
+        if http_response is not None and http_response.status_code < 300:
+            limiter.succeeded()
+
+    client.meta.events.register('before-send', before_send)
+    client.meta.events.register('needs-retry', needs_retry)
+    client.meta.events.register('after-call', after_call)
+
+# Lists in logged payloads are cut after LOG_MAX_ITEMS items and a logged
+# payload after LOG_MAX_LENGTH characters
+LOG_MAX_ITEMS  = int(os.getenv('LOG_MAX_ITEMS', '10').strip())
+LOG_MAX_LENGTH = int(os.getenv('LOG_MAX_LENGTH', '2000').strip())
+
+_correlation = {'id': None}
+
+class JsonFormatter(logging.Formatter):
+    """Formats log records as single line JSON objects
+
+    Every record carries the correlation id of the snapshot or request the
+    invocation handles, so all log lines of one replication can be queried
+    together.
+    """
+
+    def format(self, record):
+        entry = {
+            'timestamp'      : datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level'          : record.levelname,
+            'message'        : record.getMessage(),
+            'correlation_id' : _correlation['id'],
+            'function'       : METRICS.function
+        }
+        if getattr(record, 'aws_request_id', None):
+            entry['aws_request_id'] = record.aws_request_id
+        if TRACER.trace_id:
+            entry['trace_id'] = TRACER.trace_id
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+def get_logger(loglevel):
+    """Returns the root logger, writing JSON records at loglevel
+
+    Arguments:
+        loglevel {str} -- python logging level, e.g. 'ERROR'
+
+    Returns:
+        logging.Logger -- root logger
+    """
+    logger = logging.getLogger()
+    logger.setLevel(loglevel.upper())
+    if not logger.handlers:
+        logger.addHandler(logging.StreamHandler())
+    for handler in logger.handlers:
+        handler.setFormatter(JsonFormatter())
+    return logger
+
+def set_correlation_id(correlation_id):
+    """Sets the correlation id added to every following log record"""
+    _correlation['id'] = correlation_id
+
+def correlation_id_of(event, context):
+    """Returns the id log records of an invocation are correlated by
+
+    That is the snapshot the event is about, so the log lines of all steps
+    of its replication share it, else the Lambda request id.
+
+    Arguments:
+        event {dict} -- Lambda event object
+        context {obj} -- Lambda context object
+
+    Returns:
+        str -- correlation id or None
+    """
+    if isinstance(event, dict):
+        for state in (event, event.get('event')):
+            if isinstance(state, dict) and state.get('SourceIdentifier'):
+                return state['SourceIdentifier']
+    return getattr(context, 'aws_request_id', None)
+
+class Summary(object):
+    """Log argument which summarizes a payload only when the record is emitted"""
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def __str__(self):
+        text = json.dumps(_summarized(self.payload), default=str)
+        if len(text) > LOG_MAX_LENGTH:
+            text = '{}... ({} characters)'.format(text[:LOG_MAX_LENGTH], len(text))
+        return text
+
+def summarize(payload):
+    """Wraps an API response or event for logging
+
+    Pass the result as argument of a logging call, e.g.
+    logger.debug('Response: %s', summarize(response)). Nothing is formatted
+    unless the record is emitted, ResponseMetadata is left out and long lists
+    and payloads are cut.
+
+    Arguments:
+        payload {obj} -- dict, list or any other value
+
+    Returns:
+        Summary -- formatted on demand
+    """
+    return Summary(payload)
+
+def _summarized(value):
+    """Returns a copy of value with ResponseMetadata removed and long lists cut"""
+    if isinstance(value, dict):
+        return dict(
+            (key, _summarized(item))
+            for key, item in value.items()
+            if key != 'ResponseMetadata'
+        )
+    if isinstance(value, (list, tuple)):
+        items = [_summarized(item) for item in value[:LOG_MAX_ITEMS]]
+        if len(value) > LOG_MAX_ITEMS:
+            items.append('... {} more'.format(len(value) - LOG_MAX_ITEMS))
+        return items
+    return value
+
+def instrument_handler(handler):
+    """Decorates a lambda_handler to record its Duration and Errors
+
+    It also sets the correlation id of the log records of the invocation.
+
+    The metrics of the handler and of all AWS API calls it made are written
+    when it returns or raises, and so are its spans if tracing is enabled.
+    A step of the step function passes the trace context on in its result.
+    """
+    function = handler.__module__
+
+    @wraps(handler)
+    def wrapper(event, context):
+        METRICS.start(function)
+        set_correlation_id(correlation_id_of(event, context))
+        trace_context = trace_context_of(event)
+        TRACER.start(function, trace_context, getattr(context, 'aws_request_id', None))
+        started = time.monotonic()
+        errors = 1
+        error = None
+        try:
+            result = handler(event, context)
+            errors = 0
+            if trace_context and isinstance(result, dict):
+                result['Trace'] = next_trace_context(trace_context, function, result)
+            return result
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            METRICS.put_metric('Duration', (time.monotonic() - started) * 1000, 'Milliseconds')
+            METRICS.count('Errors', errors)
+            METRICS.flush()
+            TRACER.finish(error)
+    return wrapper
+
+def _measure_client(client, service):
+    """Records Latency, Calls, Retries and Throttles of every API call of a client"""
+
+    def before_call(context=None, **kwargs):
+        context['metrics_started'] = time.monotonic()
+
+    def needs_retry(response=None, operation=None, **kwargs):
+        if is_throttling_response(response):
+            METRICS.count('Throttles', operation='{}.{}'.format(service, operation.name))
+
+    def after_call(parsed=None, model=None, context=None, **kwargs):
+        operation = '{}.{}'.format(service, model.name)
+        if 'metrics_started' in context:
+            latency = (time.monotonic() - context.pop('metrics_started')) * 1000
+            METRICS.put_metric('Latency', latency, 'Milliseconds', operation)
+        METRICS.count('Calls', operation=operation)
+        retries = (parsed or {}).get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        if retries:
+            METRICS.count('Retries', retries, operation=operation)
+
+    client.meta.events.register('before-call', before_call)
+    client.meta.events.register('needs-retry', needs_retry)
+    client.meta.events.register('after-call', after_call)
+
+def _trace_client(client, service):
+    """Records a span for every API call of a client, and for its retry waits
+
+    An attempt that needs a retry starts the wait, the next attempt of the
+    call ends it, so the backoff of botocore shows up as a retry.wait span.
+    """
+
+    def before_call(model=None, context=None, **kwargs):
+        span = TRACER.start_span('{}.{}'.format(service, model.name), SPAN_KIND_CLIENT, attributes={
+            'rpc.system'  : 'aws-api',
+            'rpc.service' : service,
+            'rpc.method'  : model.name
+        })
+        if span:
+            context['trace_span'] = span
+            context['trace_previous'] = TRACER.activate(span)
+
+    def before_send(**kwargs):
+        span = getattr(TRACER.local, 'span', None)
+        if span and span.retry_from:
+            TRACER.record_span('retry.wait', span.retry_from, time.time(), parent_span_id=span.span_id)
+            span.retry_from = None
+
+    def needs_retry(response=None, caught_exception=None, attempts=None, **kwargs):
+        span = getattr(TRACER.local, 'span', None)
+        if not span:
+            return
+        code = None
+        if response and response[1]:
+            code = response[1].get('Error', {}).get('Code')
+        if code or caught_exception:
+            span.add_event('attempt failed', {
+                'aws.attempt'    : attempts,
+                'aws.error_code' : code or type(caught_exception).__name__,
+                'aws.throttled'  : code in THROTTLING_ERRORS
+            })
+            span.retry_from = time.time()
+
+    def after_call(http_response=None, parsed=None, context=None, **kwargs):
+        span = context.pop('trace_span', None)
+        if not span:
+            return
+        TRACER.activate(context.pop('trace_previous', None))
+        metadata = (parsed or {}).get('ResponseMetadata', {})
+        span.attributes['http.status_code'] = getattr(http_response, 'status_code', None)
+        span.attributes['aws.request_id'] = metadata.get('RequestId')
+        span.attributes['aws.retries'] = metadata.get('RetryAttempts', 0)
+        error = (parsed or {}).get('Error', {}).get('Code')
+        span.end(error=error)
+
+    def after_call_error(exception=None, context=None, **kwargs):
+        span = context.pop('trace_span', None)
+        if span:
+            TRACER.activate(context.pop('trace_previous', None))
+            span.end(error=exception)
+
+    client.meta.events.register('before-call', before_call)
+    client.meta.events.register('before-send', before_send)
+    client.meta.events.register('needs-retry', needs_retry)
+    client.meta.events.register('after-call', after_call)
+    client.meta.events.register('after-call-error', after_call_error)
+
+_sessions     = {}
+_clients      = {}
+_clients_lock = threading.RLock()
+
+def get_session(role_arn=None, session_name='awsaccount_session'):
+    """Returns the session of the own account or of an assumed role
+
+    An assumed role is only assumed when the first client of the session
+    makes a call. The credentials are cached for the lifetime of the Lambda
+    container and botocore assumes the role again shortly before they expire.
+    Sessions are shared by all callers assuming a role with the same name.
+
+    Arguments:
+        role_arn {str} -- ARN of the role to assume, None for the own account
+        session_name {str} -- RoleSessionName
+
+    Returns:
+        boto3.Session -- Session shared by all clients of the account
+    """
+    key = (role_arn, session_name if role_arn else None)
+    with _clients_lock:
+        if key not in _sessions:
+            botocore_session = botocore.session.get_session()
+            if role_arn:
+                botocore_session.get_component('credential_provider').insert_before(
+                    'env', AssumedRoleProvider(role_arn, session_name)
+                )
+            _sessions[key] = boto3.Session(botocore_session=botocore_session)
+        return _sessions[key]
+
+def create_client(service, region_name=None, role_arn=None):
+    """Creates a boto3 client, the default client factory
+
+    Arguments:
+        service {str} -- e.g. 'rds'
+        region_name {str} -- AWS region
+        role_arn {str} -- ARN of the role to assume, None for the own account
+
+    Returns:
+        obj -- boto3 client
+    """
+    return get_session(role_arn).client(
+        service,
+        region_name  = region_name,
+        config       = CLIENT_CONFIG,
+        endpoint_url = os.getenv('AWS_ENDPOINT_URL') or None
+    )
+
+_client_factory = {'create': create_client}
+
+def set_client_factory(factory):
+    """Replaces how clients are created, e.g. by a local fake of AWS
+
+    Clients created before are dropped, so the next call of every LazyClient
+    uses the new factory.
+
+    Arguments:
+        factory {callable} -- called like create_client, returns a boto3 client
+
+    Returns:
+        callable -- the previous factory
+    """
+    with _clients_lock:
+        previous, _client_factory['create'] = _client_factory['create'], factory
+        _clients.clear()
+        return previous
+
+def get_client(service, region_name=None, role_arn=None):
+    """Returns a shared client, creating it on first use
+
+    Arguments:
+        service {str} -- e.g. 'rds'
+        region_name {str} -- AWS region
+        role_arn {str} -- ARN of the role to assume, None for the own account
+
+    Returns:
+        obj -- boto3 client
+    """
+    key = (service, region_name, role_arn)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = _client_factory['create'](service, region_name, role_arn)
+            # Registered first, so a retry wait ends before the rate limiter waits
+            _trace_client(_clients[key], service)
+            _limit_client(_clients[key], service)
+            _measure_client(_clients[key], service)
+        return _clients[key]
+
+class LazyClient(object):
+    """Stands in for a boto3 client until its first method is used"""
+
+    def __init__(self, service, region_name=None, role_arn=None):
+        self.service     = service
+        self.region_name = region_name
+        self.role_arn    = role_arn
+
+    def __getattr__(self, name):
+        return getattr(get_client(self.service, self.region_name, self.role_arn), name)
+
+class AssumedRoleProvider(CredentialProvider):
+    """Provides the credentials of a role assumed with the own credentials
+
+    Takes precedence over the default credential chain of a botocore session.
+    The role is assumed by the shared STS client of the own account, so
+    AssumeRole calls are rate limited and traced like all other calls.
+    """
+
+    METHOD         = 'rds-replication-assume-role'
+    CANONICAL_NAME = 'custom-rds-replication-assume-role'
+
+    def __init__(self, role_arn, session_name):
+        super(AssumedRoleProvider, self).__init__()
+        self.role_arn     = role_arn
+        self.session_name = session_name
+
+    def load(self):
+        fetcher = AssumeRoleCredentialFetcher(
+            client_creator     = self._create_client,
+            source_credentials = get_session().get_credentials(),
+            role_arn           = self.role_arn,
+            extra_args         = {'RoleSessionName': self.session_name}
+        )
+        return DeferredRefreshableCredentials(
+            refresh_using = fetcher.fetch_credentials,
+            method        = self.METHOD
+        )
+
+    def _create_client(self, service, **credentials):
+        # The source credentials are those of the own account
+        return get_client(service)
+
+# Step Functions execution names are at most 80 characters of these
+EXECUTION_NAME_LENGTH = 80
+EXECUTION_NAME_INVALID = re.compile('[^A-Za-z0-9_-]')
+
+def execution_name(source_arns, attempt=1):
+    """Derives the execution name of a replication from its snapshot ARNs
+
+    Step Functions refuses to start a second execution with the same name, so
+    a duplicate event cannot start a second replication of a snapshot. The
+    name ends with a hash of the ARNs, which keeps it unique when the readable
+    part has to be shortened.
+
+    Arguments:
+        source_arns {list} -- ARNs of the replicated snapshots
+        attempt {int} -- counts replications of the same snapshots
+
+    Returns:
+        str -- execution name
+    """
+    digest = hashlib.sha256('\n'.join(sorted(source_arns)).encode()).hexdigest()[:16]
+    suffix = '-{}-{}'.format(attempt, digest)
+    if len(source_arns) == 1:
+        readable = EXECUTION_NAME_INVALID.sub('-', source_arns[0].split(':', 6)[-1])
+    else:
+        readable = 'batch-{}'.format(len(source_arns))
+    return readable[:EXECUTION_NAME_LENGTH - len(suffix)] + suffix
@@ -7,36 +7,31 @@ Inspired by https://github.com/awslabs/rds-snapshot-tool
 '''
 
 # dst_copy_snapshot.py
-# This lambda function copies the shared snapshot to the destination account
+# This lambda function copies the shared snapshot to every destination account,
+# the destinations concurrently. In batch mode it copies all snapshots of the
+# batch concurrently.
 
 import os
-import logging
-
-import boto3
+import time
 
 from common import *
 
-DST_ARN     = os.getenv('DST_ARN').strip()
-DST_REGION  = os.getenv('DST_REGION').strip()
-LOGLEVEL    = os.getenv('LOGLEVEL', 'ERROR').strip()
-SRC_ACCOUNT = os.getenv('SRC_ACCOUNT').strip()
+LOGLEVEL      = os.getenv('LOGLEVEL', 'ERROR').strip()
+SRC_ACCOUNT   = os.getenv('SRC_ACCOUNT').strip()
+SRC_REGION    = os.getenv('SRC_REGION').strip()
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', '8').strip())
+DESTINATIONS  = get_destinations()
 
-logger = logging.getLogger()
-logger.setLevel(LOGLEVEL.upper())
+logger = get_logger(LOGLEVEL)
 
-# This function is executed on a different account so we have to get the credentials
-STS = boto3.client('sts')
-awsaccount = STS.assume_role(
-        RoleArn         = DST_ARN,
-        RoleSessionName ='awsaccount_session'
+# This function is executed on different accounts so we have to get the
+# credentials. They are assumed on first use and refreshed before they expire
+RDS = dict(
+    (destination_key(destination), LazyClient('rds', region_name=destination.region, role_arn=destination.role_arn))
+    for destination in DESTINATIONS
 )
 
-ACCESS_KEY    = awsaccount['Credentials']['AccessKeyId']
-SECRET_KEY    = awsaccount['Credentials']['SecretAccessKey']
-SESSION_TOKEN = awsaccount['Credentials']['SessionToken']
-
-RDS = boto3.client('rds', region_name=DST_REGION, aws_access_key_id=ACCESS_KEY, aws_secret_access_key=SECRET_KEY, aws_session_token=SESSION_TOKEN)
-
+@instrument_handler
 def lambda_handler(event, context):
     """Copy shared snapshot
     
@@ -47,43 +42,92 @@ def lambda_handler(event, context):
     Returns:
         dict -- as event
     """
-    cluster = False
-    if 'cluster' in event['SourceType']:
-        cluster = True
-    logger.debug('event: {}'.format(event))
+    return handle_batch(copy_snapshot, event, BATCH_WORKERS)
 
-    # Get the ARN of the shared snapshot to copy
-    if cluster:
-        shared_snapshot_arn = 'arn:aws:rds:{}:{}:cluster-snapshot:{}'
-    else:
-        shared_snapshot_arn = 'arn:aws:rds:{}:{}:snapshot:{}'
+def copy_snapshot(event):
+    """Copies a single shared snapshot to every destination
 
-    shared_snapshot_arn = shared_snapshot_arn.format(
-        DST_REGION,
-        SRC_ACCOUNT,
-        event['local_copy_snapshot_identifier']
-    )
-    logger.debug('arn: {}'.format(shared_snapshot_arn))
+    Arguments:
+        event {dict} -- Snapshot event
+
+    Returns:
+        dict -- as event
+    """
+    logger.debug('event: %s', summarize(event))
 
     # Generating name for our local snapshot copy
-    local_copy_name = 'replication-{}-{}'.format(SRC_ACCOUNT, event['SourceIdentifier'].replace(':', '-'))
-    logger.info('Copying snapshot {} from account {} to {}'.format(shared_snapshot_arn, SRC_ACCOUNT, local_copy_name))
+    local_copy_name = replication_prefix(SRC_ACCOUNT) + replica_name(
+        event['SourceIdentifier'],
+        region_of(event.get('SourceArn')),
+        SRC_REGION
+    )
+    descriptors = run_concurrently(
+        lambda destination: copy_to(event, destination, local_copy_name),
+        DESTINATIONS,
+        len(DESTINATIONS)
+    )
+    dst_copies = event.get('dst_copies') or {}
+    for destination, descriptor in zip(DESTINATIONS, descriptors):
+        if descriptor:
+            dst_copies[destination_key(destination)] = descriptor
+    event['dst_snapshot_identifier'] = local_copy_name
+    event['dst_copy_started_at']     = int(time.time())
+    event['dst_copies']              = dst_copies
+    return event
+
+def copy_to(event, destination, local_copy_name):
+    """Copies a single shared snapshot to one destination
+
+    Arguments:
+        event {dict} -- Snapshot event
+        destination {Destination} -- account and region to copy to
+        local_copy_name {str} -- identifier of the copy
 
+    Returns:
+        dict -- descriptor of the copy, None if it already existed
+    """
+    cluster = False
+    if 'cluster' in event['SourceType']:
+        cluster = True
+
+    # Get the ARN of the shared snapshot to copy, events of older executions do
+    # not carry the descriptor of the shared copy
+    local_copy = descriptor_of(event.get('local_copies') or {}, destination.region)
+    if local_copy and local_copy.arn:
+        shared_snapshot_arn = local_copy.arn
+    else:
+        if cluster:
+            shared_snapshot_arn = 'arn:aws:rds:{}:{}:cluster-snapshot:{}'
+        else:
+            shared_snapshot_arn = 'arn:aws:rds:{}:{}:snapshot:{}'
+        shared_snapshot_arn = shared_snapshot_arn.format(
+            destination.region,
+            SRC_ACCOUNT,
+            event['local_copy_snapshot_identifier']
+        )
+    logger.debug('arn: %s', shared_snapshot_arn)
+    logger.info('Copying snapshot %s from account %s to %s in %s', shared_snapshot_arn, SRC_ACCOUNT, local_copy_name, destination_key(destination))
+
+    rds = RDS[destination_key(destination)]
     try:
         if cluster:
-            response = RDS.copy_db_cluster_snapshot(
+            response = rds.copy_db_cluster_snapshot(
                 SourceDBClusterSnapshotIdentifier = shared_snapshot_arn,
                 TargetDBClusterSnapshotIdentifier = local_copy_name,
             )
+            descriptor = snapshot_descriptor(response['DBClusterSnapshot'])._asdict()
         else:
-            response = RDS.copy_db_snapshot(
+            response = rds.copy_db_snapshot(
                 SourceDBSnapshotIdentifier = shared_snapshot_arn,
                 TargetDBSnapshotIdentifier = local_copy_name,
             )
-        logger.info('Response: {}'.format(response))
+            descriptor = snapshot_descriptor(response['DBSnapshot'])._asdict()
+        logger.info('Response: %s', summarize(response))
+        return descriptor
     except Exception as e:
+        if error_code(e) in ALREADY_EXISTS_ERRORS:
+            logger.info('Snapshot copy %s already exists in %s', local_copy_name, destination_key(destination))
+            return None
         log_message = 'Exeption: {}'.format(e)
         logger.error(log_message)
         raise SnapshotSharingException(log_message)
-    event['dst_snapshot_identifier'] = local_copy_name
-    return event
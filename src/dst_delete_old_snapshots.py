@@ -9,103 +9,334 @@ Inspired by https://github.com/awslabs/rds-snapshot-tool
 # dst_delete_old_snapshots
 # This lambda function triggers daily to delete old snapshots.
 # It:
-# 1. describe-db-snapshots and describe-db-cluster-snapshots
-# 2. for every db instance or cluster snapshot that begins with 'replication':
-# 3. delete oldest snapshot if number of snapshots > RETENTION, until
-#    number of snapshots == RETENTION
+# 1. pages through all manual db instance and db cluster snapshots
+# 2. keeps the identifier, create time and kind of every snapshot that begins
+#    with 'replication-', grouped by source account, source region and db
+#    instance or cluster
+# 3. plans in one pass which snapshots of every group to keep:
+#    - the RETENTION newest snapshots
+#    - the newest snapshot of each of the last KEEP_DAILY days, KEEP_WEEKLY
+#      weeks and KEEP_MONTHLY months
+#    - but none older than MAX_AGE_DAYS, except the newest snapshot
+# 4. logs a summary of the plan, or if DRY_RUN writes the whole plan as JSON
+#    to stdout, and unless DRY_RUN deletes the other snapshots using up to
+#    DELETE_WORKERS concurrent delete calls, for as long as the invocation has
+#    time left.
+#    Snapshots it could not get to are returned as {"delete": [...]} and
+#    counted in the SnapshotsLeftToDelete metric. Nothing reads them on the
+#    schedule, the next run plans them again.
+# {"delete": [...]} is also accepted as event to only execute a plan, e.g. the
+# result of an invocation that ran out of time. Only snapshots this function
+# owns, manual snapshots beginning with 'replication-', are deleted.
 
+import json
 import os
-import logging
+import re
 
-from operator import itemgetter
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from operator import attrgetter
 
-import boto3
+from common import *
 
-DST_REGION = os.getenv('DST_REGION').strip()
-RETENTION  = int(os.getenv('RETENTION').strip())
-LOGLEVEL   = os.getenv('LOGLEVEL', 'ERROR').strip()
+DST_REGION     = os.getenv('DST_REGION').strip()
+RETENTION      = int(os.getenv('RETENTION').strip())
+LOGLEVEL       = os.getenv('LOGLEVEL', 'ERROR').strip()
+DELETE_WORKERS = int(os.getenv('DELETE_WORKERS', '8').strip())
+KEEP_DAILY     = int(os.getenv('KEEP_DAILY', '0').strip())
+KEEP_WEEKLY    = int(os.getenv('KEEP_WEEKLY', '0').strip())
+KEEP_MONTHLY   = int(os.getenv('KEEP_MONTHLY', '0').strip())
+MAX_AGE_DAYS   = int(os.getenv('MAX_AGE_DAYS', '0').strip())
+DRY_RUN        = os.getenv('DRY_RUN', 'false').strip().lower() == 'true'
 
-logger = logging.getLogger()
-logger.setLevel(LOGLEVEL.upper())
+REPLICATION_PREFIX = 'replication-'
 
-RDS = boto3.client('rds', region_name=DST_REGION)
+# Copies are named replication-<source account>-<replica_name>, see
+# dst_copy_snapshot
+COPY_NAME = re.compile('^' + REPLICATION_PREFIX + '(?:([0-9]{12})-)?(.*)$')
 
+# Stop deleting when the invocation has less time left than this
+MIN_REMAINING_MILLIS = 30000
+
+logger = get_logger(LOGLEVEL)
+
+RDS = LazyClient('rds', region_name=DST_REGION)
+
+# The only fields retention needs, so that thousands of snapshots do not keep
+# the full describe responses in memory
+Snapshot = namedtuple('Snapshot', ['identifier', 'create_time', 'kind'])
+
+# How many snapshots to keep. daily, weekly and monthly keep the newest
+# snapshot of that many periods, max_age_days = 0 disables age based expiry
+RetentionPolicy = namedtuple('RetentionPolicy', ['last', 'daily', 'weekly', 'monthly', 'max_age_days'])
+
+# The snapshots of one database, which retention keeps and deletes together.
+# Databases of the same name in other source regions or accounts, or an
+# instance and a cluster of the same name, are different databases.
+Group = namedtuple('Group', ['kind', 'account', 'region', 'database'])
+
+# A snapshot of the plan, reason is why it is kept or None if it is deleted
+PlannedSnapshot = namedtuple('PlannedSnapshot', ['group', 'snapshot', 'reason'])
+
+POLICY = RetentionPolicy(RETENTION, KEEP_DAILY, KEEP_WEEKLY, KEEP_MONTHLY, MAX_AGE_DAYS)
+
+PERIODS = (
+    ('daily',   lambda create_time: create_time.date()),
+    ('weekly',  lambda create_time: create_time.isocalendar()[:2]),
+    ('monthly', lambda create_time: (create_time.year, create_time.month)),
+)
+
+@instrument_handler
 def lambda_handler(event, context):
     """Main method
-    
+
     Arguments:
         event {dict} -- Lambda event object
         context {obj} -- Lambda context object
+
+    Returns:
+        dict -- the plan in dry run mode, else the snapshots left to delete
+    """
+    if 'delete' in event:
+        logger.info('Executing plan with %s snapshots to delete', len(event['delete']))
+        to_be_deleted = owned_snapshots(event['delete'])
+    else:
+        logger.info('Looking for old replicated snapshots to delete')
+        plan = plan_retention(get_snapshots(), POLICY, datetime.now(timezone.utc))
+        logger.info('Keeping %s and deleting %s snapshots', len(plan['keep']), len(plan['delete']))
+        if DRY_RUN:
+            plan = plan_to_dict(plan)
+            # The whole plan, summarize would cut it short for a real fleet.
+            # It is what a dry run is for, so like the metrics it is written
+            # to stdout whatever the log level, as one JSON line.
+            print(json.dumps({'RetentionPlan': plan}))
+            return plan
+        logger.info('Deleting: %s', summarize([planned.snapshot.identifier for planned in plan['delete']]))
+        to_be_deleted = [planned.snapshot for planned in plan['delete']]
+    remaining = execute_plan(to_be_deleted, context)
+    return {
+        'delete': [
+            {'identifier': snapshot.identifier, 'kind': snapshot.kind}
+            for snapshot in remaining
+        ]
+    }
+
+def is_owned(identifier, snapshot_type='manual'):
+    """Returns whether a snapshot was made by the replication, and may be deleted"""
+    return identifier.startswith(REPLICATION_PREFIX) and snapshot_type == 'manual'
+
+def owned_snapshots(entries):
+    """Returns the snapshots of a {"delete": [...]} event which may be deleted
+
+    The snapshots are described, so that only existing manual snapshots whose
+    identifier begins with REPLICATION_PREFIX are deleted, whatever the event
+    lists.
+
+    Arguments:
+        entries {list} -- dicts with identifier and kind
+
+    Returns:
+        list -- Snapshots to delete
+    """
+    def describe(entry):
+        if not is_owned(entry['identifier']):
+            return None
+        try:
+            if entry['kind'] == 'cluster':
+                snapshot = RDS.describe_db_cluster_snapshots(
+                    DBClusterSnapshotIdentifier = entry['identifier']
+                )['DBClusterSnapshots'][0]
+            else:
+                snapshot = RDS.describe_db_snapshots(
+                    DBSnapshotIdentifier = entry['identifier']
+                )['DBSnapshots'][0]
+        except Exception as e:
+            if error_code(e) in NOT_FOUND_ERRORS:
+                return None
+            raise
+        if not is_owned(entry['identifier'], snapshot.get('SnapshotType')):
+            return None
+        return Snapshot(entry['identifier'], snapshot.get('SnapshotCreateTime'), entry['kind'])
+    snapshots = [snapshot for snapshot in run_concurrently(describe, entries, DELETE_WORKERS) if snapshot]
+    if len(snapshots) < len(entries):
+        logger.warning('Not deleting %s snapshots which are gone or not replicated snapshots', len(entries) - len(snapshots))
+    return snapshots
+
+def plan_retention(snapshots, policy, now):
+    """Decides which snapshots to keep and which to delete
+
+    Pure function, every group is sorted once and then walked newest first.
+
+    Arguments:
+        snapshots {dict} -- Snapshot lists by Group
+        policy {RetentionPolicy} -- what to keep
+        now {datetime} -- current time, timezone aware
+
+    Returns:
+        dict -- 'keep' and 'delete' lists of PlannedSnapshot
+    """
+    plan = {'keep': [], 'delete': []}
+    expired = None
+    if policy.max_age_days:
+        expired = now - timedelta(days=policy.max_age_days)
+    for group, group_snapshots in snapshots.items():
+        kept_periods = dict((name, set()) for name, _ in PERIODS)
+        ordered = sorted(group_snapshots, key=attrgetter('create_time'), reverse=True)
+        for index, snapshot in enumerate(ordered):
+            reason = None
+            if index < policy.last:
+                reason = 'last'
+            for name, period_of in PERIODS:
+                period = period_of(snapshot.create_time)
+                if period not in kept_periods[name] and len(kept_periods[name]) < getattr(policy, name):
+                    kept_periods[name].add(period)
+                    reason = reason or name
+            if expired and index > 0 and snapshot.create_time < expired:
+                reason = None
+            if reason:
+                plan['keep'].append(PlannedSnapshot(group, snapshot, reason))
+            else:
+                plan['delete'].append(PlannedSnapshot(group, snapshot, None))
+    return plan
+
+def plan_to_dict(plan):
+    """Converts a plan into something that can be serialized as JSON
+
+    Arguments:
+        plan {dict} -- 'keep' and 'delete' lists of PlannedSnapshot
+
+    Returns:
+        dict -- 'keep' and 'delete' lists of dicts
     """
-    logger.info('Looking for old replicated snapshots to delete')
-    snapshots = get_snapshots()
-    for instance, instance_snapshots in snapshots.items():
-        # sort by snapshot date ascending. we want to delete oldest snapshots
-        # first
-        instance_snapshots = sorted(
-            instance_snapshots,
-            key     = itemgetter('SnapshotCreateTime'),
-            reverse = False
+    return dict(
+        (
+            action,
+            [
+                {
+                    'group'       : planned.group._asdict(),
+                    'identifier'  : planned.snapshot.identifier,
+                    'kind'        : planned.snapshot.kind,
+                    'create_time' : planned.snapshot.create_time.isoformat(),
+                    'reason'      : planned.reason
+                }
+                for planned in planned_snapshots
+            ]
         )
-        number_of_snapshots = len(instance_snapshots)
-        logger.debug('Snapshots for instance {}: {}'.format(instance, number_of_snapshots))
-        for snapshot in instance_snapshots:
-            if number_of_snapshots > RETENTION:
-                try:
-                    logger.debug('Snapshot object: {}'.format(snapshot))
-                    if 'DBClusterSnapshotArn' in snapshot:
-                        deleting = snapshot['DBClusterSnapshotIdentifier']
-                        logger.info('Deleting {}'.format(deleting))
-                        RDS.delete_db_cluster_snapshot(
-                            DBClusterSnapshotIdentifier = deleting
-                        )
-                    else:
-                        deleting = snapshot['DBSnapshotIdentifier']
-                        RDS.delete_db_snapshot(
-                            DBSnapshotIdentifier = snapshot['DBSnapshotIdentifier']
-                        )
-                        logger.info('Deleting {}'.format(deleting))
-                    number_of_snapshots = number_of_snapshots - 1
-                    logger.debug('Snapshots left for instance {}: {}'.format(instance, number_of_snapshots))
-                except Exception as e:
-                    logger.error('Exception deleting Snapshot: {}'.format(e))
-            logger.info('Desired number of snapshots reached for identifier: {}'.format(instance))
+        for action, planned_snapshots in plan.items()
+    )
+
+def group_of(kind, database, identifier):
+    """Returns the group of a replicated snapshot
+
+    The source account and region are taken from the identifier of the copy,
+    see replica_name.
+
+    Arguments:
+        kind {str} -- 'instance' or 'cluster'
+        database {str} -- instance or cluster identifier
+        identifier {str} -- snapshot identifier
 
-def get_snapshots():
-    """Finds all RDS and Aurora snapshots
-    
     Returns:
-        dict -- All snapshot objects
+        Group -- account and region are None if the identifier has none
+    """
+    account, name = COPY_NAME.match(identifier).groups()
+    return Group(kind, account, replica_region(name), database)
+
+def execute_plan(to_be_deleted, context):
+    """Deletes snapshots for as long as the invocation has time left
+
+    Arguments:
+        to_be_deleted {list} -- Snapshots to delete
+        context {obj} -- Lambda context object
+
+    Returns:
+        list -- Snapshots it did not get to
+    """
+    remaining = list(to_be_deleted)
+    deleted = 0
+    while remaining:
+        if context and context.get_remaining_time_in_millis() < MIN_REMAINING_MILLIS:
+            logger.info('Out of time, %s snapshots left to delete', len(remaining))
+            break
+        chunk, remaining = remaining[:DELETE_WORKERS * 4], remaining[DELETE_WORKERS * 4:]
+        results = run_concurrently(delete_snapshot, chunk, DELETE_WORKERS)
+        deleted += results.count(True)
+    logger.info('Deleted %s of %s snapshots', deleted, len(to_be_deleted))
+    put_metric('SnapshotsDeleted', deleted)
+    put_metric('SnapshotsLeftToDelete', len(remaining))
+    return remaining
+
+def delete_snapshot(snapshot):
+    """Deletes a single replicated snapshot
+
+    Arguments:
+        snapshot {Snapshot} -- Snapshot to delete
+
+    Returns:
+        boolean -- True if the snapshot has been deleted, else False
+    """
+    try:
+        logger.info('Deleting %s', snapshot.identifier)
+        if snapshot.kind == 'cluster':
+            RDS.delete_db_cluster_snapshot(
+                DBClusterSnapshotIdentifier = snapshot.identifier
+            )
+        else:
+            RDS.delete_db_snapshot(
+                DBSnapshotIdentifier = snapshot.identifier
+            )
+        return True
+    except Exception as e:
+        logger.error('Exception deleting Snapshot %s: %s', snapshot.identifier, e)
+        return False
+
+def iter_snapshots():
+    """Streams all replicated RDS and Aurora snapshots, following pagination
+
+    A page that cannot be fetched fails the invocation, as the snapshots
+    kept by retention depend on all other snapshots of their group, so a plan
+    of an incomplete listing could delete snapshots it should keep.
+
+    Returns:
+        generator -- (Group, Snapshot) tuples
     """
-    snapshots = {}
     try:
         logger.info('Fetching DB snapshots')
-        response = RDS.describe_db_snapshots()
-        logger.debug(response)
-        if response:
-            for snapshot in response['DBSnapshots']:
-                if snapshot['DBInstanceIdentifier'] not in snapshots:
-                    snapshots[snapshot['DBInstanceIdentifier']] = []
-                if snapshot['DBSnapshotIdentifier'].startswith('replication'):
-                    logger.info('Found replicated snapshot {}'.format(snapshot['DBSnapshotIdentifier']))
-                    snapshots[snapshot['DBInstanceIdentifier']].append(snapshot)
-        logger.debug('snapshots object: {}'.format(snapshots))
+        for snapshot in paginate(RDS.describe_db_snapshots, 'DBSnapshots', SnapshotType='manual'):
+            if is_owned(snapshot['DBSnapshotIdentifier']) and 'SnapshotCreateTime' in snapshot:
+                logger.debug('Found replicated snapshot %s', snapshot['DBSnapshotIdentifier'])
+                yield group_of('instance', snapshot['DBInstanceIdentifier'], snapshot['DBSnapshotIdentifier']), Snapshot(
+                    snapshot['DBSnapshotIdentifier'],
+                    snapshot['SnapshotCreateTime'],
+                    'instance'
+                )
     except Exception as e:
         log_message = 'Exception while fetching DB snapshots: {}'.format(e)
         logger.error(log_message)
+        raise SnapshotSharingException(log_message)
     try:
         logger.info('Fetching Aurora Cluster snapshots')
-        cluster_response = RDS.describe_db_cluster_snapshots()
-        logger.debug(cluster_response)
-        if cluster_response:
-            for snapshot in cluster_response['DBClusterSnapshots']:
-                if snapshot['DBClusterIdentifier'] not in snapshots:
-                    snapshots[snapshot['DBClusterIdentifier']] = []
-                if snapshot['DBClusterSnapshotIdentifier'].startswith('replication'):
-                    logger.info('Found replicated snapshot {}'.format(snapshot['DBClusterSnapshotIdentifier']))
-                    snapshots[snapshot['DBClusterIdentifier']].append(snapshot)
-        logger.debug('snapshots object: {}'.format(snapshots))
+        for snapshot in paginate(RDS.describe_db_cluster_snapshots, 'DBClusterSnapshots', SnapshotType='manual'):
+            if is_owned(snapshot['DBClusterSnapshotIdentifier']) and 'SnapshotCreateTime' in snapshot:
+                logger.debug('Found replicated snapshot %s', snapshot['DBClusterSnapshotIdentifier'])
+                yield group_of('cluster', snapshot['DBClusterIdentifier'], snapshot['DBClusterSnapshotIdentifier']), Snapshot(
+                    snapshot['DBClusterSnapshotIdentifier'],
+                    snapshot['SnapshotCreateTime'],
+                    'cluster'
+                )
     except Exception as e:
         log_message = 'Exception while fetching DB Cluster snapshots: {}'.format(e)
         logger.error(log_message)
+        raise SnapshotSharingException(log_message)
+
+def get_snapshots():
+    """Finds all replicated RDS and Aurora snapshots
+
+    Returns:
+        dict -- Snapshot lists by Group
+    """
+    snapshots = {}
+    for group, snapshot in iter_snapshots():
+        snapshots.setdefault(group, []).append(snapshot)
+    logger.info('Found replicated snapshots for %s instances and clusters', len(snapshots))
     return snapshots
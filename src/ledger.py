@@ -0,0 +1,454 @@
+'''
+Copyright 2019  Pinguin AG, Mattis Haase
+
+Licensed under the Apache License, Version 2.0 (the "License").
+'''
+
+# ledger.py
+# The replication ledger: the replication state of every source snapshot and
+# the documents shared by all invocations, such as the admission queue of
+# src_schedule_copy, kept in DynamoDB or, for tests and local tools, in SQLite
+# or a JSON file.
+
+import os
+import copy
+import json
+import sqlite3
+import threading
+import time
+
+from common import LazyClient, SnapshotSharingException, error_code
+
+# Replication states of a source snapshot in the ledger
+LEDGER_PENDING = 'pending'
+LEDGER_COPYING = 'copying'
+LEDGER_DONE    = 'done'
+# The replication failed and its copies were cleaned up, it may be repeated
+LEDGER_FAILED  = 'failed'
+
+# Ledger entries are removed after this many days, DynamoDB expires them
+LEDGER_TTL_DAYS = 90
+
+# Ledger documents shared by several lambda functions: the admitted copies of
+# src_schedule_copy and the checkpoint of src_backfill_snapshots
+COPY_QUEUE_DOCUMENT = 'scheduler:copies'
+BACKFILL_DOCUMENT   = 'backfill:checkpoint'
+
+# Collection of the replications waiting for admission by src_schedule_copy,
+# one document each
+COPY_QUEUE_WAITING = 'scheduler:waiting'
+
+class Ledger(object):
+    """Replication state of every source snapshot, keyed by its ARN
+
+    An entry is a dict with source_arn, state, attempt, updated_at and
+    expires_at. A replication claims a snapshot before it starts, and can
+    only claim it again once the previous replication has failed, or has
+    been pending or copying for longer than stale_seconds without finishing.
+    Subclasses store the entries in _get, _put and _delete, which are called
+    with the lock held.
+
+    The ledger also keeps documents, JSON objects shared by all invocations
+    such as the queue of src_schedule_copy, in the same store. A document is
+    only written if it has not changed since it was read, subclasses store
+    them in _get_document, _put_document and _delete_document. Documents may
+    belong to a collection, which _list_documents returns all documents of.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+
+    def get(self, source_arn):
+        """Returns the entry of a snapshot, None if it has never been claimed"""
+        with self.lock:
+            return self._get(source_arn)
+
+    def claim(self, source_arn, stale_seconds):
+        """Claims a snapshot for replication
+
+        Arguments:
+            source_arn {str} -- ARN of the source snapshot
+            stale_seconds {int} -- when an unfinished replication may be repeated
+
+        Returns:
+            dict -- the new entry, None if the snapshot is done or in progress
+        """
+        with self.lock:
+            entry = self._get(source_arn)
+            if not claimable(entry, stale_seconds):
+                return None
+            entry = _ledger_entry(source_arn, LEDGER_PENDING, (entry or {}).get('attempt', 0) + 1)
+            self._put(entry)
+            return entry
+
+    def set_state(self, source_arn, state):
+        """Records the progress of a replication
+
+        Arguments:
+            source_arn {str} -- ARN of the source snapshot
+            state {str} -- LEDGER_COPYING, LEDGER_DONE or LEDGER_FAILED
+        """
+        with self.lock:
+            entry = self._get(source_arn) or {}
+            self._put(_ledger_entry(source_arn, state, entry.get('attempt', 1)))
+
+    def release(self, source_arn):
+        """Forgets a claim, e.g. when the replication could not be started"""
+        with self.lock:
+            self._delete(source_arn)
+
+    def get_document(self, key):
+        """Returns a document and its version, ({}, 0) if it does not exist"""
+        with self.lock:
+            return self._get_document(key)
+
+    def put_document(self, key, document, version, collection=None):
+        """Stores a document, unless another writer has changed it since
+
+        Arguments:
+            key {str} -- key of the document
+            document {dict} -- JSON serializable document
+            version {int} -- version the document was read with
+            collection {str} -- collection the document belongs to, if any
+
+        Returns:
+            boolean -- True if it has been stored, False on a conflict
+        """
+        with self.lock:
+            if self._get_document(key)[1] != version:
+                return False
+            self._put_document(key, document, version + 1, collection)
+            return True
+
+    def update_document(self, key, function, attempts=10, collection=None):
+        """Reads, changes and stores a document until there is no conflict
+
+        A document the function leaves unchanged is not written, so readers
+        do not contend with each other.
+
+        Arguments:
+            key {str} -- key of the document
+            function {callable} -- changes the document in place, may be
+                called several times and must only depend on the document
+            attempts {int} -- how often to try
+            collection {str} -- collection the document belongs to, if any
+
+        Returns:
+            object -- result of the successful call of function
+        """
+        for _ in range(attempts):
+            document, version = self.get_document(key)
+            original = copy.deepcopy(document)
+            result = function(document)
+            if document == original or self.put_document(key, document, version, collection):
+                return result
+        raise SnapshotSharingException('Could not update ledger document {}'.format(key))
+
+    def delete_document(self, key):
+        """Deletes a document, if it exists"""
+        with self.lock:
+            self._delete_document(key)
+
+    def list_documents(self, collection):
+        """Returns all documents of a collection
+
+        Arguments:
+            collection {str} -- collection the documents were stored with
+
+        Returns:
+            dict -- documents by key
+        """
+        with self.lock:
+            return self._list_documents(collection)
+
+def claimable(entry, stale_seconds):
+    """Tells whether a snapshot may be replicated
+
+    Arguments:
+        entry {dict} -- ledger entry or None
+        stale_seconds {int} -- when an unfinished replication may be repeated
+
+    Returns:
+        boolean -- True if it has never been claimed or its replication failed
+            or is stale
+    """
+    if not entry:
+        return True
+    if entry['state'] == LEDGER_DONE:
+        return False
+    if entry['state'] == LEDGER_FAILED:
+        return True
+    return entry['updated_at'] < time.time() - stale_seconds
+
+def _ledger_entry(source_arn, state, attempt):
+    now = int(time.time())
+    return {
+        'source_arn' : source_arn,
+        'state'      : state,
+        'attempt'    : int(attempt),
+        'updated_at' : now,
+        'expires_at' : now + LEDGER_TTL_DAYS * 86400
+    }
+
+class FileLedger(Ledger):
+    """Keeps the ledger in a JSON file, for tests and local tools"""
+
+    def __init__(self, path):
+        super(FileLedger, self).__init__()
+        self.path = path
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as ledger_file:
+            return json.load(ledger_file)
+
+    def _save(self, entries):
+        with open(self.path + '.tmp', 'w') as ledger_file:
+            json.dump(entries, ledger_file)
+        os.replace(self.path + '.tmp', self.path)
+
+    def _get(self, source_arn):
+        return self._load().get(source_arn)
+
+    def _put(self, entry):
+        entries = self._load()
+        entries[entry['source_arn']] = entry
+        self._save(entries)
+
+    def _delete(self, source_arn):
+        entries = self._load()
+        entries.pop(source_arn, None)
+        self._save(entries)
+
+    def _get_document(self, key):
+        entry = self._load().get(key) or {}
+        return entry.get('document', {}), entry.get('version', 0)
+
+    def _put_document(self, key, document, version, collection):
+        entries = self._load()
+        entries[key] = {'source_arn': key, 'document': document, 'version': version, 'collection': collection}
+        self._save(entries)
+
+    def _delete_document(self, key):
+        self._delete(key)
+
+    def _list_documents(self, collection):
+        return {
+            key: entry['document']
+            for key, entry in self._load().items()
+            if collection and entry.get('collection') == collection
+        }
+
+class SQLiteLedger(Ledger):
+    """Keeps the ledger in a SQLite database, for tests and local tools"""
+
+    COLUMNS = ('source_arn', 'state', 'attempt', 'updated_at', 'expires_at')
+
+    def __init__(self, path):
+        super(SQLiteLedger, self).__init__()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS ledger ('
+            'source_arn TEXT PRIMARY KEY, state TEXT, attempt INTEGER, updated_at INTEGER, expires_at INTEGER)'
+        )
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS documents (key TEXT PRIMARY KEY, document TEXT, version INTEGER, collection TEXT)'
+        )
+
+    def _get(self, source_arn):
+        row = self.connection.execute(
+            'SELECT {} FROM ledger WHERE source_arn = ?'.format(', '.join(self.COLUMNS)),
+            (source_arn,)
+        ).fetchone()
+        return dict(zip(self.COLUMNS, row)) if row else None
+
+    def _put(self, entry):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO ledger ({}) VALUES (?, ?, ?, ?, ?)'.format(', '.join(self.COLUMNS)),
+            tuple(entry[column] for column in self.COLUMNS)
+        )
+
+    def _delete(self, source_arn):
+        self.connection.execute('DELETE FROM ledger WHERE source_arn = ?', (source_arn,))
+
+    def _get_document(self, key):
+        row = self.connection.execute('SELECT document, version FROM documents WHERE key = ?', (key,)).fetchone()
+        return (json.loads(row[0]), row[1]) if row else ({}, 0)
+
+    def _put_document(self, key, document, version, collection):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO documents (key, document, version, collection) VALUES (?, ?, ?, ?)',
+            (key, json.dumps(document), version, collection)
+        )
+
+    def _delete_document(self, key):
+        self.connection.execute('DELETE FROM documents WHERE key = ?', (key,))
+
+    def _list_documents(self, collection):
+        rows = self.connection.execute('SELECT key, document FROM documents WHERE collection = ?', (collection,))
+        return {key: json.loads(document) for key, document in rows}
+
+class DynamoDBLedger(Ledger):
+    """Keeps the ledger in a DynamoDB table with the hash key source_arn
+
+    Claims are conditional writes, so concurrent Lambda invocations cannot
+    claim the same snapshot twice. Documents of a collection are found by the
+    index COLLECTION_INDEX on their collection attribute. It is eventually
+    consistent, so a document stored a moment ago may not be listed yet.
+    """
+
+    COLLECTION_INDEX = 'collection'
+
+    def __init__(self, table):
+        super(DynamoDBLedger, self).__init__()
+        self.table    = table
+        self.dynamodb = LazyClient('dynamodb')
+
+    def get(self, source_arn):
+        item = self.dynamodb.get_item(
+            TableName      = self.table,
+            Key            = {'source_arn': {'S': source_arn}},
+            ConsistentRead = True
+        ).get('Item')
+        return _from_item(item) if item else None
+
+    def claim(self, source_arn, stale_seconds):
+        now = int(time.time())
+        try:
+            item = self.dynamodb.update_item(
+                TableName                 = self.table,
+                Key                       = {'source_arn': {'S': source_arn}},
+                UpdateExpression          = 'SET #state = :pending, updated_at = :now, expires_at = :expires ADD attempt :one',
+                ConditionExpression       = 'attribute_not_exists(source_arn) OR #state = :failed OR (#state <> :done AND updated_at < :stale)',
+                ExpressionAttributeNames  = {'#state': 'state'},
+                ExpressionAttributeValues = {
+                    ':pending' : {'S': LEDGER_PENDING},
+                    ':done'    : {'S': LEDGER_DONE},
+                    ':failed'  : {'S': LEDGER_FAILED},
+                    ':now'     : {'N': str(now)},
+                    ':stale'   : {'N': str(now - stale_seconds)},
+                    ':expires' : {'N': str(now + LEDGER_TTL_DAYS * 86400)},
+                    ':one'     : {'N': '1'}
+                },
+                ReturnValues              = 'ALL_NEW'
+            )['Attributes']
+        except Exception as e:
+            if error_code(e) == 'ConditionalCheckFailedException':
+                return None
+            raise
+        return _from_item(item)
+
+    def set_state(self, source_arn, state):
+        now = int(time.time())
+        self.dynamodb.update_item(
+            TableName                 = self.table,
+            Key                       = {'source_arn': {'S': source_arn}},
+            UpdateExpression          = 'SET #state = :state, updated_at = :now, expires_at = :expires',
+            ExpressionAttributeNames  = {'#state': 'state'},
+            ExpressionAttributeValues = {
+                ':state'   : {'S': state},
+                ':now'     : {'N': str(now)},
+                ':expires' : {'N': str(now + LEDGER_TTL_DAYS * 86400)}
+            }
+        )
+
+    def release(self, source_arn):
+        self.dynamodb.delete_item(
+            TableName = self.table,
+            Key       = {'source_arn': {'S': source_arn}}
+        )
+
+    def get_document(self, key):
+        item = self.dynamodb.get_item(
+            TableName      = self.table,
+            Key            = {'source_arn': {'S': key}},
+            ConsistentRead = True
+        ).get('Item')
+        if not item or 'document' not in item:
+            return {}, 0
+        return json.loads(item['document']['S']), int(item['version']['N'])
+
+    def put_document(self, key, document, version, collection=None):
+        # The version is the condition of the write, documents do not expire
+        names  = {'#document': 'document', '#version': 'version'}
+        values = {
+            ':document' : {'S': json.dumps(document)},
+            ':version'  : {'N': str(version)},
+            ':next'     : {'N': str(version + 1)}
+        }
+        update = 'SET #document = :document, #version = :next'
+        if collection:
+            names['#collection'] = 'collection'
+            values[':collection'] = {'S': collection}
+            update += ', #collection = :collection'
+        try:
+            self.dynamodb.update_item(
+                TableName                 = self.table,
+                Key                       = {'source_arn': {'S': key}},
+                UpdateExpression          = update,
+                ConditionExpression       = 'attribute_not_exists(#version) OR #version = :version',
+                ExpressionAttributeNames  = names,
+                ExpressionAttributeValues = values
+            )
+        except Exception as e:
+            if error_code(e) == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+
+    def delete_document(self, key):
+        self.release(key)
+
+    def list_documents(self, collection):
+        documents = {}
+        pages = self.dynamodb.get_paginator('query').paginate(
+            TableName                 = self.table,
+            IndexName                 = self.COLLECTION_INDEX,
+            KeyConditionExpression    = '#collection = :collection',
+            ExpressionAttributeNames  = {'#collection': 'collection'},
+            ExpressionAttributeValues = {':collection': {'S': collection}}
+        )
+        for page in pages:
+            for item in page['Items']:
+                documents[item['source_arn']['S']] = json.loads(item['document']['S'])
+        return documents
+
+def _from_item(item):
+    """Converts a DynamoDB item into a ledger entry"""
+    return {
+        'source_arn' : item['source_arn']['S'],
+        'state'      : item['state']['S'],
+        'attempt'    : int(item.get('attempt', {'N': '1'})['N']),
+        'updated_at' : int(item['updated_at']['N']),
+        'expires_at' : int(item.get('expires_at', {'N': '0'})['N'])
+    }
+
+LEDGER_BACKENDS = {
+    'dynamodb' : DynamoDBLedger,
+    'file'     : FileLedger,
+    'sqlite'   : SQLiteLedger,
+}
+
+_ledgers      = {}
+_ledgers_lock = threading.Lock()
+
+def get_ledger(url):
+    """Returns the ledger stored at url, shared by all callers
+
+    Arguments:
+        url {str} -- 'dynamodb://<table>', 'sqlite://<path>' or 'file://<path>',
+            an empty string disables the ledger
+
+    Returns:
+        Ledger -- or None if url is empty
+    """
+    if not url:
+        return None
+    with _ledgers_lock:
+        if url not in _ledgers:
+            backend, _, location = url.partition('://')
+            if backend not in LEDGER_BACKENDS:
+                raise ValueError('Unknown ledger backend {}'.format(backend))
+            _ledgers[url] = LEDGER_BACKENDS[backend](location)
+        return _ledgers[url]
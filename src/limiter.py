@@ -0,0 +1,163 @@
+'''
+Copyright 2019  Pinguin AG, Mattis Haase
+
+Licensed under the Apache License, Version 2.0 (the "License").
+'''
+
+# limiter.py
+# Client side rate limiting of the AWS API calls of a Lambda container. Every
+# service listed in API_RATE_LIMITS gets a token bucket shared by all clients
+# and threads calling it, which common.get_client puts in front of every
+# request.
+
+import os
+import threading
+import time
+
+from collections import Counter
+
+# Error codes AWS APIs return when a request exceeds the API rate
+THROTTLING_ERRORS = (
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottledException',
+    'RequestLimitExceeded',
+    'TooManyRequestsException',
+    'RequestThrottled',
+    'SlowDown',
+)
+
+# Requests per second each service may be called with by one Lambda container,
+# e.g. API_RATE_LIMITS="rds=10,sns=50". Services not listed are not limited.
+# Terraform sets it per function, so the scheduled sweeps may use a larger share
+# of the account-level RDS quota than the concurrently running pipeline stages.
+DEFAULT_API_RATE_LIMITS = 'rds=10,sns=50,stepfunctions=20'
+
+class TokenBucket(object):
+    """Rate limiter shared by all threads calling one service
+
+    Every request, including retries by botocore, takes a token. Tokens are
+    refilled at the current rate up to a burst of one second worth of
+    requests. The rate is halved on every throttling error and grows back by a
+    twentieth of the maximum rate with every successful call, so concurrent
+    callers slow down together instead of retrying in lockstep.
+    """
+
+    def __init__(self, rate):
+        self.max_rate  = float(rate)
+        self.min_rate  = self.max_rate / 20
+        self.rate      = self.max_rate
+        self.tokens    = self.max_rate
+        self.timestamp = time.monotonic()
+        self.lock      = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.tokens + (now - self.timestamp) * self.rate, max(self.rate, 1))
+        self.timestamp = now
+
+    def acquire(self):
+        """Blocks until a request may be sent
+
+        Returns:
+            boolean -- True if it had to wait
+        """
+        waited = False
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited = True
+
+    def throttled(self):
+        """Slows down after a throttling error"""
+        with self.lock:
+            self._refill()
+            self.rate = max(self.rate / 2, self.min_rate)
+            self.tokens = min(self.tokens, 0)
+
+    def succeeded(self):
+        """Speeds up again after a successful call"""
+        with self.lock:
+            self._refill()
+            self.rate = min(self.rate + self.max_rate / 20, self.max_rate)
+
+def parse_rate_limits(value):
+    """Parses a comma separated list of service=requests per second
+
+    Arguments:
+        value {str} -- e.g. 'rds=10,sns=50'
+
+    Returns:
+        dict -- requests per second by service
+    """
+    rate_limits = {}
+    for item in value.split(','):
+        if item.strip():
+            service, rate = item.split('=')
+            if float(rate) > 0:
+                rate_limits[service.strip()] = float(rate)
+    return rate_limits
+
+API_RATE_LIMITS = parse_rate_limits(os.getenv('API_RATE_LIMITS', DEFAULT_API_RATE_LIMITS))
+
+_rate_limiters = {}
+_throttles     = Counter()
+_throttle_lock = threading.Lock()
+
+def get_rate_limiter(service):
+    """Returns the TokenBucket of a service, None if it is not limited
+
+    Arguments:
+        service {str} -- e.g. 'rds'
+
+    Returns:
+        TokenBucket -- shared by all clients of the service
+    """
+    with _throttle_lock:
+        if service not in _rate_limiters:
+            _rate_limiters[service] = None
+            if service in API_RATE_LIMITS:
+                _rate_limiters[service] = TokenBucket(API_RATE_LIMITS[service])
+        return _rate_limiters[service]
+
+def throttle_counts():
+    """Returns how often each operation has been throttled in this container
+
+    Returns:
+        dict -- throttling errors by 'service.Operation'
+    """
+    with _throttle_lock:
+        return dict(_throttles)
+
+def count_throttle(service, operation):
+    """Counts a throttling error of an operation
+
+    Arguments:
+        service {str} -- e.g. 'rds'
+        operation {str} -- e.g. 'CopyDBSnapshot'
+
+    Returns:
+        int -- how often the operation has been throttled in this container
+    """
+    key = '{}.{}'.format(service, operation)
+    with _throttle_lock:
+        _throttles[key] += 1
+        return _throttles[key]
+
+def is_throttling_response(response):
+    """Tells whether an attempt of an API call has been throttled
+
+    Arguments:
+        response {tuple} -- (http response, parsed response) of botocore, or None
+
+    Returns:
+        boolean -- True for throttling errors
+    """
+    parsed = response[1] if response else None
+    return bool(parsed) and parsed.get('Error', {}).get('Code') in THROTTLING_ERRORS
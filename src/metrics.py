@@ -0,0 +1,145 @@
+'''
+Copyright 2019  Pinguin AG, Mattis Haase
+
+Licensed under the Apache License, Version 2.0 (the "License").
+'''
+
+# metrics.py
+# Metrics of the handler invocations and of their AWS API calls.
+# common.instrument_handler starts and writes the metrics of an invocation,
+# common.get_client records the metrics of every API call.
+
+import os
+import json
+import threading
+import time
+
+# Metrics are written as CloudWatch Embedded Metric Format log lines, which
+# CloudWatch Logs turns into metrics without any extra API calls
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'RDSSnapshotReplication').strip()
+
+# CloudWatch accepts at most this many values of a metric in one log line
+MAX_METRIC_VALUES = 100
+
+class StdoutSink(object):
+    """Prints metric records to stdout, where Lambda sends them to CloudWatch Logs"""
+
+    def emit(self, record):
+        print(json.dumps(record))
+
+class MemorySink(object):
+    """Keeps metric records in memory, e.g. for tests and local tools"""
+
+    def __init__(self):
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+class Metrics(object):
+    """Collects the metrics of one handler invocation
+
+    Handler metrics like Duration have the Function dimension, API call
+    metrics additionally have an Operation dimension, e.g. 'rds.CopyDBSnapshot'.
+    Metrics can be recorded from any thread and are written by flush.
+    """
+
+    def __init__(self, sink):
+        self.sink       = sink
+        self.function   = None
+        self.values     = {}
+        self.operations = {}
+        self.lock       = threading.Lock()
+
+    def start(self, function):
+        """Starts collecting metrics of a new invocation"""
+        with self.lock:
+            self.function   = function
+            self.values     = {}
+            self.operations = {}
+
+    def put_metric(self, name, value, unit='Count', operation=None):
+        """Records a value of a metric
+
+        Arguments:
+            name {str} -- metric name, e.g. 'AllocatedStorage'
+            value {float} -- value to record
+            unit {str} -- CloudWatch unit, e.g. 'Milliseconds'
+            operation {str} -- Operation dimension, None for handler metrics
+        """
+        with self.lock:
+            values = self.values
+            if operation:
+                values = self.operations.setdefault(operation, {})
+            values.setdefault(name, (unit, []))[1].append(value)
+
+    def count(self, name, value=1, operation=None):
+        """Adds to a counter, which is written as a single sum
+
+        Arguments:
+            name {str} -- metric name, e.g. 'Calls'
+            value {int} -- amount to add
+            operation {str} -- Operation dimension, None for handler metrics
+        """
+        with self.lock:
+            values = self.values
+            if operation:
+                values = self.operations.setdefault(operation, {})
+            counter = values.setdefault(name, ('Count', [0]))[1]
+            counter[0] += value
+
+    def flush(self):
+        """Writes all collected metrics to the sink and starts over"""
+        with self.lock:
+            groups = [(['Function'], {}, self.values)]
+            for operation, values in sorted(self.operations.items()):
+                groups.append((['Function', 'Operation'], {'Operation': operation}, values))
+            function = self.function
+            self.values     = {}
+            self.operations = {}
+        for dimensions, dimension_values, values in groups:
+            for record in self._records(function, dimensions, dimension_values, values):
+                self.sink.emit(record)
+
+    def _records(self, function, dimensions, dimension_values, values):
+        """Builds the EMF records of one set of dimension values"""
+        records = []
+        for name, (unit, metric_values) in sorted(values.items()):
+            for index, start in enumerate(range(0, len(metric_values), MAX_METRIC_VALUES)):
+                chunk = metric_values[start:start + MAX_METRIC_VALUES]
+                if index == len(records):
+                    records.append(dict(dimension_values, Function=function, _aws={
+                        'Timestamp'         : int(time.time() * 1000),
+                        'CloudWatchMetrics' : [{
+                            'Namespace'  : METRICS_NAMESPACE,
+                            'Dimensions' : [dimensions],
+                            'Metrics'    : []
+                        }]
+                    }))
+                records[index]['_aws']['CloudWatchMetrics'][0]['Metrics'].append({'Name': name, 'Unit': unit})
+                records[index][name] = chunk if len(chunk) > 1 else chunk[0]
+        return records
+
+METRICS = Metrics(StdoutSink())
+
+def set_metrics_sink(sink):
+    """Replaces where metrics are written to, e.g. by a MemorySink
+
+    Arguments:
+        sink {obj} -- object with an emit(record) method
+
+    Returns:
+        obj -- the previous sink
+    """
+    previous, METRICS.sink = METRICS.sink, sink
+    return previous
+
+def put_metric(name, value, unit='Count'):
+    """Records a metric of the current handler invocation
+
+    Arguments:
+        name {str} -- metric name, e.g. 'AllocatedStorage'
+        value {float} -- value to record
+        unit {str} -- CloudWatch unit, e.g. 'Gigabytes'
+    """
+    METRICS.put_metric(name, value, unit)
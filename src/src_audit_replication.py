@@ -0,0 +1,287 @@
+'''
+Copyright 2019  Pinguin AG, Mattis Haase
+
+Licensed under the Apache License, Version 2.0 (the "License").
+'''
+
+# src_audit_replication.py
+# This lambda function checks whether every database has a recent replicated
+# snapshot in every destination. It:
+# 1. pages through the automated instance and cluster snapshots of the source
+#    region and the SOURCE_REGIONS whose identifier matches PATTERN and
+#    indexes them by the identifier their copies are named after
+# 2. pages through the 'replication-<SRC_ACCOUNT>-' snapshots of every
+#    destination, up to SCAN_WORKERS destinations in parallel, and looks each
+#    one up in the index, keeping only the newest replicated snapshot of every
+#    database, so the destination snapshots are never held in memory
+# 3. pages through the intermediate copies the source account keeps in the
+#    destination regions
+# 4. reports for every database and destination
+#    - the replication lag: how old the newest replicated snapshot is
+#    - the missing copies: snapshots newer than that, which should have been
+#      replicated within MAX_LAG_HOURS
+#    and the intermediate copies older than COPY_TIMEOUT_HOURS, except the
+#    newest copy of every DB instance which INCREMENTAL keeps on purpose
+#
+# The report is returned and its counts are written as metrics. The same
+# audit can be run locally with tools/audit_replication.py.
+
+import os
+import re
+
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+
+from common import *
+
+LOGLEVEL           = os.getenv('LOGLEVEL', 'ERROR').strip()
+SRC_REGION         = os.getenv('SRC_REGION').strip()
+SRC_ACCOUNT        = os.getenv('SRC_ACCOUNT').strip()
+PATTERN            = os.getenv('PATTERN').strip()
+MAX_LAG_HOURS      = int(os.getenv('MAX_LAG_HOURS', '26').strip())
+COPY_TIMEOUT_HOURS = int(os.getenv('COPY_TIMEOUT_HOURS', '72').strip())
+INCREMENTAL        = os.getenv('INCREMENTAL', 'false').strip().lower() == 'true'
+SCAN_WORKERS       = int(os.getenv('SCAN_WORKERS', '8').strip())
+DESTINATIONS       = get_destinations()
+
+logger = get_logger(LOGLEVEL)
+
+SOURCE_REGIONS = get_source_regions(SRC_REGION)
+
+RDS = dict(
+    (region, LazyClient('rds', region_name=region))
+    for region in SOURCE_REGIONS
+)
+
+# The intermediate copies are kept by the source account in every
+# destination region
+LOCAL_RDS = dict(
+    (region, LazyClient('rds', region_name=region))
+    for region in destination_regions(DESTINATIONS)
+)
+
+# The replicated snapshots are listed with the role of their destination
+DST_RDS = dict(
+    (destination_key(destination), LazyClient('rds', region_name=destination.region, role_arn=destination.role_arn))
+    for destination in DESTINATIONS
+)
+
+# The only fields the audit needs, so that tens of thousands of snapshots do
+# not keep the full describe responses in memory. database is a
+# (kind, instance or cluster identifier, region) tuple for source snapshots
+# and a (kind, instance or cluster identifier) tuple for intermediate copies
+SourceSnapshot = namedtuple('SourceSnapshot', ['database', 'identifier', 'create_time'])
+Intermediate = namedtuple('Intermediate', ['region', 'database', 'identifier', 'create_time', 'status'])
+
+@instrument_handler
+def lambda_handler(event, context):
+    """Main method
+
+    Arguments:
+        event {dict} -- Lambda event object
+        context {obj} -- Lambda context object
+
+    Returns:
+        dict -- the report, see build_report
+    """
+    logger.debug('event: %s', summarize(event))
+    report = audit(datetime.now(timezone.utc))
+    summary = report['summary']
+    logger.info('Audit summary: %s', summary)
+    put_metric('LaggingDatabases', summary['lagging'])
+    put_metric('MissingCopies', summary['missing_copies'])
+    put_metric('StuckIntermediates', summary['stuck_intermediates'])
+    for database in report['databases']:
+        if database['lag_hours'] is not None:
+            put_metric('ReplicationLag', database['lag_hours'] * 3600, 'Seconds')
+    return report
+
+def audit(now):
+    """Joins the source snapshots with the replicated snapshots of every destination
+
+    Arguments:
+        now {datetime} -- current time, timezone aware
+
+    Returns:
+        dict -- the report, see build_report
+    """
+    sources = index_sources()
+    logger.info('Indexed %s source snapshots', len(sources))
+    newest = run_concurrently(
+        lambda destination: newest_replicated(destination, sources),
+        DESTINATIONS,
+        SCAN_WORKERS
+    )
+    intermediates = []
+    for region_intermediates in run_concurrently(get_intermediates, destination_regions(DESTINATIONS), SCAN_WORKERS):
+        intermediates.extend(region_intermediates)
+    return build_report(
+        sources,
+        dict(zip([destination_key(destination) for destination in DESTINATIONS], newest)),
+        intermediates,
+        now
+    )
+
+def index_sources():
+    """Indexes the automated snapshots of all source regions that match PATTERN
+
+    Returns:
+        dict -- SourceSnapshot by join key
+    """
+    logger.info('Indexing source snapshots')
+    sources = {}
+    for region in SOURCE_REGIONS:
+        for kind, identifier, database, snapshot in iter_rds_snapshots(RDS[region], 'automated'):
+            if re.search(PATTERN, identifier):
+                sources[replica_key(kind, replica_name(identifier, region, SRC_REGION))] = SourceSnapshot(
+                    (kind, database, region),
+                    identifier,
+                    snapshot['SnapshotCreateTime']
+                )
+    return sources
+
+def newest_replicated(destination, sources):
+    """Finds the newest replicated snapshot of every database in a destination
+
+    Arguments:
+        destination {Destination} -- destination to look at
+        sources {dict} -- SourceSnapshot by join key
+
+    Returns:
+        dict -- create time of the newest replicated source snapshot by database
+    """
+    prefix = replication_prefix(SRC_ACCOUNT)
+    logger.info('Looking for replicated snapshots in %s', destination_key(destination))
+    newest = {}
+    for kind, identifier, _, snapshot in iter_rds_snapshots(DST_RDS[destination_key(destination)], 'manual'):
+        if not identifier.startswith(prefix):
+            continue
+        source = sources.get(replica_key(kind, identifier[len(prefix):]))
+        if source and (source.database not in newest or newest[source.database] < source.create_time):
+            newest[source.database] = source.create_time
+    return newest
+
+def get_intermediates(region):
+    """Lists the intermediate copies of a destination region
+
+    Arguments:
+        region {str} -- destination region
+
+    Returns:
+        list -- Intermediate copies
+    """
+    logger.info('Looking for intermediate copies in %s', region)
+    return [
+        Intermediate(region, (kind, database), identifier, snapshot['SnapshotCreateTime'], snapshot.get('Status'))
+        for kind, identifier, database, snapshot in iter_rds_snapshots(LOCAL_RDS[region], 'manual')
+        if identifier.startswith(LOCAL_COPY_PREFIX)
+    ]
+
+def stuck_intermediates(intermediates, now):
+    """Returns the intermediate copies that should have been deleted by now
+
+    Arguments:
+        intermediates {list} -- Intermediate copies
+        now {datetime} -- current time, timezone aware
+
+    Returns:
+        list -- stuck Intermediate copies
+    """
+    kept = set()
+    if INCREMENTAL:
+        newest = {}
+        for intermediate in intermediates:
+            key = (intermediate.region, intermediate.database)
+            if intermediate.database[0] == 'instance' and (
+                key not in newest or newest[key].create_time < intermediate.create_time
+            ):
+                newest[key] = intermediate
+        kept = set(intermediate.identifier for intermediate in newest.values())
+    stuck_before = now - timedelta(hours=COPY_TIMEOUT_HOURS)
+    return [
+        intermediate for intermediate in intermediates
+        if intermediate.create_time < stuck_before and intermediate.identifier not in kept
+    ]
+
+def hours(delta):
+    """Returns a timedelta in hours, rounded for the report"""
+    return round(delta.total_seconds() / 3600, 2)
+
+def build_report(sources, newest, intermediates, now):
+    """Builds the report of an audit
+
+    Arguments:
+        sources {dict} -- SourceSnapshot by join key
+        newest {dict} -- newest_replicated results by destination key
+        intermediates {list} -- Intermediate copies
+        now {datetime} -- current time, timezone aware
+
+    Returns:
+        dict -- generated_at, summary, databases and stuck_intermediates, the
+            databases with the largest lag first
+    """
+    due_before = now - timedelta(hours=MAX_LAG_HOURS)
+    databases = {}
+    for source in sources.values():
+        for destination, replicated in newest.items():
+            entry = databases.get((source.database, destination))
+            if not entry:
+                entry = databases[(source.database, destination)] = {
+                    'database'          : source.database[1],
+                    'kind'              : source.database[0],
+                    'source_region'     : source.database[2],
+                    'destination'       : destination,
+                    'newest_snapshot'   : source.create_time,
+                    'newest_replicated' : replicated.get(source.database),
+                    'missing'           : []
+                }
+            entry['newest_snapshot'] = max(entry['newest_snapshot'], source.create_time)
+            if source.create_time < due_before and (
+                not entry['newest_replicated'] or entry['newest_replicated'] < source.create_time
+            ):
+                entry['missing'].append(source.identifier)
+
+    report_databases = []
+    for entry in databases.values():
+        entry['lag_hours'] = None
+        if entry['newest_replicated']:
+            entry['lag_hours'] = hours(now - entry['newest_replicated'])
+            entry['newest_replicated'] = entry['newest_replicated'].isoformat()
+        entry['newest_snapshot'] = entry['newest_snapshot'].isoformat()
+        entry['missing'].sort()
+        report_databases.append(entry)
+    report_databases.sort(key=lambda entry: (
+        entry['lag_hours'] is not None,
+        -(entry['lag_hours'] or 0),
+        entry['database'],
+        entry['destination']
+    ))
+
+    stuck = stuck_intermediates(intermediates, now)
+    return {
+        'generated_at' : now.isoformat(),
+        'summary'      : {
+            'source_snapshots'    : len(sources),
+            'databases'           : len(set(source.database for source in sources.values())),
+            'lagging'             : len([
+                entry for entry in report_databases
+                if entry['lag_hours'] is None or entry['lag_hours'] > MAX_LAG_HOURS
+            ]),
+            'unreplicated'        : len([entry for entry in report_databases if entry['lag_hours'] is None]),
+            'missing_copies'      : sum(len(entry['missing']) for entry in report_databases),
+            'stuck_intermediates' : len(stuck)
+        },
+        'databases'           : report_databases,
+        'stuck_intermediates' : [
+            {
+                'region'      : intermediate.region,
+                'identifier'  : intermediate.identifier,
+                'database'    : intermediate.database[1],
+                'kind'        : intermediate.database[0],
+                'create_time' : intermediate.create_time.isoformat(),
+                'age_hours'   : hours(now - intermediate.create_time),
+                'status'      : intermediate.status
+            }
+            for intermediate in sorted(stuck, key=lambda intermediate: intermediate.create_time)
+        ]
+    }
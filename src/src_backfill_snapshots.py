@@ -0,0 +1,312 @@
+'''
+Copyright 2019  Pinguin AG, Mattis Haase
+
+Licensed under the Apache License, Version 2.0 (the "License").
+'''
+
+# src_backfill_snapshots.py
+# This lambda function replicates the snapshots that were missed, e.g. while
+# the replication was broken. src_backup_event only sees new events and
+# src_check_aurora_backups only the latest BACKUP_LAST_N snapshots.
+#
+# A backfill is started by invoking it with
+#   {"since": "2019-06-01T00:00:00+00:00", "until": <optional, default now>}
+# which stores a checkpoint in the ledger. Every scheduled invocation then
+# continues the backfill of the checkpoint, until it is finished:
+# 1. pages through the automated instance and cluster snapshots of the source
+#    region and the SOURCE_REGIONS created between since and until whose
+#    identifier matches PATTERN and which are past the cursor of the checkpoint
+# 2. pages through the replicated snapshots of every destination and drops the
+#    snapshots already replicated to all of them, and those the ledger knows
+#    to be replicated, whose copies may have been deleted by retention since
+# 3. publishes events for the oldest of the rest, BATCH_SIZE snapshots per
+#    event and PUBLISH_BATCH_SIZE events per publish call, like
+#    src_check_aurora_backups does. A wave has at most WAVE_SIZE snapshots,
+#    less the replications waiting for admission by src_schedule_copy, so a
+#    backfill never queues more copies than the copy budget works off
+# 4. moves the cursor past the published snapshots
+#
+# Snapshots are published at most once per backfill, src_backup_event skips
+# snapshots the ledger knows to be replicated or being replicated.
+
+import json
+import os
+import re
+
+from datetime import datetime, timezone
+
+from common import *
+from ledger import *
+
+LOGLEVEL           = os.getenv('LOGLEVEL', 'ERROR').strip()
+SRC_REGION         = os.getenv('SRC_REGION').strip()
+SRC_ACCOUNT        = os.getenv('SRC_ACCOUNT').strip()
+SNS_TOPIC_ARN      = os.getenv('SNS_TOPIC_ARN').strip()
+PATTERN            = os.getenv('PATTERN').strip()
+WAVE_SIZE          = int(os.getenv('WAVE_SIZE', '20').strip())
+SCAN_WORKERS       = int(os.getenv('SCAN_WORKERS', '8').strip())
+# SNS accepts at most 10 entries per publish_batch call
+PUBLISH_BATCH_SIZE = min(int(os.getenv('PUBLISH_BATCH_SIZE', '10').strip()), 10)
+# Snapshots per event, more than 1 replicates them in batch mode
+BATCH_SIZE         = int(os.getenv('BATCH_SIZE', '1').strip())
+DESTINATIONS       = get_destinations()
+
+EVENT_SOURCES = {'instance': 'db-snapshot', 'cluster': 'db-cluster-snapshot'}
+
+logger = get_logger(LOGLEVEL)
+
+LEDGER = get_ledger(os.getenv('LEDGER', '').strip())
+
+SOURCE_REGIONS = get_source_regions(SRC_REGION)
+
+RDS = dict(
+    (region, LazyClient('rds', region_name=region))
+    for region in SOURCE_REGIONS
+)
+SNS = LazyClient('sns', region_name=SRC_REGION)
+
+DST_RDS = dict(
+    (destination_key(destination), LazyClient('rds', region_name=destination.region, role_arn=destination.role_arn))
+    for destination in DESTINATIONS
+)
+
+@instrument_handler
+def lambda_handler(event, context):
+    """Main method
+
+    Arguments:
+        event {dict} -- Lambda event object, with since to start a backfill
+        context {obj} -- Lambda context object
+
+    Returns:
+        dict -- checkpoint with enqueued and remaining of this invocation
+    """
+    logger.debug('event: %s', summarize(event))
+    if not LEDGER:
+        raise SnapshotSharingException('A backfill needs a ledger for its checkpoint')
+
+    if event.get('since'):
+        checkpoint = start_backfill(event['since'], event.get('until'))
+        version = LEDGER.get_document(BACKFILL_DOCUMENT)[1]
+    else:
+        checkpoint, version = LEDGER.get_document(BACKFILL_DOCUMENT)
+    if not checkpoint or checkpoint.get('finished_at'):
+        logger.info('No backfill in progress')
+        return dict(checkpoint, enqueued=0, remaining=0)
+
+    missing = missing_snapshots(checkpoint)
+    wave = missing[:wave_size()]
+    published = publish_wave(wave)
+    if published:
+        checkpoint['cursor'] = cursor_of(wave[published - 1])
+    checkpoint['enqueued'] += published
+    remaining = len(missing) - published
+    if not remaining:
+        checkpoint['finished_at'] = datetime.now(timezone.utc).isoformat()
+    logger.info('Backfill enqueued %s snapshots, %s remaining', published, remaining)
+    put_metric('BackfillEnqueued', published)
+    put_metric('BackfillRemaining', remaining)
+
+    if not LEDGER.put_document(BACKFILL_DOCUMENT, checkpoint, version):
+        # Publishing twice is harmless, the replications are only started once
+        logger.warning('The backfill checkpoint was changed by another invocation, not saving it')
+    return dict(checkpoint, enqueued=published, remaining=remaining)
+
+def start_backfill(since, until=None):
+    """Returns the checkpoint of a new backfill
+
+    Arguments:
+        since {str} -- ISO 8601 time of the first snapshot to replicate
+        until {str} -- ISO 8601 time after the last snapshot, default now
+
+    Returns:
+        dict -- checkpoint
+    """
+    now = datetime.now(timezone.utc).isoformat()
+    checkpoint = {
+        'since'       : parse_time(since).isoformat(),
+        'until'       : parse_time(until or now).isoformat(),
+        'cursor'      : None,
+        'enqueued'    : 0,
+        'started_at'  : now,
+        'finished_at' : None
+    }
+    logger.info('Starting backfill of the snapshots from %s until %s', checkpoint['since'], checkpoint['until'])
+    return checkpoint
+
+def parse_time(value):
+    """Parses an ISO 8601 time like datetime.isoformat returns it, UTC if it has no timezone"""
+    # python 3.6 only parses timezones without a colon
+    value = re.sub(r'([+-]\d\d):(\d\d)$', r'\1\2', value.replace('Z', '+0000'))
+    for time_format in ('%Y-%m-%dT%H:%M:%S.%f%z', '%Y-%m-%dT%H:%M:%S%z', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            parsed = datetime.strptime(value, time_format)
+        except ValueError:
+            continue
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+    raise ValueError('Not an ISO 8601 time: {}'.format(value))
+
+def cursor_of(snapshot):
+    """Returns the position of a snapshot in the order snapshots are backfilled
+
+    The create time is formatted with a fixed width in UTC, so positions can
+    be compared as they are stored in the checkpoint.
+    """
+    return [
+        snapshot['create_time'].astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+        snapshot['identifier']
+    ]
+
+def missing_snapshots(checkpoint):
+    """Returns the snapshots of a backfill that are not yet replicated everywhere
+
+    The source snapshots are indexed by the key their copies share, and the
+    replicated snapshots of every destination are looked up in that index.
+    Snapshots the ledger marks as done are not missing either, retention may
+    have deleted their copies.
+
+    Arguments:
+        checkpoint {dict} -- checkpoint of the backfill
+
+    Returns:
+        list -- dicts with kind, identifier, arn and create_time, oldest first
+    """
+    since, until = parse_time(checkpoint['since']), parse_time(checkpoint['until'])
+    cursor = checkpoint.get('cursor')
+    sources = {}
+    for region in SOURCE_REGIONS:
+        for kind, identifier, _, snapshot in iter_rds_snapshots(RDS[region], 'automated'):
+            create_time = snapshot['SnapshotCreateTime']
+            if not since <= create_time < until or not re.search(PATTERN, identifier):
+                continue
+            source = {
+                'kind'        : kind,
+                'identifier'  : identifier,
+                'arn'         : snapshot.get('DBSnapshotArn') or snapshot.get('DBClusterSnapshotArn'),
+                'create_time' : create_time
+            }
+            if cursor and cursor_of(source) <= cursor:
+                continue
+            sources[replica_key(kind, replica_name(identifier, region, SRC_REGION))] = source
+    logger.info('%s snapshots of the backfill left to check', len(sources))
+
+    prefix = replication_prefix(SRC_ACCOUNT)
+    def replicated(destination):
+        keys = set()
+        for kind, identifier, _, _ in iter_rds_snapshots(DST_RDS[destination_key(destination)], 'manual'):
+            if identifier.startswith(prefix):
+                key = replica_key(kind, identifier[len(prefix):])
+                if key in sources:
+                    keys.add(key)
+        return keys
+    replicated_everywhere = None
+    for keys in run_concurrently(replicated, DESTINATIONS, SCAN_WORKERS):
+        replicated_everywhere = keys if replicated_everywhere is None else replicated_everywhere & keys
+    for key in replicated_everywhere or ():
+        del sources[key]
+
+    missing = sorted(sources.values(), key=cursor_of)
+    done = run_concurrently(
+        lambda source: (LEDGER.get(source['arn']) or {}).get('state') == LEDGER_DONE,
+        missing,
+        SCAN_WORKERS
+    )
+    logger.info('%s snapshots of the backfill are replicated according to the ledger', done.count(True))
+    return [source for source, replicated in zip(missing, done) if not replicated]
+
+def wave_size():
+    """Returns how many snapshots the next wave may publish
+
+    Replications still waiting for admission by src_schedule_copy count
+    against WAVE_SIZE, so waves only follow once the copies have caught up.
+    """
+    waiting = sum(entry.get('weight', 1) for entry in LEDGER.list_documents(COPY_QUEUE_WAITING).values())
+    logger.info('%s snapshots are waiting for admission', waiting)
+    return max(0, WAVE_SIZE - waiting)
+
+def build_event(snapshots):
+    """Builds an event looking like an 'Automated snapshot created' event
+
+    Arguments:
+        snapshots {list} -- snapshots of the same kind
+
+    Returns:
+        dict -- RDS event message, listing all snapshots in batch mode
+    """
+    event = {
+        'Event Message' : 'Automated snapshot created',
+        'Event Source'  : EVENT_SOURCES[snapshots[0]['kind']]
+    }
+    if len(snapshots) == 1:
+        event['Source ID']  = snapshots[0]['identifier']
+        event['Source ARN'] = snapshots[0]['arn']
+    else:
+        event['Source IDs']  = [snapshot['identifier'] for snapshot in snapshots]
+        event['Source ARNs'] = [snapshot['arn'] for snapshot in snapshots]
+    return event
+
+def publish_wave(wave):
+    """Publishes the events of a wave, in order
+
+    Arguments:
+        wave {list} -- snapshots to publish, oldest first
+
+    Returns:
+        int -- how many snapshots from the start of wave have been published
+    """
+    # Every event lists snapshots of a single kind
+    events = []
+    for snapshot in wave:
+        if events and len(events[-1]) < BATCH_SIZE and events[-1][0]['kind'] == snapshot['kind']:
+            events[-1].append(snapshot)
+        else:
+            events.append([snapshot])
+    published = 0
+    for entries in chunks(events, PUBLISH_BATCH_SIZE):
+        successful = publish_events(entries)
+        for index, snapshots in enumerate(entries):
+            # The cursor can only move past events that were published in order
+            if index not in successful:
+                logger.error('Could not publish event for %s', [snapshot['identifier'] for snapshot in snapshots])
+                return published
+            published += len(snapshots)
+    return published
+
+def publish_events(events):
+    """Publishes up to 10 events, with a single publish_batch call if possible
+
+    Arguments:
+        events {list} -- snapshot lists, one per event
+
+    Returns:
+        set -- indexes of the events that have been published
+    """
+    logger.info('Publishing %s backfill events to %s', len(events), SNS_TOPIC_ARN)
+    if PUBLISH_BATCH_SIZE > 1 and hasattr(SNS, 'publish_batch'):
+        try:
+            response = SNS.publish_batch(
+                TopicArn                   = SNS_TOPIC_ARN,
+                PublishBatchRequestEntries = [
+                    {
+                        'Id'      : str(index),
+                        'Message' : json.dumps(build_event(snapshots))
+                    }
+                    for index, snapshots in enumerate(events)
+                ]
+            )
+        except Exception as e:
+            logger.error('Exception: %s', e)
+            return set()
+        return set(int(entry['Id']) for entry in response.get('Successful', []))
+    published = set()
+    for index, snapshots in enumerate(events):
+        try:
+            SNS.publish(
+                TopicArn = SNS_TOPIC_ARN,
+                Message  = json.dumps(build_event(snapshots))
+            )
+        except Exception as e:
+            logger.error('Exception: %s', e)
+            break
+        published.add(index)
+    return published
@@ -7,79 +7,275 @@ Inspired by https://github.com/awslabs/rds-snapshot-tool
 '''
 
 # src_backup_event.py
-# This lambda function looks at an RDS backup event. If the event is a completed
-# Snapshot or Cluster snapshot, invoke step function
+# This lambda function looks at the RDS backup events of an SNS or SQS delivery.
+# If an event is a completed Snapshot or Cluster snapshot, invoke step function.
+# Event messages listing several snapshots invoke the batch step function
+# instead, every other snapshot of a delivery gets an execution of its own.
+# Executions are named after the snapshot ARNs and snapshots are claimed in the
+# replication ledger first, so duplicate events do not replicate a snapshot
+# twice.
+# Snapshots are described in the region of the 'Source ARN' of the event, or in
+# REGION if it has none.
+# Every execution starts a trace of its replication, see trace_replication.
 
 import json
-import logging
 import os
 import re
 
-import boto3
-
 from common import *
+from ledger import *
+
+LOGLEVEL                = os.getenv('LOGLEVEL', 'ERROR').strip()
+REGION                  = os.getenv('REGION').strip()
+STATE_MACHINE_ARN       = os.getenv('STATE_MACHINE_ARN').strip()
+PATTERN                 = os.getenv('PATTERN').strip()
+# Snapshots of one event are replicated by a single execution of the batch
+# step function, BATCH_SIZE snapshots per lambda invocation
+BATCH_STATE_MACHINE_ARN = os.getenv('BATCH_STATE_MACHINE_ARN', '').strip()
+BATCH_SIZE              = int(os.getenv('BATCH_SIZE', '10').strip())
+# Snapshot identifiers looked up per describe call
+DESCRIBE_FILTER_SIZE    = int(os.getenv('DESCRIBE_FILTER_SIZE', '50').strip())
+# A replication which has not finished after this many hours is started again
+LEDGER_STALE_HOURS      = int(os.getenv('LEDGER_STALE_HOURS', '72').strip())
 
-LOGLEVEL          = os.getenv('LOGLEVEL', 'ERROR').strip()
-REGION            = os.getenv('REGION').strip()
-STATE_MACHINE_ARN = os.getenv('STATE_MACHINE_ARN').strip()
-PATTERN           = os.getenv('PATTERN').strip()
+logger = get_logger(LOGLEVEL)
 
-logger = logging.getLogger()
-logger.setLevel(LOGLEVEL.upper())
+LEDGER = get_ledger(os.getenv('LEDGER', '').strip())
 
-RDS = boto3.client('rds', region_name=REGION)
-SNS = boto3.client('sns', region_name=REGION)
-SFN = boto3.client('stepfunctions', region_name=REGION)
+RDS = dict(
+    (region, LazyClient('rds', region_name=region))
+    for region in get_source_regions(REGION)
+)
+SFN = LazyClient('stepfunctions', region_name=REGION)
 
+@instrument_handler
 def lambda_handler(event, context):
     """Main method
-    
+
+    Handles every record of an SNS or SQS delivery. The ARNs of all snapshots
+    of the delivery are described together, DESCRIBE_FILTER_SIZE per call,
+    and their descriptors passed on to the step function.
+    Records of an SQS delivery which could not be handled are reported as
+    batchItemFailures, so only they are retried. For SNS the invocation fails
+    and is retried, which is safe as replications are only started once.
+
     Arguments:
         event {dict} -- Lambda event object
         context {obj} -- Lambda context object
+
+    Returns:
+        dict -- batchItemFailures of an SQS delivery
     """
-    logger.debug('event: {}'.format(event))
-    msg = json.loads(event['Records'][0]['Sns']['Message'])
-    logger.info('Parsing message, type: {}'.format(msg['Event Source']))
-    if msg['Event Source'] == 'db-snapshot' or msg['Event Source'] == 'db-cluster-snapshot':
-      if msg['Event Message'] == 'Automated snapshot created':
-        logger.info('New DB Snapshot created: {}'.format(msg['Source ID']))
-        if re.search(PATTERN, msg['Source ID']):
-            # Aurora cluster snapshots and RDS snapshots use two different sets
-            # of API calls
-            if 'cluster' in msg['Event Source']:
-                try:
-                    rds_response = RDS.describe_db_cluster_snapshots(
-                        DBClusterSnapshotIdentifier = msg['Source ID']
-                    )
-                    arn = rds_response['DBClusterSnapshots'][0]['DBClusterSnapshotArn']
-                except Exception as e:
-                    log_message = 'Encountered Error: {}'.format(e)
-                    logger.error(log_message)
-                    raise SnapshotSharingException(log_message)
-            else:
+    logger.debug('event: %s', summarize(event))
+    failed = set()
+    snapshots = []
+    for index, record in enumerate(event['Records']):
+        record_id = record_identifier(record)
+        try:
+            msg = parse_message(record)
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error('Could not parse record %s: %s', record_id, e)
+            failed.add(record_id)
+            continue
+        logger.info('Parsing message, type: %s', msg.get('Event Source'))
+        for source_id, region in snapshot_ids(msg):
+            logger.info('New DB Snapshot created: %s in %s', source_id, region)
+            if re.search(PATTERN, source_id):
+                snapshots.append((record_id, index, msg, source_id, region))
+
+    descriptors = get_snapshot_descriptors(
+        [(region, source_id) for _, _, msg, source_id, region in snapshots if 'cluster' not in msg['Event Source']],
+        [(region, source_id) for _, _, msg, source_id, region in snapshots if 'cluster' in msg['Event Source']]
+    )
+    # The return events of every message, snapshots announced twice are only
+    # replicated with the first message
+    messages = {}
+    record_ids = {}
+    for record_id, index, msg, source_id, region in snapshots:
+        descriptor = descriptors.get(('cluster' in msg['Event Source'], region, source_id))
+        if not descriptor:
+            logger.error('Could not find DB snapshot %s', source_id)
+            failed.add(record_id)
+            continue
+        if descriptor.arn not in record_ids:
+            messages.setdefault(index, []).append(get_return_event(msg, source_id, descriptor))
+        record_ids.setdefault(descriptor.arn, set()).add(record_id)
+    for arn in start_replication([messages[index] for index in sorted(messages)]):
+        failed.update(record_ids[arn])
+
+    if event['Records'] and event['Records'][0].get('eventSource') == 'aws:sqs':
+        return {'batchItemFailures': [{'itemIdentifier': record_id} for record_id in sorted(failed)]}
+    if failed:
+        log_message = 'Could not handle {} of {} records'.format(len(failed), len(event['Records']))
+        logger.error(log_message)
+        raise SnapshotSharingException(log_message)
+
+def record_identifier(record):
+    """Returns the message id of an SNS or SQS record"""
+    if 'Sns' in record:
+        return record['Sns'].get('MessageId')
+    return record.get('messageId')
+
+def parse_message(record):
+    """Returns the RDS event message of an SNS or SQS record
+
+    SQS messages contain the SNS notification, unless raw message delivery
+    is enabled for the subscription.
+
+    Arguments:
+        record {dict} -- SNS or SQS record
+
+    Returns:
+        dict -- RDS event message
+    """
+    if 'Sns' in record:
+        return json.loads(record['Sns']['Message'])
+    body = json.loads(record['body'])
+    if body.get('Type') == 'Notification' and 'Message' in body:
+        return json.loads(body['Message'])
+    return body
+
+def snapshot_ids(msg):
+    """Returns the identifiers and regions of the snapshots an RDS event announces
+
+    Arguments:
+        msg {dict} -- RDS event message
+
+    Returns:
+        list -- (snapshot identifier, region) tuples, empty for other events
+    """
+    if msg.get('Event Source') not in ('db-snapshot', 'db-cluster-snapshot'):
+        return []
+    if msg.get('Event Message') != 'Automated snapshot created':
+        return []
+    # src_check_aurora_backups emits several snapshots per event in batch mode
+    if 'Source IDs' in msg:
+        identifiers = msg['Source IDs']
+        arns = msg.get('Source ARNs') or [None] * len(identifiers)
+    else:
+        identifiers = [msg['Source ID']]
+        arns = [msg.get('Source ARN')]
+    return [(identifier, region_of(arn) or REGION) for identifier, arn in zip(identifiers, arns)]
+
+def get_snapshot_descriptors(db_snapshot_ids, cluster_snapshot_ids):
+    """Describes snapshots in their regions, DESCRIBE_FILTER_SIZE per describe call
+
+    Arguments:
+        db_snapshot_ids {list} -- (region, DB snapshot identifier) tuples
+        cluster_snapshot_ids {list} -- (region, DB cluster snapshot identifier) tuples
+
+    Returns:
+        dict -- SnapshotDescriptor by (cluster, region, identifier), missing snapshots are left out
+    """
+    # Aurora cluster snapshots and RDS snapshots use two different sets
+    # of API calls
+    lookups = (
+        (False, db_snapshot_ids, 'describe_db_snapshots', 'DBSnapshots', 'db-snapshot-id'),
+        (True, cluster_snapshot_ids, 'describe_db_cluster_snapshots', 'DBClusterSnapshots', 'db-cluster-snapshot-id'),
+    )
+    descriptors = {}
+    for cluster, region_identifiers, method, result_key, filter_name in lookups:
+        by_region = {}
+        for region, identifier in region_identifiers:
+            by_region.setdefault(region, set()).add(identifier)
+        for region, identifiers in sorted(by_region.items()):
+            rds = RDS.get(region) or LazyClient('rds', region_name=region)
+            for chunk in chunks(sorted(identifiers), DESCRIBE_FILTER_SIZE):
                 try:
-                    rds_response = RDS.describe_db_snapshots(
-                        DBSnapshotIdentifier = msg['Source ID']
-                    )
-                    arn = rds_response['DBSnapshots'][0]['DBSnapshotArn']
+                    for snapshot in paginate(getattr(rds, method), result_key, Filters=[{'Name': filter_name, 'Values': chunk}]):
+                        descriptor = snapshot_descriptor(snapshot)
+                        descriptors[(cluster, region, descriptor.identifier)] = descriptor
                 except Exception as e:
-                    log_message = 'Encountered Error: {}'.format(e)
-                    logger.error(log_message)
-                    raise SnapshotSharingException(log_message)
-            return_event = {
-                'SourceIdentifier': msg['Source ID'],
-                'SourceType'      : msg['Event Source'],
-                'Message'         : msg['Event Message'],
-                'SourceArn'       : arn
-            }
-            logger.info('Snapshot matches pattern. Trying to invoke Step Function {}.'.format(STATE_MACHINE_ARN))
-            logger.debug('Step function to be invoked with input: {}'.format(return_event))
-            try:
-                response = SFN.start_execution(
-                    stateMachineArn = STATE_MACHINE_ARN,
-                    input           = json.dumps(return_event)
-                )
-                logger.info('Step Function response: {}'.format(response))
-            except Exception as e:
-                logger.error('Encountered Error: {}'.format(e))
+                    logger.error('Encountered Error in %s: %s', region, e)
+    return descriptors
+
+def get_return_event(msg, source_id, descriptor):
+    """Builds the step function input for a snapshot
+
+    Arguments:
+        msg {dict} -- RDS event message
+        source_id {str} -- snapshot identifier
+        descriptor {SnapshotDescriptor} -- descriptor of the snapshot
+
+    Returns:
+        dict -- step function input
+    """
+    return {
+        'SourceIdentifier': source_id,
+        'SourceType'      : msg['Event Source'],
+        'Message'         : msg['Event Message'],
+        'SourceArn'       : descriptor.arn,
+        'Snapshot'        : descriptor._asdict()
+    }
+
+def start_replication(messages):
+    """Starts the replications of the snapshots of every event message
+
+    Snapshots which are already replicated or being replicated are skipped.
+    The snapshots of a message listing several of them are replicated by one
+    execution of the batch step function, every other snapshot by an
+    execution of its own, so unrelated snapshots of a delivery do not wait
+    for each other.
+
+    Arguments:
+        messages {list} -- step function inputs of the matching snapshots, one list per message
+
+    Returns:
+        list -- ARNs of the snapshots whose replication could not be started
+    """
+    failed = []
+    for return_events in messages:
+        claimed = []
+        attempts = {}
+        for return_event in return_events:
+            attempts[return_event['SourceArn']] = 1
+            if LEDGER:
+                entry = LEDGER.claim(return_event['SourceArn'], LEDGER_STALE_HOURS * 3600)
+                if not entry:
+                    logger.info('Snapshot %s is already replicated or being replicated', return_event['SourceIdentifier'])
+                    continue
+                attempts[return_event['SourceArn']] = entry['attempt']
+            claimed.append(return_event)
+        if BATCH_STATE_MACHINE_ARN and len(claimed) > 1:
+            batches = [trace_replication({'Snapshots': batch}) for batch in chunks(claimed, BATCH_SIZE)]
+            if not start_execution(BATCH_STATE_MACHINE_ARN, {'Batches': batches}, claimed, attempts):
+                failed.extend(return_event['SourceArn'] for return_event in claimed)
+            continue
+        for return_event in claimed:
+            if not start_execution(STATE_MACHINE_ARN, trace_replication(return_event), [return_event], attempts):
+                failed.append(return_event['SourceArn'])
+    return failed
+
+def start_execution(state_machine_arn, execution_input, return_events, attempts):
+    """Starts a step function execution named after its snapshots
+
+    Arguments:
+        state_machine_arn {str} -- ARN of the step function
+        execution_input {dict} -- input of the execution
+        return_events {list} -- step function inputs of the snapshots it replicates
+        attempts {dict} -- replication attempt by snapshot ARN
+
+    Returns:
+        boolean -- True if the execution has been started, else False
+    """
+    source_arns = [return_event['SourceArn'] for return_event in return_events]
+    name = execution_name(source_arns, max(attempts[source_arn] for source_arn in source_arns))
+    logger.info('Snapshot matches pattern. Trying to invoke Step Function %s as %s.', state_machine_arn, name)
+    logger.debug('Step function to be invoked with input: %s', summarize(execution_input))
+    try:
+        response = SFN.start_execution(
+            stateMachineArn = state_machine_arn,
+            name            = name,
+            input           = json.dumps(execution_input)
+        )
+        logger.info('Step Function response: %s', summarize(response))
+        return True
+    except Exception as e:
+        if error_code(e) == 'ExecutionAlreadyExists':
+            logger.info('Execution %s has already been started', name)
+            return True
+        logger.error('Encountered Error: %s', e)
+        if LEDGER:
+            for source_arn in source_arns:
+                LEDGER.release(source_arn)
+        return False
@@ -11,34 +11,70 @@ Inspired by https://github.com/awslabs/rds-snapshot-tool
 # So we have to look through snapshots with a script periodically, emitting an
 # event for all new ones.
 #
-# 1. search for DB clusters that match PATTERN
-# 2. search for last BACKUP_LAST_N snapshots for those DB clusters without tag
-#    'rds-replication-replicated'
-# 3. emit an SNS event for each one
-# 4. if response 200: set tag 'rds-replication-replicated' on snapshot
+# 1. page through DB clusters that match PATTERN in REGION and the
+#    SOURCE_REGIONS, all regions in parallel. A region that cannot be scanned
+#    is logged and left out, the others are replicated anyway
+# 2. for up to SCAN_WORKERS clusters of all regions in parallel, search for last BACKUP_LAST_N
+#    snapshots newer than the high-water mark of the cluster which the
+#    replication ledger does not know, or, without a ledger entry, without tag
+#    'rds-replication-replicated', using the TagList of the describe response
+# 3. emit an SNS event for each one, or for each BATCH_SIZE of them in batch
+#    mode, up to PUBLISH_BATCH_SIZE events per publish call
+# 4. if the event has been published: set tag 'rds-replication-replicated' on
+#    snapshot
+# 5. advance the high-water mark of every cluster to its newest snapshot that
+#    was replicated or published, but not past one that could not be published
+#
+# The high-water marks are a document in the ledger. RDS cannot filter
+# snapshots by create time, so a run still describes all automated snapshots
+# of every cluster, but only looks up the ones created since the last run in
+# the ledger and their tags.
+# Replications of snapshots behind the mark which failed are not retried,
+# they are reported by src_audit_replication and replicated by a backfill, or
+# by invoking this function with {"full_scan": true}, which ignores the marks.
 
 import json
-import logging
 import os
 import re
 
+from datetime import timezone
 from operator import itemgetter
 
-import boto3
+from common import *
+from ledger import *
 
 LOGLEVEL      = os.getenv('LOGLEVEL', 'ERROR').strip()
 REGION        = os.getenv('REGION').strip()
 SNS_TOPIC_ARN = os.getenv('SNS_TOPIC_ARN').strip()
 PATTERN       = os.getenv('PATTERN').strip()
 BACKUP_LAST_N = int(os.getenv('BACKUP_LAST_N').strip())
+SCAN_WORKERS  = int(os.getenv('SCAN_WORKERS', '8').strip())
+# SNS accepts at most 10 entries per publish_batch call, 1 publishes every
+# event on its own
+PUBLISH_BATCH_SIZE = min(int(os.getenv('PUBLISH_BATCH_SIZE', '10').strip()), 10)
+# Snapshots per event, more than 1 replicates them in batch mode
+BATCH_SIZE = int(os.getenv('BATCH_SIZE', '1').strip())
+# A replication which has not finished after this many hours is started again
+LEDGER_STALE_HOURS = int(os.getenv('LEDGER_STALE_HOURS', '72').strip())
+
+REPLICATED_TAG = 'rds-replication-replicated'
+
+# Key of the high-water marks in the ledger
+HIGH_WATER_MARKS = 'aurora:high-water-marks'
 
+logger = get_logger(LOGLEVEL)
 
-logger = logging.getLogger()
-logger.setLevel(LOGLEVEL.upper())
+LEDGER = get_ledger(os.getenv('LEDGER', '').strip())
 
-SNS = boto3.client('sns', region_name=REGION)
-RDS = boto3.client('rds', region_name=REGION)
+REGIONS = get_source_regions(REGION)
 
+SNS = LazyClient('sns', region_name=REGION)
+RDS = dict(
+    (region, LazyClient('rds', region_name=region))
+    for region in REGIONS
+)
+
+@instrument_handler
 def lambda_handler(event, context):
     """Main method
     
@@ -46,118 +82,329 @@ def lambda_handler(event, context):
         event {dict} -- Lambda event object
         context {obj} -- Lambda context object
     """
-    logger.debug('event: {}'.format(event))
+    logger.debug('event: %s', summarize(event))
+
+    # Get all clusters which match PATTERN, as (region, cluster) tuples
+    clusters = []
+    failed_regions = []
+    for region, region_clusters in zip(REGIONS, run_concurrently(get_region_clusters, REGIONS, len(REGIONS))):
+        if region_clusters is None:
+            failed_regions.append(region)
+        else:
+            clusters.extend((region, cluster) for cluster in region_clusters)
+
+    marks = {}
+    if LEDGER and not event.get('full_scan'):
+        marks = LEDGER.get_document(HIGH_WATER_MARKS)[0]
+
+    # Clusters are independent of each other, so we check them in parallel
+    # get BACKUP_LAST_N snapshots for cluster without replication tag
+    results = run_concurrently(
+        lambda region_cluster: get_snapshots(
+            region_cluster[1],
+            marks.get(cluster_key(*region_cluster)),
+            region_cluster[0]
+        ),
+        clusters,
+        SCAN_WORKERS
+    )
+    snapshots = []
+    for cluster_snapshots, _ in results:
+        snapshots.extend(cluster_snapshots)
+    logger.info('%s snapshots to be replicated', len(snapshots))
+
+    # Every event lists up to BATCH_SIZE snapshots, which are then replicated
+    # by a single step function execution
+    events = chunks(snapshots, BATCH_SIZE)
+    if PUBLISH_BATCH_SIZE > 1 and hasattr(SNS, 'publish_batch'):
+        submitted = []
+        for batch in chunks(events, PUBLISH_BATCH_SIZE):
+            submitted.extend(submit_events(batch))
+    else:
+        submitted = [event_snapshots for event_snapshots in events if submit_event(event_snapshots)]
+    submitted_snapshots = [snapshot for event_snapshots in submitted for snapshot in event_snapshots]
+    run_concurrently(tag_snapshot, submitted_snapshots, SCAN_WORKERS)
+
+    if LEDGER:
+        advanced = advance_marks(clusters, results, submitted_snapshots)
+        # Marks of clusters which were not seen are only dropped if every
+        # region could be scanned
+        current = None if failed_regions else [cluster_key(*region_cluster) for region_cluster in clusters]
+        LEDGER.update_document(HIGH_WATER_MARKS, lambda marks: merge_marks(marks, advanced, current))
+
+    if failed_regions:
+        log_message = 'Could not scan regions {}'.format(', '.join(failed_regions))
+        logger.error(log_message)
+        raise SnapshotSharingException(log_message)
+
+def get_region_clusters(region):
+    """Returns the clusters of a region which match PATTERN, None if it fails
+
+    Arguments:
+        region {str} -- region to scan
+
+    Returns:
+        list -- Matching cluster identifiers, None if the region could not be scanned
+    """
+    try:
+        return get_clusters(region)
+    except Exception as e:
+        logger.error('Exception while getting clusters in %s: %s', region, e)
+        put_metric('RegionScanErrors', 1)
+        return None
 
-    # Get all clusters which match PATTERN
-    clusters = get_clusters()
+def cluster_key(region, cluster):
+    """Returns the key of the high-water mark of a cluster
 
-    for cluster in clusters:
-        # get BACKUP_LAST_N snapshots for cluster without replication tag
-        snapshots = get_snapshots(cluster)
-        for snapshot in snapshots:
-            event_submitted = submit_event(snapshot)
-            if event_submitted:
-                tag_snapshot(snapshot)
+    Clusters of REGION are keyed by their identifier, those of other regions
+    by region and identifier.
+    """
+    if region == REGION:
+        return cluster
+    return '{}:{}'.format(region, cluster)
 
-def get_clusters():
-    """Returns cluster identifiers whose pattern matches PATTERn
+def get_clusters(region=REGION):
+    """Returns cluster identifiers whose pattern matches PATTERN
     
+    Arguments:
+        region {str} -- region of the clusters
+
     Returns:
         list -- Matching cluster identifiers
     """
-    logger.info('Getting Clusters')
+    logger.info('Getting Clusters in %s', region)
     clusters = []
-    response = RDS.describe_db_clusters()
-    if not response['DBClusters']:
-        logger.info('No DB Clusters found')
-        return
-    for cluster in response['DBClusters']:
-        logger.debug('Checking if {} matches PATTERN'.format(cluster['DBClusterIdentifier']))
+    for cluster in paginate(RDS[region].describe_db_clusters, 'DBClusters'):
+        logger.debug('Checking if %s matches PATTERN', cluster['DBClusterIdentifier'])
         if re.search(PATTERN, cluster['DBClusterIdentifier']):
             clusters.append(cluster['DBClusterIdentifier'])
-        logger.info('Clusters which match the pattern: {}'.format(clusters))
+    if not clusters:
+        logger.info('No matching DB Clusters found')
+    logger.info('Clusters which match the pattern: %s', summarize(clusters))
     return clusters
 
-def get_snapshots(cluster):
-    """returns a list of the BACKUP_LAST_N snapshots for cluster
+def get_snapshots(cluster, mark=None, region=REGION):
+    """returns a list of the BACKUP_LAST_N snapshots for cluster newer than mark
+
+    All automated snapshots of the cluster are listed, as RDS has no filter
+    on the create time. Only those newer than mark are checked further.
     
     Arguments:
         cluster {str} -- DBClusterIdentifier
+        mark {str} -- high-water mark of the cluster, None to examine all
+        region {str} -- region of the cluster
     
     Returns:
-        list -- Matching snapshot objects
+        tuple -- Matching snapshot objects, create times of all examined snapshots
     """
-    logger.info('Getting snapshots for cluster {}'.format(cluster))
+    logger.info('Getting snapshots for cluster %s in %s newer than %s', cluster, region, mark)
     snapshots = []
-    # get all automated snapshots. manual snapshots are not replicated by this
-    # if you want to replicate manual snapshots, keep in mind they already emit
-    # an event, so you want to edit src_backup_event.py
-    response = RDS.describe_db_cluster_snapshots(
-        DBClusterIdentifier = cluster,
-        SnapshotType        = 'automated'
-    )
     try:
-        if not response['DBClusterSnapshots']:
-            logger.info('No Snapshots found for cluster {}'.format(cluster))
-            return snapshots
+        # get all automated snapshots. manual snapshots are not replicated by this
+        # if you want to replicate manual snapshots, keep in mind they already emit
+        # an event, so you want to edit src_backup_event.py
+        snapshots = list(paginate(
+            RDS[region].describe_db_cluster_snapshots,
+            'DBClusterSnapshots',
+            DBClusterIdentifier = cluster,
+            SnapshotType        = 'automated'
+        ))
+        if not snapshots:
+            logger.info('No Snapshots found for cluster %s', cluster)
+            return snapshots, []
         # sort list so its easier to get the last BACKUP_LAST_N
         snapshots = sorted(
-            response['DBClusterSnapshots'],
+            snapshots,
             key     = itemgetter('SnapshotCreateTime'),
             reverse = True
         )
         # return the latest BACKUP_LAST_N snapshots without tag rds-replication-replicated
+        examined = [
+            snapshot for snapshot in snapshots[:BACKUP_LAST_N]
+            if not mark or mark_of(snapshot['SnapshotCreateTime']) > mark
+        ]
         to_be_replicated = []
-        for snapshot in snapshots[:BACKUP_LAST_N]:
-            logger.debug('Checking snapshot {} for tags'.format(snapshot['DBClusterSnapshotArn']))
-            tag_response = RDS.list_tags_for_resource(
-                ResourceName = snapshot['DBClusterSnapshotArn']
-            )
-            logger.debug('tag_response for {}: {}'.format(snapshot['DBClusterSnapshotIdentifier'], tag_response))
-            replication_flag = True
-            if 'TagList' in tag_response:
-                for tag in tag_response['TagList']:
-                    if tag['Key'] == 'rds-replication-replicated':
-                        logger.debug('Snapshot {} already tagged'.format(snapshot['DBClusterSnapshotIdentifier']))
-                        replication_flag = False
-            if replication_flag:
-                logger.debug('Adding {} to be replicated'.format(snapshot['DBClusterSnapshotIdentifier']))
+        for snapshot in examined:
+            if is_replicated(snapshot):
+                logger.debug('Snapshot %s already tagged', snapshot['DBClusterSnapshotIdentifier'])
+            else:
+                logger.debug('Adding %s to be replicated', snapshot['DBClusterSnapshotIdentifier'])
                 to_be_replicated.append(snapshot)
-        logger.info('Snapshots to be replicated for cluster {}: {}'.format(cluster, to_be_replicated))
-        return to_be_replicated
+        logger.info(
+            'Snapshots to be replicated for cluster %s: %s',
+            cluster,
+            summarize([snapshot['DBClusterSnapshotIdentifier'] for snapshot in to_be_replicated])
+        )
+        return to_be_replicated, [snapshot['SnapshotCreateTime'] for snapshot in examined]
     except Exception as e:
-        logger.error('Exception while getting snapshots for cluster {}: {}'.format(cluster, e))
-        return []
+        logger.error('Exception while getting snapshots for cluster %s: %s', cluster, e)
+        return [], []
+
+def mark_of(create_time):
+    """Returns a create time as high-water mark
+
+    Marks are formatted with a fixed width in UTC, so they can be compared as
+    they are stored.
+    """
+    return create_time.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+def advance_marks(clusters, results, submitted):
+    """Computes how far the high-water mark of every cluster may advance
+
+    A mark advances to the newest examined snapshot which is replicated or was
+    published, but stays behind the oldest snapshot that could not be
+    published, so that the next run examines it again.
+
+    Arguments:
+        clusters {list} -- (region, cluster identifier) tuples
+        results {list} -- get_snapshots results, in the order of clusters
+        submitted {list} -- snapshot objects whose event was published
+
+    Returns:
+        dict -- new marks by cluster key, clusters without a new mark are left out
+    """
+    published = set(snapshot['DBClusterSnapshotArn'] for snapshot in submitted)
+    marks = {}
+    for (region, cluster), (to_be_replicated, examined) in zip(clusters, results):
+        unpublished = [
+            snapshot['SnapshotCreateTime'] for snapshot in to_be_replicated
+            if snapshot['DBClusterSnapshotArn'] not in published
+        ]
+        handled = [create_time for create_time in examined if not unpublished or create_time < min(unpublished)]
+        if handled:
+            marks[cluster_key(region, cluster)] = mark_of(max(handled))
+    return marks
 
-def submit_event(snapshot):
+def merge_marks(marks, advanced, clusters):
+    """Merges new high-water marks into the stored ones, in place
+
+    Marks only move forward, and marks of clusters which no longer match
+    PATTERN are dropped.
+
+    Arguments:
+        marks {dict} -- stored marks by cluster key
+        advanced {dict} -- new marks by cluster key
+        clusters {list} -- cluster keys of this run, None to keep all marks
+    """
+    if clusters is not None:
+        current = set(clusters)
+        for cluster in list(marks):
+            if cluster not in current:
+                del marks[cluster]
+    for cluster, mark in advanced.items():
+        if mark > marks.get(cluster, ''):
+            marks[cluster] = mark
+
+def is_replicated(snapshot):
+    """Checks whether a snapshot is replicated or being replicated
+
+    The replication ledger knows every snapshot claimed since it was set up.
+    Older snapshots are checked for the tag rds-replication-replicated.
+    Describe responses include the TagList of every snapshot, so tags are only
+    fetched separately if it is missing.
+
+    Arguments:
+        snapshot {dict} -- Snapshot object
+
+    Returns:
+        boolean -- True if the snapshot is replicated or tagged, else False
+    """
+    if LEDGER:
+        entry = LEDGER.get(snapshot['DBClusterSnapshotArn'])
+        if entry:
+            return not claimable(entry, LEDGER_STALE_HOURS * 3600)
+    if 'TagList' in snapshot:
+        tags = snapshot['TagList']
+    else:
+        logger.debug('Checking snapshot %s for tags', snapshot['DBClusterSnapshotArn'])
+        tag_response = RDS[region_of(snapshot['DBClusterSnapshotArn'])].list_tags_for_resource(
+            ResourceName = snapshot['DBClusterSnapshotArn']
+        )
+        tags = tag_response.get('TagList', [])
+    return any(tag['Key'] == REPLICATED_TAG for tag in tags)
+
+def build_event(snapshots):
+    """Builds an event looking like an 'Automated Snapshot created' event
+
+    Arguments:
+        snapshots {list} -- Snapshot objects
+
+    Returns:
+        dict -- RDS event message, listing all snapshots in batch mode
+    """
+    event = {
+        'Event Message' : 'Automated snapshot created',
+        'Event Source'  : 'db-cluster-snapshot'
+    }
+    if len(snapshots) == 1:
+        event['Source ID']  = snapshots[0]['DBClusterSnapshotIdentifier']
+        event['Source ARN'] = snapshots[0]['DBClusterSnapshotArn']
+    else:
+        event['Source IDs']  = [snapshot['DBClusterSnapshotIdentifier'] for snapshot in snapshots]
+        event['Source ARNs'] = [snapshot['DBClusterSnapshotArn'] for snapshot in snapshots]
+    return event
+
+def submit_event(snapshots):
     """emits SNS event looking like an 'Automated Snapshot created' event
     
     Arguments:
-        snapshot {dict} -- Snapshot object
+        snapshots {list} -- Snapshot objects of the event
     
     Returns:
         boolean -- True if event has been submitted, else False
     """
     # 
-    logger.info('Publishing event for {} to {}'.format(snapshot['DBClusterSnapshotIdentifier'], SNS_TOPIC_ARN))
-    event = {
-        'Event Message' : 'Automated snapshot created',
-        'Event Source'  : 'db-cluster-snapshot',
-        'Source ID'     : snapshot['DBClusterSnapshotIdentifier']
-    }
-    logger.debug('Event: {}'.format(event))
+    event = build_event(snapshots)
+    logger.info('Publishing event for %s to %s', event.get('Source IDs', event.get('Source ID')), SNS_TOPIC_ARN)
+    logger.debug('Event: %s', summarize(event))
     try:
         publish_response = SNS.publish(
           TopicArn = SNS_TOPIC_ARN,
           Message  = json.dumps(event)
         )
     except Exception as e:
-        logger.error('Exception: {}'.format(e))
+        logger.error('Exception: %s', e)
         return False
     logger.info('Event published')
-    logger.debug(event)
+    logger.debug('Event: %s', summarize(event))
     return True
 
+def submit_events(events):
+    """emits up to 10 SNS events with a single publish_batch call
+
+    Arguments:
+        events {list} -- Snapshot object lists, one per event
+
+    Returns:
+        list -- Snapshot object lists whose event has been submitted
+    """
+    logger.info('Publishing %s events to %s', len(events), SNS_TOPIC_ARN)
+    entries = [
+        {
+            'Id'      : str(index),
+            'Message' : json.dumps(build_event(snapshots))
+        }
+        for index, snapshots in enumerate(events)
+    ]
+    try:
+        publish_response = SNS.publish_batch(
+            TopicArn                   = SNS_TOPIC_ARN,
+            PublishBatchRequestEntries = entries
+        )
+    except Exception as e:
+        logger.error('Exception: %s', e)
+        return []
+    for failed in publish_response.get('Failed', []):
+        logger.error(
+            'Could not publish event for %s: %s %s',
+            [snapshot['DBClusterSnapshotIdentifier'] for snapshot in events[int(failed['Id'])]],
+            failed.get('Code'),
+            failed.get('Message')
+        )
+    submitted = [events[int(successful['Id'])] for successful in publish_response.get('Successful', [])]
+    logger.info('%s events published', len(submitted))
+    return submitted
+
 def tag_snapshot(snapshot):
     """Tag replicated snapshots
     
@@ -168,17 +415,17 @@ def tag_snapshot(snapshot):
         Boolean -- True if tagging worked else False
     """
     try:
-        logger.info('Tagging snapshot {}'.format(snapshot['DBClusterSnapshotIdentifier']))
-        tagging_response = RDS.add_tags_to_resource(
+        logger.info('Tagging snapshot %s', snapshot['DBClusterSnapshotIdentifier'])
+        tagging_response = RDS[region_of(snapshot['DBClusterSnapshotArn'])].add_tags_to_resource(
             ResourceName = snapshot['DBClusterSnapshotArn'],
             Tags         = [
                 {
-                    'Key'  : 'rds-replication-replicated',
+                    'Key'  : REPLICATED_TAG,
                     'Value': 'event-generated'
                 }
             ]
         )
         return True
     except Exception as e:
-        logger.error('Exception: {}'.format(e))
+        logger.error('Exception: %s', e)
         return False
@@ -0,0 +1,218 @@
+'''
+Copyright 2019  Pinguin AG, Mattis Haase
+
+Licensed under the Apache License, Version 2.0 (the "License").
+
+Inspired by https://github.com/awslabs/rds-snapshot-tool
+'''
+
+# src_check_copy_status.py
+# This lambda function checks whether a snapshot copy made by the step function
+# is available. If it is not, it estimates from PercentProgress and the time the
+# copy started how long the step function should wait before checking again.
+#
+# The step function passes
+#   {"snapshot": "local_copy" | "dst_copy", "event": <step function state>}
+# and stores the returned status in $.copy_status. The status is only available
+# once the copies in all destination regions or accounts are, and for a batch
+# once those of all snapshots of the batch are.
+
+import os
+import time
+
+from common import *
+
+LOGLEVEL           = os.getenv('LOGLEVEL', 'ERROR').strip()
+MIN_WAIT_SECONDS   = int(os.getenv('MIN_WAIT_SECONDS', '60').strip())
+MAX_WAIT_SECONDS   = int(os.getenv('MAX_WAIT_SECONDS', '1800').strip())
+COPY_TIMEOUT_HOURS = int(os.getenv('COPY_TIMEOUT_HOURS', '72').strip())
+BATCH_WORKERS      = int(os.getenv('BATCH_WORKERS', '8').strip())
+DESTINATIONS       = get_destinations()
+
+# event keys holding the identifier and the start time of each copy
+COPIES = {
+    'local_copy': ('local_copy_snapshot_identifier', 'local_copy_started_at'),
+    'dst_copy'  : ('dst_snapshot_identifier', 'dst_copy_started_at'),
+}
+FAILED_STATUSES = ('failed', 'error', 'deleting', 'deleted')
+
+logger = get_logger(LOGLEVEL)
+
+# The intermediate copies, one per destination region
+RDS = dict(
+    (region, LazyClient('rds', region_name=region))
+    for region in destination_regions(DESTINATIONS)
+)
+
+# The destination account roles are assumed on first use and refreshed before
+# their credentials expire
+DST_RDS = dict(
+    (destination_key(destination), LazyClient('rds', region_name=destination.region, role_arn=destination.role_arn))
+    for destination in DESTINATIONS
+)
+
+@instrument_handler
+def lambda_handler(event, context):
+    """Main method
+
+    Arguments:
+        event {dict} -- Lambda event object
+        context {obj} -- Lambda context object
+
+    Returns:
+        dict -- available, status, percent_progress and wait_seconds
+    """
+    logger.debug('event: %s', summarize(event))
+    state = event['event']
+    if 'Snapshots' not in state:
+        return check_copies(event['snapshot'], state)
+
+    statuses = run_concurrently(
+        lambda snapshot_state: check_copies(event['snapshot'], snapshot_state),
+        state['Snapshots'],
+        BATCH_WORKERS
+    )
+    return combine_statuses(statuses)
+
+def combine_statuses(statuses):
+    """Combines the statuses of several copies
+
+    The step function can only move on once every copy is available, so we
+    wait for the copy that is expected to take longest.
+
+    Arguments:
+        statuses {list} -- status dicts of the copies
+
+    Returns:
+        dict -- available, status, percent_progress and wait_seconds
+    """
+    pending = [status for status in statuses if not status['available']]
+    logger.info('%s of %s copies available', len(statuses) - len(pending), len(statuses))
+    if not pending:
+        return {
+            'available'        : True,
+            'status'           : 'available',
+            'percent_progress' : 100,
+            'wait_seconds'     : 0
+        }
+    return {
+        'available'        : False,
+        'status'           : pending[0]['status'],
+        'percent_progress' : min(status['percent_progress'] for status in pending),
+        'wait_seconds'     : max(status['wait_seconds'] for status in pending)
+    }
+
+def check_copies(copy, state):
+    """Checks the copies of a single snapshot in all destination regions or accounts
+
+    Arguments:
+        copy {str} -- 'local_copy' or 'dst_copy'
+        state {dict} -- Snapshot event
+
+    Returns:
+        dict -- available, status, percent_progress and wait_seconds
+    """
+    if copy == 'local_copy':
+        clients = list(RDS.values())
+    else:
+        clients = list(DST_RDS.values())
+    if len(clients) == 1:
+        return check_copy(copy, state, clients[0])
+    return combine_statuses(run_concurrently(
+        lambda rds: check_copy(copy, state, rds),
+        clients,
+        len(clients)
+    ))
+
+def check_copy(copy, state, rds):
+    """Checks a single snapshot copy
+
+    Arguments:
+        copy {str} -- 'local_copy' or 'dst_copy'
+        state {dict} -- Snapshot event
+        rds {obj} -- RDS client of the region or account of the copy
+
+    Returns:
+        dict -- available, status, percent_progress and wait_seconds
+    """
+    identifier_key, started_key = COPIES[copy]
+    cluster = False
+    if 'cluster' in state['SourceType']:
+        cluster = True
+
+    snapshot = describe_snapshot(rds, state[identifier_key], cluster)
+    status = snapshot['Status']
+    percent_progress = snapshot.get('PercentProgress', 0)
+    logger.info('Snapshot %s is %s (%s%%)', state[identifier_key], status, percent_progress)
+    if status in FAILED_STATUSES:
+        log_message = 'Copy {} failed with status {}'.format(state[identifier_key], status)
+        logger.error(log_message)
+        raise SnapshotCopyFailedException(log_message)
+    if status == 'available':
+        return {
+            'available'        : True,
+            'status'           : status,
+            'percent_progress' : 100,
+            'wait_seconds'     : 0
+        }
+
+    elapsed = copy_elapsed_seconds(state.get(started_key), snapshot.get('SnapshotCreateTime'))
+    if elapsed > COPY_TIMEOUT_HOURS * 3600:
+        log_message = 'Copy {} did not finish within {} hours'.format(state[identifier_key], COPY_TIMEOUT_HOURS)
+        logger.error(log_message)
+        raise SnapshotCopyFailedException(log_message)
+    wait_seconds = estimate_wait_seconds(percent_progress, elapsed, MIN_WAIT_SECONDS, MAX_WAIT_SECONDS)
+    logger.info('Checking %s again in %s seconds', state[identifier_key], wait_seconds)
+    put_metric('CopyWaitSeconds', wait_seconds, 'Seconds')
+    return {
+        'available'        : False,
+        'status'           : status,
+        'percent_progress' : percent_progress,
+        'wait_seconds'     : wait_seconds
+    }
+
+def describe_snapshot(rds, identifier, cluster):
+    """Describes a single DB or DB cluster snapshot
+
+    Arguments:
+        rds {obj} -- RDS client
+        identifier {str} -- snapshot identifier
+        cluster {bool} -- True for DB cluster snapshots
+
+    Returns:
+        dict -- Snapshot object
+    """
+    try:
+        if cluster:
+            snapshots = rds.describe_db_cluster_snapshots(
+                DBClusterSnapshotIdentifier = identifier
+            )['DBClusterSnapshots']
+        else:
+            snapshots = rds.describe_db_snapshots(
+                DBSnapshotIdentifier = identifier
+            )['DBSnapshots']
+    except Exception as e:
+        if 'NotFound' in (error_code(e) or ''):
+            snapshots = []
+        else:
+            raise
+    if not snapshots:
+        logger.error('Could not find DB snapshot %s', identifier)
+        raise SnapshotNotFoundException
+    return snapshots[0]
+
+def copy_elapsed_seconds(started_at, snapshot_create_time):
+    """Returns the seconds since a copy started
+
+    Arguments:
+        started_at {int} -- epoch seconds recorded when the copy was started
+        snapshot_create_time {datetime} -- SnapshotCreateTime of the copy
+
+    Returns:
+        float -- elapsed seconds, 0 if unknown
+    """
+    if started_at:
+        return max(time.time() - started_at, 0)
+    if snapshot_create_time:
+        return max(time.time() - snapshot_create_time.timestamp(), 0)
+    return 0
@@ -7,25 +7,40 @@ Inspired by https://github.com/awslabs/rds-snapshot-tool
 '''
 
 # src_copy_snapshot.py
-# This lambda function creates a manual copy of a snapshot, for later sharing
+# This lambda function creates a manual copy of a snapshot in every destination
+# region, for later sharing. In batch mode it copies all snapshots of the batch
+# concurrently.
+# The snapshot is only described if the event does not carry its descriptor,
+# and the descriptors of the copies are passed on as "local_copies", by region.
+# The source region is taken from the ARN of the snapshot, so snapshots of
+# every source region are copied by the same function.
 
 import os
-import logging
-
-import boto3
+import time
 
 from common import *
+from ledger import *
 
 LOGLEVEL = os.getenv('LOGLEVEL', 'ERROR').strip()
-DST_REGION   = os.getenv('DST_REGION').strip()
+# The region the replication is deployed in, for events without an ARN
 SRC_REGION   = os.getenv('SRC_REGION').strip()
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', '8').strip())
+DESTINATIONS = get_destinations()
+
+logger = get_logger(LOGLEVEL)
 
-logger = logging.getLogger()
-logger.setLevel(LOGLEVEL.upper())
+LEDGER = get_ledger(os.getenv('LEDGER', '').strip())
 
-SRC_RDS = boto3.client('rds', region_name=SRC_REGION)
-DST_RDS = boto3.client('rds', region_name=DST_REGION)
+SRC_RDS = dict(
+    (region, LazyClient('rds', region_name=region))
+    for region in get_source_regions(SRC_REGION)
+)
+DST_RDS = dict(
+    (region, LazyClient('rds', region_name=region))
+    for region in destination_regions(DESTINATIONS)
+)
 
+@instrument_handler
 def lambda_handler(event, context):
     """Main method
     
@@ -33,48 +48,83 @@ def lambda_handler(event, context):
         event {dict} -- Lambda event object
         context {obj} -- Lambda context object
     """
+    return handle_batch(copy_snapshot, event, BATCH_WORKERS)
+
+def copy_snapshot(event):
+    """Copies a single snapshot to every destination region
+
+    Arguments:
+        event {dict} -- Snapshot event
+
+    Returns:
+        dict -- as event
+    """
     cluster = False
     if 'cluster' in event['SourceType']:
         cluster = True
-    logger.debug('event: {}'.format(event))
+    logger.debug('event: %s', summarize(event))
 
-    # Sanity check: does the snapshot actually exist? If not we want to fail fast
-    if cluster:
-        response = SRC_RDS.describe_db_cluster_snapshots(
-            DBClusterSnapshotIdentifier = event['SourceIdentifier']
-        )
-        snapshots = response['DBClusterSnapshots']
-    else:
-        response = SRC_RDS.describe_db_snapshots(
-            DBSnapshotIdentifier = event['SourceIdentifier']
-        )
-        snapshots = response['DBSnapshots']
-    logger.debug(response)
-    if not snapshots:
-        logger.error('Could not find DB snapshot {}'.format(event['SourceIdentifier']))
-        raise SnapshotNotFoundException
-
-    # Generating name for our local snapshot copy
-    local_copy_name = 'rds-replication-{}'.format(event['SourceIdentifier']).replace(':', '-')
-    logger.info('Copying snapshot {} locally to {}'.format(event['SourceIdentifier'], local_copy_name))
-    try:
+    source_region = region_of(event.get('SourceArn')) or SRC_REGION
+    source = descriptor_of(event)
+    if source is None:
+        # Sanity check: does the snapshot actually exist? If not we want to fail fast
+        src_rds = SRC_RDS.get(source_region) or LazyClient('rds', region_name=source_region)
         if cluster:
-            response = DST_RDS.copy_db_cluster_snapshot(
-                SourceDBClusterSnapshotIdentifier = event['SourceArn'],
-                TargetDBClusterSnapshotIdentifier = local_copy_name,
-                SourceRegion                      = SRC_REGION
+            response = src_rds.describe_db_cluster_snapshots(
+                DBClusterSnapshotIdentifier = event['SourceIdentifier']
             )
+            snapshots = response['DBClusterSnapshots']
         else:
-            response = DST_RDS.copy_db_snapshot(
-                SourceDBSnapshotIdentifier = event['SourceArn'],
-                TargetDBSnapshotIdentifier = local_copy_name,
-                SourceRegion               = SRC_REGION
+            response = src_rds.describe_db_snapshots(
+                DBSnapshotIdentifier = event['SourceIdentifier']
             )
-        logger.info('Response: {}'.format(response))
-    except Exception as e:
-        log_message = 'Copy pending: {}'.format(event['SourceIdentifier'])
-        logger.error(log_message)
-        raise SnapshotSharingException(log_message)
+            snapshots = response['DBSnapshots']
+        logger.debug('Response: %s', summarize(response))
+        if not snapshots:
+            logger.error('Could not find DB snapshot %s', event['SourceIdentifier'])
+            raise SnapshotNotFoundException
+        source = snapshot_descriptor(snapshots[0])
+        event['Snapshot'] = source._asdict()
+    if source.allocated_storage:
+        put_metric('AllocatedStorage', source.allocated_storage, 'Gigabytes')
+
+    # Generating name for our local snapshot copies, it is the same in every
+    # region
+    local_copy_name = LOCAL_COPY_PREFIX + replica_name(event['SourceIdentifier'], source_region, SRC_REGION)
+    local_copies = event.get('local_copies') or {}
+    for region, rds in DST_RDS.items():
+        logger.info('Copying snapshot %s locally to %s in %s', event['SourceIdentifier'], local_copy_name, region)
+        # Copies within a region must not be presigned
+        source_region_argument = {}
+        if region != source_region:
+            source_region_argument['SourceRegion'] = source_region
+        try:
+            if cluster:
+                response = rds.copy_db_cluster_snapshot(
+                    SourceDBClusterSnapshotIdentifier = event['SourceArn'],
+                    TargetDBClusterSnapshotIdentifier = local_copy_name,
+                    **source_region_argument
+                )
+                local_copies[region] = snapshot_descriptor(response['DBClusterSnapshot'])._asdict()
+            else:
+                response = rds.copy_db_snapshot(
+                    SourceDBSnapshotIdentifier = event['SourceArn'],
+                    TargetDBSnapshotIdentifier = local_copy_name,
+                    **source_region_argument
+                )
+                local_copies[region] = snapshot_descriptor(response['DBSnapshot'])._asdict()
+            logger.info('Response: %s', summarize(response))
+        except Exception as e:
+            if error_code(e) in ALREADY_EXISTS_ERRORS:
+                logger.info('Snapshot copy %s already exists in %s', local_copy_name, region)
+            else:
+                log_message = 'Copy pending: {}'.format(event['SourceIdentifier'])
+                logger.error(log_message)
+                raise SnapshotSharingException(log_message)
+    if LEDGER:
+        LEDGER.set_state(event['SourceArn'], LEDGER_COPYING)
     event['local_copy_snapshot_identifier'] = local_copy_name
-    logger.debug('Returning: {}'.format(event))
+    event['local_copies']                   = local_copies
+    event['local_copy_started_at']          = int(time.time())
+    logger.debug('Returning: %s', summarize(event))
     return event
@@ -6,37 +6,54 @@ Licensed under the Apache License, Version 2.0 (the "License").
 Inspired by https://github.com/awslabs/rds-snapshot-tool
 '''
 
-# src_copy_snapshot.py
-# This lambda function deletes the snapshot copy that was created before sharing
+# src_delete_snapshot.py
+# This lambda function deletes the snapshot copies that were created before
+# sharing, once every destination has finished its copy. In batch mode it
+# deletes the copies of all snapshots of the batch concurrently.
+# In incremental mode it keeps the copy of a DB instance snapshot and deletes
+# the previous copies of that instance instead.
+# The destination copies are only described if the step function did not just
+# find them available ($.copy_status).
+#
+# When a replication fails the step function passes
+#   {"action": "cleanup", "event": <step function state>}
+# which deletes the copies of every snapshot of the replication, also of those
+# whose steps succeeded, as the failed execution will not get to them. The
+# copies are found by name, as a failed step does not return the identifiers.
+# Their ledger entries are marked failed, so the next event or backfill can
+# replicate them again.
 
 import os
-import logging
-
-import boto3
 
 from common import *
+from ledger import *
 
-DST_ARN    = os.getenv('DST_ARN').strip()
-DST_REGION = os.getenv('DST_REGION').strip()
-LOGLEVEL   = os.getenv('LOGLEVEL', 'ERROR').strip()
+LOGLEVEL      = os.getenv('LOGLEVEL', 'ERROR').strip()
+# The region the replication is deployed in, for events without an ARN
+SRC_REGION    = os.getenv('SRC_REGION').strip()
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', '8').strip())
+# Keep the latest copy of every DB instance, so the next copy is incremental
+INCREMENTAL   = os.getenv('INCREMENTAL', 'false').strip().lower() == 'true'
+DESTINATIONS  = get_destinations()
 
-logger = logging.getLogger()
-logger.setLevel(LOGLEVEL.upper())
+logger = get_logger(LOGLEVEL)
 
-RDS = boto3.client('rds', region_name=DST_REGION)
+LEDGER = get_ledger(os.getenv('LEDGER', '').strip())
 
-STS = boto3.client('sts')
-awsaccount = STS.assume_role(
-        RoleArn         = DST_ARN,
-        RoleSessionName ='awsaccount_session'
+# The intermediate copies, one per destination region
+RDS = dict(
+    (region, LazyClient('rds', region_name=region))
+    for region in destination_regions(DESTINATIONS)
 )
 
-ACCESS_KEY    = awsaccount['Credentials']['AccessKeyId']
-SECRET_KEY    = awsaccount['Credentials']['SecretAccessKey']
-SESSION_TOKEN = awsaccount['Credentials']['SessionToken']
-
-DST_RDS = boto3.client('rds', region_name=DST_REGION, aws_access_key_id=ACCESS_KEY, aws_secret_access_key=SECRET_KEY, aws_session_token=SESSION_TOKEN)
+# The destination account roles are assumed on first use and refreshed before
+# their credentials expire
+DST_RDS = dict(
+    (destination_key(destination), LazyClient('rds', region_name=destination.region, role_arn=destination.role_arn))
+    for destination in DESTINATIONS
+)
 
+@instrument_handler
 def lambda_handler(event, context):
     """Main method
     
@@ -44,43 +61,172 @@ def lambda_handler(event, context):
         event {dict} -- Lambda event object
         context {obj} -- Lambda context object
     """
+    if event.get('action') == 'cleanup':
+        return cleanup(event['event'])
+    # src_check_copy_status stores its result for the whole batch
+    available = (event.get('copy_status') or {}).get('available', False)
+    return handle_batch(
+        lambda snapshot_event: delete_snapshot(snapshot_event, available),
+        event,
+        BATCH_WORKERS
+    )
+
+def delete_snapshot(event, available=False):
+    """Deletes the copies of a single snapshot once all destination copies are available
+
+    Arguments:
+        event {dict} -- Snapshot event
+        available {bool} -- the destination copies have just been checked
+
+    Returns:
+        dict -- as event
+    """
     cluster = False
     if 'cluster' in event['SourceType']:
         cluster = True
-    # We can only delete the shared snapshot if the destination has finished it's copy
+    # We can only delete the shared snapshots if every destination has finished
+    # its copy
+    if not available:
+        for rds in DST_RDS.values():
+            check_destination_copy(event, rds, cluster)
+    if LEDGER:
+        LEDGER.set_state(event['SourceArn'], LEDGER_DONE)
+    for rds in RDS.values():
+        # RDS only copies a snapshot incrementally if the previous copy of the
+        # same DB instance still exists in the target region. Aurora copies are
+        # never incremental, so cluster copies are always deleted.
+        if INCREMENTAL and not cluster:
+            delete_previous_copies(rds, event['local_copy_snapshot_identifier'])
+        else:
+            delete_copy(rds, event['local_copy_snapshot_identifier'], cluster)
+    return event
+
+def cleanup(state):
+    """Deletes the copies of every snapshot of a failed replication
+
+    Copies which cannot be deleted, e.g. because they are still being copied,
+    are left for src_audit_replication to report, so that the release of the
+    replication is not held up. Snapshots whose replication did not finish
+    are marked failed in the ledger, so they can be claimed again at once
+    instead of after copy_timeout_hours.
+
+    Arguments:
+        state {dict} -- Snapshot event or batch, with the error of the failed step
+
+    Returns:
+        dict -- identifiers of the copies that could not be deleted
+    """
+    logger.error('Replication failed: %s', summarize(state.get('error')))
+    snapshots = state.get('Snapshots') or [state]
+    def delete_copies(event):
+        cluster = 'cluster' in event['SourceType']
+        identifier = event.get('local_copy_snapshot_identifier') or LOCAL_COPY_PREFIX + replica_name(
+            event['SourceIdentifier'], region_of(event.get('SourceArn')) or SRC_REGION, SRC_REGION
+        )
+        failed = []
+        for rds in RDS.values():
+            try:
+                delete_copy(rds, identifier, cluster)
+            except SnapshotSharingException:
+                failed.append(identifier)
+        if LEDGER and event.get('SourceArn'):
+            entry = LEDGER.get(event['SourceArn'])
+            if entry and entry['state'] != LEDGER_DONE:
+                LEDGER.set_state(event['SourceArn'], LEDGER_FAILED)
+        return failed
+    leftover = [identifier for failed in run_concurrently(delete_copies, snapshots, BATCH_WORKERS) for identifier in failed]
+    if leftover:
+        put_metric('CleanupFailures', len(leftover))
+    return {'leftover': leftover}
+
+def check_destination_copy(event, rds, cluster):
+    """Fails unless the copy in one destination is available
+
+    Arguments:
+        event {dict} -- Snapshot event
+        rds {obj} -- RDS client of the destination
+        cluster {bool} -- True for DB cluster snapshots
+    """
     # First we check if it exists at all, and fail if it does not
     if cluster:
-        response = DST_RDS.describe_db_cluster_snapshots(
+        response = rds.describe_db_cluster_snapshots(
             DBClusterSnapshotIdentifier = event['dst_snapshot_identifier']
         )
         snapshots = response['DBClusterSnapshots']
     else:
-        response = DST_RDS.describe_db_snapshots(
+        response = rds.describe_db_snapshots(
             DBSnapshotIdentifier = event['dst_snapshot_identifier']
         )
         snapshots = response['DBSnapshots']
-    logger.debug(response)
+    logger.debug('Response: %s', summarize(response))
     if not snapshots:
-        logger.error('Could not find DB snapshot {}'.format(event['local_copy_snapshot_identifier']))
+        logger.error('Could not find DB snapshot %s', event['local_copy_snapshot_identifier'])
         raise SnapshotNotFoundException
     for snapshot in snapshots:
         if not snapshot['Status'] == 'available':
-            log_message = 'Snapshot {} still creating, retrying..'.format(snapshot['DBSnapshotIdentifier'])
+            log_message = 'Snapshot {} still creating, retrying..'.format(event['dst_snapshot_identifier'])
             logger.info(log_message)
             raise SnapshotSharingException(log_message)
-    # Generating name for our local snapshot copy
-    logger.info('Deleting snapshot {}'.format(event['local_copy_snapshot_identifier']))
+
+def delete_copy(rds, identifier, cluster):
+    """Deletes the intermediate copy in one region
+
+    Arguments:
+        rds {obj} -- RDS client of the region
+        identifier {str} -- identifier of the copy
+        cluster {bool} -- True for DB cluster snapshots
+    """
+    logger.info('Deleting snapshot %s', identifier)
     try:
         if cluster:
-            response = RDS.delete_db_cluster_snapshot(
-                DBClusterSnapshotIdentifier = event['local_copy_snapshot_identifier']
+            response = rds.delete_db_cluster_snapshot(
+                DBClusterSnapshotIdentifier = identifier
             )
         else:
-            response = RDS.delete_db_snapshot(
-                DBSnapshotIdentifier = event['local_copy_snapshot_identifier']
+            response = rds.delete_db_snapshot(
+                DBSnapshotIdentifier = identifier
             )
-        logger.info('Response: {}'.format(response))
+        logger.info('Response: %s', summarize(response))
     except Exception as e:
-        log_message = 'Exception while trying to delete: {}'.format(e)
-        logger.error(log_message)
-        raise SnapshotSharingException(log_message)
+        if error_code(e) in NOT_FOUND_ERRORS:
+            logger.info('Snapshot %s already deleted', identifier)
+        else:
+            log_message = 'Exception while trying to delete: {}'.format(e)
+            logger.error(log_message)
+            raise SnapshotSharingException(log_message)
+
+def delete_previous_copies(rds, identifier):
+    """Deletes the copies older than identifier of the same DB instance
+
+    Arguments:
+        rds {obj} -- RDS client of the region of the copies
+        identifier {str} -- identifier of the copy to keep
+    """
+    current = rds.describe_db_snapshots(
+        DBSnapshotIdentifier = identifier
+    )['DBSnapshots'][0]
+    logger.info('Keeping snapshot %s for incremental copies of %s', identifier, current['DBInstanceIdentifier'])
+    for snapshot in paginate(
+        rds.describe_db_snapshots,
+        'DBSnapshots',
+        DBInstanceIdentifier = current['DBInstanceIdentifier'],
+        SnapshotType         = 'manual'
+    ):
+        if not snapshot['DBSnapshotIdentifier'].startswith(LOCAL_COPY_PREFIX):
+            continue
+        if snapshot['DBSnapshotIdentifier'] == identifier or snapshot['Status'] != 'available':
+            continue
+        if snapshot['SnapshotCreateTime'] >= current['SnapshotCreateTime']:
+            continue
+        # Instances with the same name in another source region are different
+        # databases, their copies are kept for their own incremental copies
+        if snapshot.get('SourceRegion') != current.get('SourceRegion'):
+            continue
+        logger.info('Deleting previous snapshot %s', snapshot['DBSnapshotIdentifier'])
+        try:
+            rds.delete_db_snapshot(
+                DBSnapshotIdentifier = snapshot['DBSnapshotIdentifier']
+            )
+        except Exception as e:
+            if error_code(e) not in NOT_FOUND_ERRORS:
+                logger.error('Exception while trying to delete %s: %s', snapshot['DBSnapshotIdentifier'], e)
@@ -0,0 +1,68 @@
+'''
+Copyright 2019  Pinguin AG, Mattis Haase
+
+Licensed under the Apache License, Version 2.0 (the "License").
+'''
+
+# src_dispatcher.py
+# This lambda function runs every stage of the step function in one function,
+# if the module is deployed with dispatcher = true. The step function passes
+#   {"Stage": <module of the stage>, "Input": <event of the stage>}
+# and the dispatcher hands Input to the lambda_handler of that stage.
+#
+# All stages share the AWS clients and the assumed role credentials of the
+# container, so a replication whose stages land on the same warm container
+# only creates its clients and assumes the destination roles once. It is
+# packaged with all stages, see create_zip_files.sh.
+
+import os
+
+import dst_copy_snapshot
+import src_check_copy_status
+import src_copy_snapshot
+import src_delete_snapshot
+import src_schedule_copy
+import src_share_snapshot
+
+from common import *
+
+LOGLEVEL = os.getenv('LOGLEVEL', 'ERROR').strip()
+
+logger = get_logger(LOGLEVEL)
+
+STAGES = dict(
+    (stage.__name__, stage.lambda_handler)
+    for stage in (
+        src_schedule_copy,
+        src_copy_snapshot,
+        src_check_copy_status,
+        src_share_snapshot,
+        dst_copy_snapshot,
+        src_delete_snapshot
+    )
+)
+
+# Stages this container has run, to tell warm from cold stage transitions
+_invocations = {'count': 0}
+
+def lambda_handler(event, context):
+    """Main method
+
+    The stage handlers record their own metrics, so the dispatcher is not
+    instrumented itself.
+
+    Arguments:
+        event {dict} -- Stage and Input of the stage
+        context {obj} -- Lambda context object
+
+    Returns:
+        obj -- the result of the stage handler
+    """
+    stage = event.get('Stage')
+    if stage not in STAGES:
+        log_message = 'Unknown stage {}'.format(stage)
+        logger.error(log_message)
+        raise SnapshotSharingException(log_message)
+    _invocations['count'] += 1
+    logger.info('Running stage %s, invocation %s of this container', stage, _invocations['count'])
+    return STAGES[stage](event['Input'], context)
@@ -0,0 +1,290 @@
+'''
+Copyright 2019  Pinguin AG, Mattis Haase
+
+Licensed under the Apache License, Version 2.0 (the "License").
+'''
+
+# src_schedule_copy.py
+# This lambda function admits replications, so that no more than COPY_BUDGET
+# snapshot copies are in progress in a destination region at the same time.
+# RDS limits the copies in progress per region, copies beyond the limit would
+# only fail and be retried until the step function gives up.
+#
+# The step function passes
+#   {"action": "admit" | "release", "event": <step function state>}
+# "admit" queues the replication and returns admitted, wait_seconds and
+# position, the step function waits and asks again until it is admitted. The
+# wait grows with the position in the queue and the time already waited, from
+# ADMISSION_MIN_WAIT_SECONDS up to ADMISSION_MAX_WAIT_SECONDS, so replications
+# at the end of a long queue do not ask every few minutes.
+# Waiting replications are admitted in order of
+# 1. the first of the PRIORITY_TIERS patterns the snapshot matches
+# 2. replications waiting for longer than MAX_QUEUE_HOURS, so that large
+#    snapshots are not starved
+# 3. the size of the snapshots, smallest first
+# 4. how long they have been waiting
+# "release" frees the slots of a finished or failed replication.
+#
+# Every waiting replication is a document of the ledger collection
+# COPY_QUEUE_WAITING, which only its own invocations write. The admitted
+# replications, at most COPY_BUDGET per region, are the single document
+# COPY_QUEUE_DOCUMENT. It is only written when a replication is admitted or
+# released, and only if no other invocation has changed it in the meantime.
+
+import json
+import os
+import re
+import time
+
+from collections import Counter
+
+from common import *
+from ledger import *
+
+LOGLEVEL                   = os.getenv('LOGLEVEL', 'ERROR').strip()
+COPY_BUDGET                = int(os.getenv('COPY_BUDGET', '5').strip())
+ADMISSION_MIN_WAIT_SECONDS = int(os.getenv('ADMISSION_MIN_WAIT_SECONDS', '60').strip())
+ADMISSION_MAX_WAIT_SECONDS = int(os.getenv('ADMISSION_MAX_WAIT_SECONDS', '900').strip())
+MAX_QUEUE_HOURS            = int(os.getenv('MAX_QUEUE_HOURS', '24').strip())
+# Admitted replications whose release got lost free their slots after this long
+COPY_TIMEOUT_HOURS         = int(os.getenv('COPY_TIMEOUT_HOURS', '72').strip())
+PRIORITY_TIERS             = [re.compile(pattern) for pattern in json.loads(os.getenv('PRIORITY_TIERS', '').strip() or '[]')]
+DESTINATIONS               = get_destinations()
+
+# Waiting replications which stopped asking for admission, e.g. because their
+# execution was stopped, are dropped after this many wait intervals
+MAX_MISSED_POLLS = 3
+
+logger = get_logger(LOGLEVEL)
+
+LEDGER = get_ledger(os.getenv('LEDGER', '').strip())
+
+@instrument_handler
+def lambda_handler(event, context):
+    """Main method
+
+    Arguments:
+        event {dict} -- Lambda event object
+        context {obj} -- Lambda context object
+
+    Returns:
+        dict -- admitted, wait_seconds and position
+    """
+    logger.debug('event: %s', summarize(event))
+    key = replication_key(event['event'])
+    # Without a ledger there is nowhere to keep the queue
+    if not LEDGER or COPY_BUDGET <= 0:
+        return {'admitted': True, 'wait_seconds': 0, 'position': 0}
+    if event.get('action') == 'release':
+        LEDGER.update_document(COPY_QUEUE_DOCUMENT, lambda queue: release(queue, key))
+        LEDGER.delete_document(waiting_key(key))
+        logger.info('Released %s', key)
+        return {'admitted': True, 'wait_seconds': 0, 'position': 0}
+
+    now = int(time.time())
+    replication = queue_entry(event['event'])
+    waiting = {
+        document_key[len(waiting_key('')):]: entry
+        for document_key, entry in LEDGER.list_documents(COPY_QUEUE_WAITING).items()
+    }
+    # The index of the collection may not list the entry of this replication yet
+    waiting[key] = LEDGER.update_document(
+        waiting_key(key),
+        lambda entry: wait(entry, replication, now),
+        collection = COPY_QUEUE_WAITING
+    )
+    for expired in expire_waiting(waiting, now):
+        LEDGER.delete_document(waiting_key(expired))
+    admission = LEDGER.update_document(
+        COPY_QUEUE_DOCUMENT,
+        lambda queue: admit(queue, waiting, key, now)
+    )
+    logger.info('Replication %s admitted: %s, position %s', key, admission['admitted'], admission['position'])
+    if admission['admitted']:
+        LEDGER.delete_document(waiting_key(key))
+    else:
+        put_metric('AdmissionWaits', 1)
+    return admission
+
+def waiting_key(key):
+    """Returns the key of the ledger document of a waiting replication"""
+    return '{}:{}'.format(COPY_QUEUE_WAITING, key)
+
+def replication_key(state):
+    """Returns the key of a replication in the queue
+
+    Arguments:
+        state {dict} -- Snapshot event or batch
+
+    Returns:
+        str -- key, the same for every attempt of the replication
+    """
+    return execution_name([snapshot['SourceArn'] for snapshot in snapshots_of(state)])
+
+def snapshots_of(state):
+    """Returns the snapshot events of a single snapshot event or batch"""
+    if 'Snapshots' in state:
+        return state['Snapshots']
+    return [state]
+
+def tier(identifier):
+    """Returns the index of the first of the PRIORITY_TIERS identifier matches
+
+    Arguments:
+        identifier {str} -- snapshot identifier
+
+    Returns:
+        int -- tier, len(PRIORITY_TIERS) if it matches none
+    """
+    for index, pattern in enumerate(PRIORITY_TIERS):
+        if pattern.search(identifier):
+            return index
+    return len(PRIORITY_TIERS)
+
+def queue_entry(state):
+    """Describes a replication for the queue
+
+    The size is taken from the snapshot descriptors, snapshots without one
+    count as empty.
+
+    Arguments:
+        state {dict} -- Snapshot event or batch
+
+    Returns:
+        dict -- tier, size in GiB, weight in copies and regions
+    """
+    snapshots = snapshots_of(state)
+    size = 0
+    for snapshot in snapshots:
+        descriptor = descriptor_of(snapshot)
+        if descriptor and descriptor.allocated_storage:
+            size += descriptor.allocated_storage
+    return {
+        'tier'    : min(tier(snapshot['SourceIdentifier']) for snapshot in snapshots),
+        'size'    : size,
+        'weight'  : len(snapshots),
+        'regions' : destination_regions(DESTINATIONS)
+    }
+
+def queue_order(entry, now):
+    """Sort key of a waiting replication, see the header of this file"""
+    overdue = now - entry['enqueued_at'] > MAX_QUEUE_HOURS * 3600
+    return (entry['tier'], not overdue, entry['size'], entry['enqueued_at'])
+
+def wait(entry, replication, now):
+    """Records that a replication is still waiting for admission
+
+    Arguments:
+        entry {dict} -- waiting document of the replication, changed in place
+        replication {dict} -- queue entry of the replication
+        now {int} -- epoch seconds
+
+    Returns:
+        dict -- the waiting document
+    """
+    entry.setdefault('enqueued_at', now)
+    entry.update(replication)
+    entry['seen_at'] = now
+    return entry
+
+def expire_waiting(waiting, now):
+    """Drops the waiting replications that stopped asking for admission
+
+    Arguments:
+        waiting {dict} -- waiting documents by replication key, changed in place
+
+    Returns:
+        list -- keys of the dropped replications
+    """
+    expired = []
+    for key, entry in list(waiting.items()):
+        if entry['seen_at'] < now - MAX_MISSED_POLLS * ADMISSION_MAX_WAIT_SECONDS:
+            logger.warning('Replication %s stopped waiting for admission', key)
+            expired.append(key)
+            del waiting[key]
+    return expired
+
+def expire(queue, now):
+    """Frees the slots of admitted replications that were never released"""
+    for key, entry in list(queue['inflight'].items()):
+        if entry['admitted_at'] < now - COPY_TIMEOUT_HOURS * 3600:
+            logger.warning('Replication %s was never released, freeing its slots', key)
+            del queue['inflight'][key]
+
+def wait_seconds(entry, position, now):
+    """Returns how long a replication waits before asking for admission again
+
+    A replication waits ADMISSION_MIN_WAIT_SECONDS for every replication
+    ahead of it, or as long as it has already waited if that is longer, so
+    the number of polls only grows logarithmically with the time in the queue.
+
+    Arguments:
+        entry {dict} -- waiting document of the replication
+        position {int} -- replications ahead of it in the queue
+        now {int} -- epoch seconds
+
+    Returns:
+        int -- seconds to wait
+    """
+    return estimate_wait_seconds(
+        0,
+        now - entry['enqueued_at'],
+        ADMISSION_MIN_WAIT_SECONDS * (position + 1),
+        ADMISSION_MAX_WAIT_SECONDS
+    )
+
+def admit(queue, waiting, key, now):
+    """Admits a waiting replication if its turn has come
+
+    Waiting replications ahead of it in the queue keep the slots they fit
+    into, so that the next one to ask does not take them. Replications that
+    do not fit are passed over, and one that does not fit into an idle region
+    is admitted anyway, so that batches larger than COPY_BUDGET still run.
+
+    Arguments:
+        queue {dict} -- document of the admitted replications, changed in place
+        waiting {dict} -- waiting documents by replication key, including key
+        key {str} -- key of the replication
+        now {int} -- epoch seconds
+
+    Returns:
+        dict -- admitted, wait_seconds and position
+    """
+    queue.setdefault('inflight', {})
+    expire(queue, now)
+    if key in queue['inflight']:
+        return {'admitted': True, 'wait_seconds': 0, 'position': 0}
+
+    used = Counter()
+    for admitted in queue['inflight'].values():
+        for region in admitted['regions']:
+            used[region] += admitted['weight']
+    # Waiting documents of replications admitted in the meantime are deleted soon
+    candidates = [item for item in waiting.items() if item[0] not in queue['inflight']]
+    ordered = sorted(candidates, key=lambda item: queue_order(item[1], now))
+    for position, (candidate_key, candidate) in enumerate(ordered):
+        fits = all(
+            used[region] == 0 or used[region] + candidate['weight'] <= COPY_BUDGET
+            for region in candidate['regions']
+        )
+        if candidate_key == key:
+            if not fits:
+                return {'admitted': False, 'wait_seconds': wait_seconds(candidate, position, now), 'position': position}
+            queue['inflight'][key] = {
+                'weight'      : candidate['weight'],
+                'regions'     : candidate['regions'],
+                'admitted_at' : now
+            }
+            return {'admitted': True, 'wait_seconds': 0, 'position': position}
+        if fits:
+            for region in candidate['regions']:
+                used[region] += candidate['weight']
+
+def release(queue, key):
+    """Frees the slots of a replication
+
+    Arguments:
+        queue {dict} -- document of the admitted replications, changed in place
+        key {str} -- key of the replication
+    """
+    queue.setdefault('inflight', {}).pop(key, None)
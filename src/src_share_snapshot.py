@@ -7,24 +7,27 @@ Inspired by https://github.com/awslabs/rds-snapshot-tool
 '''
 
 # src_share_snapshot.py
-# shares the snapshot created in the previous step
+# shares the snapshot copies created in the previous step, the copy in every
+# destination region with all destination accounts in that region at once. In
+# batch mode it shares all snapshots of the batch concurrently. A copy is only
+# described if the event does not carry its descriptor.
 
 import os
-import logging
-
-import boto3
 
 from common import *
 
-LOGLEVEL    = os.getenv('LOGLEVEL', 'ERROR').strip()
-REGION      = os.getenv('REGION').strip()
-DST_ACCOUNT = os.getenv('DST_ACCOUNT').strip()
+LOGLEVEL      = os.getenv('LOGLEVEL', 'ERROR').strip()
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', '8').strip())
+DESTINATIONS  = get_destinations()
 
-logger = logging.getLogger()
-logger.setLevel(LOGLEVEL.upper())
+logger = get_logger(LOGLEVEL)
 
-RDS = boto3.client('rds', region_name=REGION)
+RDS = dict(
+    (region, LazyClient('rds', region_name=region))
+    for region in destination_regions(DESTINATIONS)
+)
 
+@instrument_handler
 def lambda_handler(event, context):
     """Main method
     
@@ -32,42 +35,72 @@ def lambda_handler(event, context):
         event {dict} -- Lambda event object
         context {obj} -- Lambda context object
     """
+    return handle_batch(share_snapshot, event, BATCH_WORKERS)
+
+def share_snapshot(event):
+    """Shares the copies of a single snapshot with the destination accounts
+
+    Arguments:
+        event {dict} -- Snapshot event
+
+    Returns:
+        dict -- as event
+    """
+    logger.debug('event: %s', summarize(event))
+    for region, rds in RDS.items():
+        accounts = [destination.account for destination in DESTINATIONS if destination.region == region]
+        share_copy(event, region, rds, accounts)
+    return event
+
+def share_copy(event, region, rds, accounts):
+    """Shares the copy of a snapshot in one region
+
+    Arguments:
+        event {dict} -- Snapshot event
+        region {str} -- region of the copy
+        rds {obj} -- RDS client of the region
+        accounts {list} -- destination account ids
+    """
     cluster = False
     if 'cluster' in event['SourceType']:
         cluster = True
-    logger.debug('event: {}'.format(event))
-
-    # Sanity check: does the snapshot actually exist?
-    if cluster:
-        response = RDS.describe_db_cluster_snapshots(
-            DBClusterSnapshotIdentifier = event['local_copy_snapshot_identifier']
-        )
-        snapshots = response['DBClusterSnapshots']
-    else:
-        response = RDS.describe_db_snapshots(
-            DBSnapshotIdentifier = event['local_copy_snapshot_identifier']
-        )
-        snapshots = response['DBSnapshots']
-    logger.debug(response)
-    if not snapshots:
-        logger.error('Could not find DB snapshot {}'.format(event['SourceIdentifier']))
-        raise SnapshotNotFoundException
+
+    # Sanity check: does the snapshot actually exist? src_copy_snapshot passes
+    # on the descriptors of the copies it created, which src_check_copy_status
+    # has since seen available
+    local_copies = event.setdefault('local_copies', {})
+    if descriptor_of(local_copies, region) is None:
+        if cluster:
+            response = rds.describe_db_cluster_snapshots(
+                DBClusterSnapshotIdentifier = event['local_copy_snapshot_identifier']
+            )
+            snapshots = response['DBClusterSnapshots']
+        else:
+            response = rds.describe_db_snapshots(
+                DBSnapshotIdentifier = event['local_copy_snapshot_identifier']
+            )
+            snapshots = response['DBSnapshots']
+        logger.debug('Response: %s', summarize(response))
+        if not snapshots:
+            logger.error('Could not find DB snapshot %s', event['SourceIdentifier'])
+            raise SnapshotNotFoundException
+        local_copies[region] = snapshot_descriptor(snapshots[0])._asdict()
 
     # To share a snapshot, one needs to modify the DB snapshot with the
+    logger.info('Sharing %s in %s with %s', event['local_copy_snapshot_identifier'], region, accounts)
     try:
         if cluster:
-            response = RDS.modify_db_cluster_snapshot_attribute(
+            response = rds.modify_db_cluster_snapshot_attribute(
                 DBClusterSnapshotIdentifier = event['local_copy_snapshot_identifier'],
                 AttributeName               = 'restore',
-                ValuesToAdd                 = [ DST_ACCOUNT ]
+                ValuesToAdd                 = accounts
             )
         else:
-            response = RDS.modify_db_snapshot_attribute(
+            response = rds.modify_db_snapshot_attribute(
                 DBSnapshotIdentifier = event['local_copy_snapshot_identifier'],
                 AttributeName        = 'restore',
-                ValuesToAdd          = [ DST_ACCOUNT ]
+                ValuesToAdd          = accounts
             )
     except Exception as e:
-        logger.error('Exception sharing {}: {}'.format(event['local_copy_snapshot_identifier'], e))
+        logger.error('Exception sharing %s: %s', event['local_copy_snapshot_identifier'], e)
         raise SnapshotSharingException('Could not share Snapshot')
-    return event
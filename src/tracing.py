@@ -0,0 +1,425 @@
+'''
+Copyright 2019  Pinguin AG, Mattis Haase
+
+Licensed under the Apache License, Version 2.0 (the "License").
+'''
+
+# tracing.py
+# Traces of the replications in OpenTelemetry JSON. common.instrument_handler
+# records a span per handler invocation, common.get_client a span per AWS API
+# call.
+
+import os
+import json
+import logging
+import threading
+import time
+import urllib.request
+
+from metrics import METRICS
+
+# Spans are exported in OpenTelemetry JSON (OTLP/JSON) if TRACE_EXPORTER is
+# set. src_backup_event starts a trace per step function execution, whose
+# context travels in the Trace field of the step function state, so the spans
+# of all steps of a replication belong to one trace
+TRACE_SERVICE_NAME = os.getenv('OTEL_SERVICE_NAME', 'rds_replication').strip()
+
+# Spans per export request
+TRACE_EXPORT_BATCH_SIZE = 512
+TRACE_EXPORT_TIMEOUT    = 5
+
+# Gaps between two steps shorter than this are not recorded as wait spans
+TRACE_MIN_WAIT_SECONDS = 1
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER   = 2
+SPAN_KIND_CLIENT   = 3
+SPAN_KIND_PRODUCER = 4
+
+STATUS_OK    = 1
+STATUS_ERROR = 2
+
+def new_trace_id():
+    """Returns a random trace id, 32 hex digits"""
+    return os.urandom(16).hex()
+
+def _unix_nano(seconds):
+    """Formats epoch seconds as OTLP/JSON nanoseconds"""
+    return str(int(seconds * 1e9))
+
+def _otlp_attributes(attributes):
+    """Encodes a dict as OTLP key values, leaving out None values"""
+    encoded = []
+    for key, value in sorted(attributes.items()):
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            typed = {'boolValue': value}
+        elif isinstance(value, int):
+            typed = {'intValue': str(value)}
+        elif isinstance(value, float):
+            typed = {'doubleValue': value}
+        else:
+            typed = {'stringValue': str(value)}
+        encoded.append({'key': key, 'value': typed})
+    return encoded
+
+class Span(object):
+    """A span being recorded, handed to its tracer when it ends
+
+    Arguments:
+        tracer {Tracer} -- tracer of the invocation
+        name {str} -- e.g. 'rds.CopyDBSnapshot'
+        kind {int} -- one of the SPAN_KIND constants
+        trace_id {str} -- 32 hex digits
+        parent_span_id {str} -- 16 hex digits, None for a root span
+        start {float} -- epoch seconds, default now
+        attributes {dict} -- string, number or boolean values
+        links {list} -- (trace id, span id) tuples of related spans
+    """
+
+    def __init__(self, tracer, name, kind, trace_id, parent_span_id, start=None, attributes=None, links=None):
+        self.tracer         = tracer
+        self.name           = name
+        self.kind           = kind
+        self.trace_id       = trace_id
+        self.span_id        = os.urandom(8).hex()
+        self.parent_span_id = parent_span_id
+        self.start          = time.time() if start is None else start
+        self.attributes     = dict(attributes or {})
+        self.links          = links or []
+        self.events         = []
+        # Set when an attempt of an API call failed, see common._trace_client
+        self.retry_from     = None
+
+    def add_event(self, name, attributes=None):
+        """Records something that happened during the span"""
+        self.events.append({
+            'timeUnixNano' : _unix_nano(time.time()),
+            'name'         : name,
+            'attributes'   : _otlp_attributes(attributes or {})
+        })
+
+    def end(self, end=None, error=None):
+        """Ends the span
+
+        Arguments:
+            end {float} -- epoch seconds, default now
+            error {str} -- error message if the span failed
+        """
+        end = time.time() if end is None else end
+        span = {
+            'traceId'           : self.trace_id,
+            'spanId'            : self.span_id,
+            'name'              : self.name,
+            'kind'              : self.kind,
+            'startTimeUnixNano' : _unix_nano(self.start),
+            'endTimeUnixNano'   : _unix_nano(end),
+            'attributes'        : _otlp_attributes(self.attributes),
+            'events'            : self.events,
+            'links'             : [{'traceId': trace_id, 'spanId': span_id} for trace_id, span_id in self.links],
+            'status'            : {'code': STATUS_OK}
+        }
+        if self.parent_span_id:
+            span['parentSpanId'] = self.parent_span_id
+        if error is not None:
+            span['status'] = {'code': STATUS_ERROR, 'message': str(error)}
+        self.tracer.finished(span)
+
+class Tracer(object):
+    """Records the spans of one handler invocation
+
+    Spans can be started from any thread. Spans of a thread without an active
+    span, e.g. the API calls of run_concurrently workers, are children of the
+    handler span. Without an exporter nothing is recorded.
+    """
+
+    def __init__(self, exporter):
+        self.exporter = exporter
+        self.trace_id = None
+        self.root     = None
+        self.spans    = []
+        self.lock     = threading.Lock()
+        self.local    = threading.local()
+
+    @property
+    def enabled(self):
+        return self.exporter is not None
+
+    def start(self, function, trace_context=None, request_id=None):
+        """Starts the handler span of a new invocation
+
+        Arguments:
+            function {str} -- module name of the handler
+            trace_context {dict} -- Trace field of the step function state, if any
+            request_id {str} -- Lambda request id
+        """
+        self.root = None
+        self.trace_id = trace_context['trace_id'] if trace_context else None
+        if not self.enabled:
+            return
+        self.trace_id = self.trace_id or new_trace_id()
+        self.root = self.start_span(
+            function,
+            SPAN_KIND_SERVER,
+            parent_span_id = trace_context['span_id'] if trace_context else None,
+            attributes     = {'faas.name': function, 'faas.invocation_id': request_id}
+        )
+        if trace_context and trace_context.get('ended_at'):
+            self.record_wait(trace_context, self.root.start)
+
+    def record_wait(self, trace_context, start):
+        """Records the time between the previous step and this one
+
+        That is a Wait state if the previous step asked for one, e.g. while a
+        copy is in progress, else the transition between the steps including
+        the retries of failed attempts.
+        """
+        if start - trace_context['ended_at'] < TRACE_MIN_WAIT_SECONDS:
+            return
+        name = 'stepfunctions.transition'
+        if trace_context.get('wait_seconds'):
+            name = 'stepfunctions.wait'
+        self.record_span(
+            name,
+            trace_context['ended_at'],
+            start,
+            parent_span_id = trace_context['span_id'],
+            attributes     = {
+                'replication.previous_step' : trace_context.get('step'),
+                'replication.wait_seconds'  : trace_context.get('wait_seconds')
+            }
+        )
+
+    def finish(self, error=None):
+        """Ends the handler span and exports all spans of the invocation"""
+        if self.root:
+            self.root.end(error=error)
+            self.root = None
+        self.flush()
+
+    def active(self):
+        """Returns the span new spans of this thread are children of"""
+        return getattr(self.local, 'span', None) or self.root
+
+    def activate(self, span):
+        """Makes span the parent of new spans of this thread
+
+        Returns:
+            Span -- the previously active span of this thread
+        """
+        previous = getattr(self.local, 'span', None)
+        self.local.span = span
+        return previous
+
+    def start_span(self, name, kind=SPAN_KIND_INTERNAL, parent_span_id=None, start=None, attributes=None, trace_id=None, links=None):
+        """Starts a span, a child of the active span unless parent_span_id is given
+
+        Returns:
+            Span -- or None if tracing is disabled
+        """
+        if not self.enabled:
+            return None
+        if parent_span_id is None and trace_id is None:
+            parent = self.active()
+            parent_span_id = parent.span_id if parent else None
+        return Span(self, name, kind, trace_id or self.trace_id, parent_span_id, start, attributes, links)
+
+    def record_span(self, name, start, end, kind=SPAN_KIND_INTERNAL, parent_span_id=None, attributes=None):
+        """Records a span that has already ended, e.g. a wait"""
+        span = self.start_span(name, kind, parent_span_id, start, attributes)
+        if span:
+            span.end(end)
+
+    def finished(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def flush(self):
+        """Exports the finished spans, errors of the exporter are only logged"""
+        with self.lock:
+            spans, self.spans = self.spans, []
+        if not spans or not self.exporter:
+            return
+        for start in range(0, len(spans), TRACE_EXPORT_BATCH_SIZE):
+            batch = spans[start:start + TRACE_EXPORT_BATCH_SIZE]
+            try:
+                self.exporter.export(otlp_request(batch, METRICS.function))
+            except Exception as e:
+                logging.getLogger().warning('Could not export %s spans: %s', len(batch), e)
+
+def otlp_request(spans, function):
+    """Wraps spans in an OTLP/JSON ExportTraceServiceRequest
+
+    Arguments:
+        spans {list} -- OTLP/JSON spans
+        function {str} -- module name of the handler
+
+    Returns:
+        dict -- request with one resource and scope
+    """
+    return {
+        'resourceSpans': [{
+            'resource'   : {'attributes': _otlp_attributes({
+                'service.name' : TRACE_SERVICE_NAME,
+                'faas.name'    : function
+            })},
+            'scopeSpans' : [{
+                'scope' : {'name': TRACE_SERVICE_NAME},
+                'spans' : spans
+            }]
+        }]
+    }
+
+class StdoutTraceExporter(object):
+    """Prints OTLP/JSON requests to stdout, where Lambda sends them to CloudWatch Logs"""
+
+    def export(self, request):
+        print(json.dumps(request))
+
+class FileTraceExporter(object):
+    """Appends OTLP/JSON requests to a file, one per line, e.g. for local tools"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, request):
+        with self.lock:
+            with open(self.path, 'a') as trace_file:
+                trace_file.write(json.dumps(request) + '\n')
+
+class OtlpHttpTraceExporter(object):
+    """Posts OTLP/JSON requests to a collector, e.g. http://localhost:4318/v1/traces"""
+
+    def __init__(self, url):
+        self.url = url
+
+    def export(self, request):
+        urllib.request.urlopen(
+            urllib.request.Request(
+                self.url,
+                data    = json.dumps(request).encode(),
+                headers = {'Content-Type': 'application/json'}
+            ),
+            timeout = TRACE_EXPORT_TIMEOUT
+        ).close()
+
+class MemoryTraceExporter(object):
+    """Keeps exported spans in memory, e.g. for tests"""
+
+    def __init__(self):
+        self.requests = []
+        self.spans    = []
+
+    def export(self, request):
+        self.requests.append(request)
+        for resource_spans in request['resourceSpans']:
+            for scope_spans in resource_spans['scopeSpans']:
+                self.spans.extend(scope_spans['spans'])
+
+TRACE_EXPORTERS = {
+    'file'   : FileTraceExporter,
+    'http'   : lambda location: OtlpHttpTraceExporter('http://' + location),
+    'https'  : lambda location: OtlpHttpTraceExporter('https://' + location),
+    'stdout' : lambda location: StdoutTraceExporter(),
+}
+
+def get_trace_exporter(url):
+    """Returns the exporter for url
+
+    Arguments:
+        url {str} -- 'stdout://', 'file://<path>' or the http(s) URL of an
+            OTLP/JSON collector, an empty string disables tracing
+
+    Returns:
+        obj -- exporter, or None if url is empty
+    """
+    if not url:
+        return None
+    backend, _, location = url.partition('://')
+    if backend not in TRACE_EXPORTERS:
+        raise ValueError('Unknown trace exporter {}'.format(backend))
+    return TRACE_EXPORTERS[backend](location)
+
+TRACER = Tracer(get_trace_exporter(os.getenv('TRACE_EXPORTER', '').strip()))
+
+def set_trace_exporter(exporter):
+    """Replaces where spans are exported to, e.g. by a MemoryTraceExporter
+
+    Arguments:
+        exporter {obj} -- object with an export(request) method, None disables tracing
+
+    Returns:
+        obj -- the previous exporter
+    """
+    previous, TRACER.exporter = TRACER.exporter, exporter
+    return previous
+
+def trace_context_of(event):
+    """Returns the trace context a step function state carries
+
+    Steps whose result is stored in a field of the state, like the copy
+    checks, carry it in their result, so the context of the step that ended
+    last is returned.
+
+    Arguments:
+        event {dict} -- Lambda event object
+
+    Returns:
+        dict -- trace_id, span_id, step, ended_at and wait_seconds, or None
+    """
+    contexts = []
+    if isinstance(event, dict):
+        for state in (event, event.get('event')):
+            if isinstance(state, dict):
+                contexts.append(state.get('Trace'))
+                contexts.extend(value.get('Trace') for value in state.values() if isinstance(value, dict))
+    contexts = [context for context in contexts if isinstance(context, dict) and context.get('trace_id')]
+    if not contexts:
+        return None
+    return max(contexts, key=lambda context: context.get('ended_at') or 0)
+
+def trace_replication(execution_input):
+    """Starts the trace of a step function execution
+
+    Arguments:
+        execution_input {dict} -- single snapshot event or batch
+
+    Returns:
+        dict -- execution_input with the trace context in Trace, unchanged
+            if tracing is disabled
+    """
+    if not TRACER.enabled:
+        return execution_input
+    snapshots = execution_input.get('Snapshots') or [execution_input]
+    invocation = TRACER.active()
+    span = TRACER.start_span(
+        'replication',
+        SPAN_KIND_PRODUCER,
+        trace_id   = new_trace_id(),
+        links      = [(invocation.trace_id, invocation.span_id)] if invocation else [],
+        attributes = {
+            'replication.source'    : snapshots[0].get('SourceIdentifier'),
+            'replication.snapshots' : len(snapshots)
+        }
+    )
+    ended_at = time.time()
+    span.end(ended_at)
+    return dict(execution_input, Trace={
+        'trace_id' : span.trace_id,
+        'span_id'  : span.span_id,
+        'ended_at' : ended_at
+    })
+
+def next_trace_context(trace_context, function, result):
+    """Returns the trace context a step passes on in its result"""
+    next_context = {
+        'trace_id' : trace_context['trace_id'],
+        'span_id'  : trace_context['span_id'],
+        'step'     : function,
+        'ended_at' : time.time()
+    }
+    if result.get('wait_seconds'):
+        next_context['wait_seconds'] = result['wait_seconds']
+    return next_context
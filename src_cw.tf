@@ -4,7 +4,7 @@ resource "aws_cloudwatch_event_rule" "src_check_for_aurora_backups" {
 
   name                = "rds-replication-trigger-src-check-aurora-backups"
   description         = "Triggers Lambda rds_replication_src_check_aurora_backups"
-  schedule_expression = var.schedule_expression
+  schedule_expression = coalesce(var.check_schedule_expression, var.schedule_expression)
 }
 
 resource "aws_cloudwatch_event_target" "src_check_for_aurora_backups" {
@@ -12,3 +12,31 @@ resource "aws_cloudwatch_event_target" "src_check_for_aurora_backups" {
   arn  = aws_lambda_function.src_check_aurora_backups.arn
 }
 
+
+# Event to trigger the replication audit
+resource "aws_cloudwatch_event_rule" "src_audit_replication" {
+  provider = aws.src
+
+  name                = "rds-replication-trigger-src-audit-replication"
+  description         = "Triggers Lambda rds_replication_src_audit_replication"
+  schedule_expression = var.audit_schedule_expression
+}
+
+resource "aws_cloudwatch_event_target" "src_audit_replication" {
+  rule = aws_cloudwatch_event_rule.src_audit_replication.name
+  arn  = aws_lambda_function.src_audit_replication.arn
+}
+
+# Event to continue a backfill
+resource "aws_cloudwatch_event_rule" "src_backfill_snapshots" {
+  provider = aws.src
+
+  name                = "rds-replication-trigger-src-backfill-snapshots"
+  description         = "Triggers Lambda rds_replication_src_backfill_snapshots"
+  schedule_expression = var.backfill_schedule_expression
+}
+
+resource "aws_cloudwatch_event_target" "src_backfill_snapshots" {
+  rule = aws_cloudwatch_event_rule.src_backfill_snapshots.name
+  arn  = aws_lambda_function.src_backfill_snapshots.arn
+}
@@ -0,0 +1,33 @@
+# DynamoDB for source account
+# Replication ledger: the replication state of every source snapshot, so that
+# duplicate events do not start a second replication
+resource "aws_dynamodb_table" "replication_ledger" {
+  provider = aws.src
+
+  name         = "rds_replication_ledger"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "source_arn"
+
+  attribute {
+    name = "source_arn"
+    type = "S"
+  }
+
+  # Only documents of a collection, e.g. the replications waiting for
+  # admission, have this attribute
+  attribute {
+    name = "collection"
+    type = "S"
+  }
+
+  global_secondary_index {
+    name            = "collection"
+    hash_key        = "collection"
+    projection_type = "ALL"
+  }
+
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+}
@@ -56,6 +56,19 @@ resource "aws_iam_role_policy" "src_lambda_execution_policy" {
         "SNS:publish"
       ],
       "Resource": "${aws_sns_topic.rds_snapshots.arn}"
+    },
+    {
+      "Effect": "Allow",
+      "Action": [
+        "dynamodb:GetItem",
+        "dynamodb:UpdateItem",
+        "dynamodb:DeleteItem",
+        "dynamodb:Query"
+      ],
+      "Resource": [
+        "${aws_dynamodb_table.replication_ledger.arn}",
+        "${aws_dynamodb_table.replication_ledger.arn}/index/*"
+      ]
     }
   ]
 }
@@ -104,11 +117,43 @@ resource "aws_iam_role_policy" "src_state_execution_policy" {
       "Action": [
         "lambda:InvokeFunction"
       ],
+      "Resource": ${jsonencode(concat([
+        aws_lambda_function.src_schedule_copy.arn,
+        aws_lambda_function.src_copy_snapshot.arn,
+        aws_lambda_function.src_check_copy_status.arn,
+        aws_lambda_function.src_share_snapshot.arn,
+        aws_lambda_function.src_delete_snapshot.arn,
+        aws_lambda_function.dst_copy_snapshot.arn
+      ], aws_lambda_function.src_dispatcher[*].qualified_arn))}
+    },
+    {
+      "Effect": "Allow",
+      "Action": [
+        "states:StartExecution"
+      ],
       "Resource": [
-        "${aws_lambda_function.src_copy_snapshot.arn}",
-        "${aws_lambda_function.src_share_snapshot.arn}",
-        "${aws_lambda_function.src_delete_snapshot.arn}",
-        "${aws_lambda_function.dst_copy_snapshot.arn}"
+        "${aws_sfn_state_machine.src_rds_snapshot_sharing.id}"
+      ]
+    },
+    {
+      "Effect": "Allow",
+      "Action": [
+        "states:DescribeExecution",
+        "states:StopExecution"
+      ],
+      "Resource": [
+        "arn:aws:states:${var.src_region}:${var.src_account_id}:execution:${aws_sfn_state_machine.src_rds_snapshot_sharing.name}:*"
+      ]
+    },
+    {
+      "Effect": "Allow",
+      "Action": [
+        "events:PutTargets",
+        "events:PutRule",
+        "events:DescribeRule"
+      ],
+      "Resource": [
+        "arn:aws:events:${var.src_region}:${var.src_account_id}:rule/StepFunctionsGetEventsForStepFunctionsExecutionRule"
       ]
     }
   ]
@@ -152,7 +197,8 @@ resource "aws_iam_role_policy" "src_step_invocation_policy" {
         "states:StartExecution"
       ],
       "Resource": [
-        "${aws_sfn_state_machine.src_rds_snapshot_sharing.id}"
+        "${aws_sfn_state_machine.src_rds_snapshot_sharing.id}",
+        "${aws_sfn_state_machine.src_rds_snapshot_sharing_batch.id}"
       ]
     },
     {
@@ -167,6 +213,24 @@ resource "aws_iam_role_policy" "src_step_invocation_policy" {
         "rds:DescribeDBClusterSnapshotAttributes"
       ],
       "Resource": "*"
+    },
+    {
+      "Effect": "Allow",
+      "Action": [
+        "dynamodb:GetItem",
+        "dynamodb:UpdateItem",
+        "dynamodb:DeleteItem"
+      ],
+      "Resource": "${aws_dynamodb_table.replication_ledger.arn}"
+    },
+    {
+      "Effect": "Allow",
+      "Action": [
+        "sqs:ReceiveMessage",
+        "sqs:DeleteMessage",
+        "sqs:GetQueueAttributes"
+      ],
+      "Resource": "arn:aws:sqs:${var.src_region}:${data.aws_caller_identity.source.account_id}:rds_snapshots"
     }
   ]
 }
@@ -214,7 +278,7 @@ resource "aws_iam_role_policy" "src_lambda_cross_account_execution_policy" {
     {
         "Effect": "Allow",
         "Action": "sts:AssumeRole",
-        "Resource": "${aws_iam_role.dst_lambda_execution_role.arn}"
+        "Resource": ${jsonencode(concat([aws_iam_role.dst_lambda_execution_role.arn], var.destinations[*].role_arn))}
     },
     {
       "Effect": "Allow",
@@ -234,6 +298,26 @@ resource "aws_iam_role_policy" "src_lambda_cross_account_execution_policy" {
         "rds:ListTagsForResource"
       ],
       "Resource": "*"
+    },
+    {
+      "Effect": "Allow",
+      "Action": [
+        "SNS:publish"
+      ],
+      "Resource": "${aws_sns_topic.rds_snapshots.arn}"
+    },
+    {
+      "Effect": "Allow",
+      "Action": [
+        "dynamodb:GetItem",
+        "dynamodb:UpdateItem",
+        "dynamodb:DeleteItem",
+        "dynamodb:Query"
+      ],
+      "Resource": [
+        "${aws_dynamodb_table.replication_ledger.arn}",
+        "${aws_dynamodb_table.replication_ledger.arn}/index/*"
+      ]
     }
   ]
 }
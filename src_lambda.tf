@@ -1,3 +1,13 @@
+# All destinations of the replication: dst_account_id in dst_region and the
+# additional destinations
+locals {
+  destinations = jsonencode(concat([{
+    account_id = var.dst_account_id
+    region     = var.dst_region
+    role_arn   = aws_iam_role.dst_lambda_execution_role.arn
+  }], var.destinations))
+}
+
 # Triggered periodically to check aurora snapshots for replication canidates
 resource "aws_lambda_function" "src_check_aurora_backups" {
   provider = aws.src
@@ -8,17 +18,25 @@ resource "aws_lambda_function" "src_check_aurora_backups" {
   handler          = "src_check_aurora_backups.lambda_handler"
   memory_size      = 128
   role             = aws_iam_role.src_lambda_execution_role.arn
-  runtime          = "python3.6"
+  runtime          = var.lambda_runtime
   source_code_hash = filebase64sha256("${path.module}/bin/src_check_aurora_backups.zip")
   timeout          = 300
 
   environment {
     variables = {
-      "LOGLEVEL"      = var.log_level
-      "REGION"        = var.src_region
-      "SNS_TOPIC_ARN" = aws_sns_topic.rds_snapshots.arn
-      "PATTERN"       = var.pattern
-      "BACKUP_LAST_N" = var.backup_last
+      "API_RATE_LIMITS"    = lookup(var.function_api_rate_limits, "src_check_aurora_backups", var.api_rate_limits)
+      "LOGLEVEL"           = var.log_level
+      "REGION"             = var.src_region
+      "SNS_TOPIC_ARN"      = aws_sns_topic.rds_snapshots.arn
+      "PATTERN"            = var.pattern
+      "BACKUP_LAST_N"      = var.backup_last
+      "BATCH_SIZE"         = var.batch_size
+      "PUBLISH_BATCH_SIZE" = var.publish_batch_size
+      "SCAN_WORKERS"       = var.scan_workers
+      "SOURCE_REGIONS"     = join(",", var.src_regions)
+      "LEDGER"             = "dynamodb://${aws_dynamodb_table.replication_ledger.name}"
+      "LEDGER_STALE_HOURS" = var.copy_timeout_hours
+      "TRACE_EXPORTER"     = var.trace_exporter
     }
   }
 }
@@ -40,22 +58,31 @@ resource "aws_lambda_function" "src_backup_event" {
   handler          = "src_backup_event.lambda_handler"
   memory_size      = 128
   role             = aws_iam_role.src_step_invocation_role.arn
-  runtime          = "python3.6"
+  runtime          = var.lambda_runtime
   source_code_hash = filebase64sha256("${path.module}/bin/src_backup_event.zip")
   timeout          = 300
 
   environment {
     variables = {
-      "LOGLEVEL"          = var.log_level
-      "PATTERN"           = var.pattern
-      "REGION"            = var.src_region
-      "STATE_MACHINE_ARN" = aws_sfn_state_machine.src_rds_snapshot_sharing.id
+      "API_RATE_LIMITS"         = lookup(var.function_api_rate_limits, "src_backup_event", var.api_rate_limits)
+      "BATCH_SIZE"              = var.batch_size
+      "BATCH_STATE_MACHINE_ARN" = aws_sfn_state_machine.src_rds_snapshot_sharing_batch.id
+      "LEDGER"                  = "dynamodb://${aws_dynamodb_table.replication_ledger.name}"
+      "LEDGER_STALE_HOURS"      = var.copy_timeout_hours
+      "LOGLEVEL"                = var.log_level
+      "PATTERN"                 = var.pattern
+      "REGION"                  = var.src_region
+      "SOURCE_REGIONS"          = join(",", var.src_regions)
+      "STATE_MACHINE_ARN"       = aws_sfn_state_machine.src_rds_snapshot_sharing.id
+      "TRACE_EXPORTER"          = var.trace_exporter
     }
   }
 }
 
 # Allow to be executed from SNS
 resource "aws_lambda_permission" "sns" {
+  count = var.event_queue ? 0 : 1
+
   statement_id  = "AllowExecutionFromSNS"
   action        = "lambda:InvokeFunction"
   function_name = aws_lambda_function.src_backup_event.function_name
@@ -74,15 +101,20 @@ resource "aws_lambda_function" "src_copy_snapshot" {
   handler          = "src_copy_snapshot.lambda_handler"
   memory_size      = 128
   role             = aws_iam_role.src_lambda_execution_role.arn
-  runtime          = "python3.6"
+  runtime          = var.lambda_runtime
   source_code_hash = filebase64sha256("${path.module}/bin/src_copy_snapshot.zip")
   timeout          = 300
 
   environment {
     variables = {
-      "DST_REGION" = var.dst_region
-      "LOGLEVEL"   = var.log_level
-      "SRC_REGION" = var.src_region
+      "API_RATE_LIMITS" = lookup(var.function_api_rate_limits, "src_copy_snapshot", var.api_rate_limits)
+      "BATCH_WORKERS"   = var.batch_workers
+      "DESTINATIONS"    = local.destinations
+      "LEDGER"          = "dynamodb://${aws_dynamodb_table.replication_ledger.name}"
+      "LOGLEVEL"        = var.log_level
+      "SOURCE_REGIONS"  = join(",", var.src_regions)
+      "SRC_REGION"      = var.src_region
+      "TRACE_EXPORTER"  = var.trace_exporter
     }
   }
 }
@@ -97,15 +129,17 @@ resource "aws_lambda_function" "src_share_snapshot" {
   handler          = "src_share_snapshot.lambda_handler"
   memory_size      = 128
   role             = aws_iam_role.src_lambda_execution_role.arn
-  runtime          = "python3.6"
+  runtime          = var.lambda_runtime
   source_code_hash = filebase64sha256("${path.module}/bin/src_share_snapshot.zip")
   timeout          = 300
 
   environment {
     variables = {
-      "REGION"      = var.dst_region
-      "DST_ACCOUNT" = var.dst_account_id
-      "LOGLEVEL"    = var.log_level
+      "API_RATE_LIMITS" = lookup(var.function_api_rate_limits, "src_share_snapshot", var.api_rate_limits)
+      "BATCH_WORKERS"   = var.batch_workers
+      "DESTINATIONS"    = local.destinations
+      "LOGLEVEL"        = var.log_level
+      "TRACE_EXPORTER"  = var.trace_exporter
     }
   }
 }
@@ -121,15 +155,20 @@ resource "aws_lambda_function" "src_delete_snapshot" {
   handler          = "src_delete_snapshot.lambda_handler"
   memory_size      = 128
   role             = aws_iam_role.src_lambda_cross_account_execution_role.arn
-  runtime          = "python3.6"
+  runtime          = var.lambda_runtime
   source_code_hash = filebase64sha256("${path.module}/bin/src_delete_snapshot.zip")
   timeout          = 300
 
   environment {
     variables = {
-      "DST_ARN"    = aws_iam_role.dst_lambda_execution_role.arn
-      "DST_REGION" = var.dst_region
-      "LOGLEVEL"   = var.log_level
+      "API_RATE_LIMITS" = lookup(var.function_api_rate_limits, "src_delete_snapshot", var.api_rate_limits)
+      "BATCH_WORKERS"   = var.batch_workers
+      "DESTINATIONS"    = local.destinations
+      "INCREMENTAL"     = var.incremental
+      "LEDGER"          = "dynamodb://${aws_dynamodb_table.replication_ledger.name}"
+      "LOGLEVEL"        = var.log_level
+      "SRC_REGION"      = var.src_region
+      "TRACE_EXPORTER"  = var.trace_exporter
     }
   }
 }
@@ -145,17 +184,209 @@ resource "aws_lambda_function" "dst_copy_snapshot" {
   handler          = "dst_copy_snapshot.lambda_handler"
   memory_size      = 128
   role             = aws_iam_role.src_lambda_cross_account_execution_role.arn
-  runtime          = "python3.6"
+  runtime          = var.lambda_runtime
   source_code_hash = filebase64sha256("${path.module}/bin/dst_copy_snapshot.zip")
   timeout          = 300
 
   environment {
     variables = {
-      "DST_ARN"     = aws_iam_role.dst_lambda_execution_role.arn
-      "DST_REGION"  = var.dst_region
-      "LOGLEVEL"    = var.log_level
-      "SRC_ACCOUNT" = var.src_account_id
+      "API_RATE_LIMITS" = lookup(var.function_api_rate_limits, "dst_copy_snapshot", var.api_rate_limits)
+      "BATCH_WORKERS"   = var.batch_workers
+      "DESTINATIONS"    = local.destinations
+      "LOGLEVEL"        = var.log_level
+      "SRC_ACCOUNT"     = var.src_account_id
+      "SRC_REGION"      = var.src_region
+      "TRACE_EXPORTER"  = var.trace_exporter
     }
   }
 }
 
+
+# Lambda function that checks whether a snapshot copy is available and how
+# long the step function should wait before checking again
+resource "aws_lambda_function" "src_check_copy_status" {
+  provider = aws.src
+
+  description      = "Checks the progress of a snapshot copy"
+  filename         = "${path.module}/bin/src_check_copy_status.zip"
+  function_name    = "rds_replication_src_check_copy_status"
+  handler          = "src_check_copy_status.lambda_handler"
+  memory_size      = 128
+  role             = aws_iam_role.src_lambda_cross_account_execution_role.arn
+  runtime          = var.lambda_runtime
+  source_code_hash = filebase64sha256("${path.module}/bin/src_check_copy_status.zip")
+  timeout          = 300
+
+  environment {
+    variables = {
+      "API_RATE_LIMITS"    = lookup(var.function_api_rate_limits, "src_check_copy_status", var.api_rate_limits)
+      "BATCH_WORKERS"      = var.batch_workers
+      "COPY_TIMEOUT_HOURS" = var.copy_timeout_hours
+      "DESTINATIONS"       = local.destinations
+      "LOGLEVEL"           = var.log_level
+      "MAX_WAIT_SECONDS"   = var.copy_check_max_wait
+      "MIN_WAIT_SECONDS"   = var.copy_check_min_wait
+      "TRACE_EXPORTER"     = var.trace_exporter
+    }
+  }
+}
+
+# Lambda function that admits replications within the copy budget of every
+# destination region
+resource "aws_lambda_function" "src_schedule_copy" {
+  provider = aws.src
+
+  description      = "Admits snapshot copies within the copy budget"
+  filename         = "${path.module}/bin/src_schedule_copy.zip"
+  function_name    = "rds_replication_src_schedule_copy"
+  handler          = "src_schedule_copy.lambda_handler"
+  memory_size      = 128
+  role             = aws_iam_role.src_lambda_execution_role.arn
+  runtime          = var.lambda_runtime
+  source_code_hash = filebase64sha256("${path.module}/bin/src_schedule_copy.zip")
+  timeout          = 300
+
+  environment {
+    variables = {
+      "API_RATE_LIMITS"    = lookup(var.function_api_rate_limits, "src_schedule_copy", var.api_rate_limits)
+      "COPY_BUDGET"        = var.copy_budget
+      "COPY_TIMEOUT_HOURS" = var.copy_timeout_hours
+      "DESTINATIONS"       = local.destinations
+      "LEDGER"             = "dynamodb://${aws_dynamodb_table.replication_ledger.name}"
+      "LOGLEVEL"           = var.log_level
+      "PRIORITY_TIERS"     = jsonencode(var.priority_tiers)
+      "TRACE_EXPORTER"     = var.trace_exporter
+    }
+  }
+}
+
+# With dispatcher one function runs all stages of the step function, so that
+# the stages of a replication share warm containers, clients and credentials
+resource "aws_lambda_function" "src_dispatcher" {
+  count    = var.dispatcher ? 1 : 0
+  provider = aws.src
+
+  description      = "Runs the stages of the RDS snapshot replication"
+  filename         = "${path.module}/bin/src_dispatcher.zip"
+  function_name    = "rds_replication_src_dispatcher"
+  handler          = "src_dispatcher.lambda_handler"
+  memory_size      = 128
+  publish          = true
+  role             = aws_iam_role.src_lambda_cross_account_execution_role.arn
+  runtime          = var.lambda_runtime
+  source_code_hash = filebase64sha256("${path.module}/bin/src_dispatcher.zip")
+  timeout          = 300
+
+  environment {
+    variables = {
+      "API_RATE_LIMITS"    = lookup(var.function_api_rate_limits, "src_dispatcher", var.api_rate_limits)
+      "BATCH_WORKERS"      = var.batch_workers
+      "COPY_BUDGET"        = var.copy_budget
+      "COPY_TIMEOUT_HOURS" = var.copy_timeout_hours
+      "DESTINATIONS"       = local.destinations
+      "INCREMENTAL"        = var.incremental
+      "LEDGER"             = "dynamodb://${aws_dynamodb_table.replication_ledger.name}"
+      "LOGLEVEL"           = var.log_level
+      "MAX_WAIT_SECONDS"   = var.copy_check_max_wait
+      "MIN_WAIT_SECONDS"   = var.copy_check_min_wait
+      "PRIORITY_TIERS"     = jsonencode(var.priority_tiers)
+      "SOURCE_REGIONS"     = join(",", var.src_regions)
+      "SRC_ACCOUNT"        = var.src_account_id
+      "SRC_REGION"         = var.src_region
+      "TRACE_EXPORTER"     = var.trace_exporter
+    }
+  }
+}
+
+resource "aws_lambda_provisioned_concurrency_config" "src_dispatcher" {
+  count    = var.dispatcher && var.dispatcher_provisioned_concurrency > 0 ? 1 : 0
+  provider = aws.src
+
+  function_name                     = aws_lambda_function.src_dispatcher[0].function_name
+  provisioned_concurrent_executions = var.dispatcher_provisioned_concurrency
+  qualifier                         = aws_lambda_function.src_dispatcher[0].version
+}
+
+# Triggered periodically to report replication lag, missing copies and stuck
+# intermediate copies
+resource "aws_lambda_function" "src_audit_replication" {
+  provider = aws.src
+
+  description      = "Audits the replicated snapshots"
+  filename         = "${path.module}/bin/src_audit_replication.zip"
+  function_name    = "rds_replication_src_audit_replication"
+  handler          = "src_audit_replication.lambda_handler"
+  memory_size      = 256
+  role             = aws_iam_role.src_lambda_cross_account_execution_role.arn
+  runtime          = var.lambda_runtime
+  source_code_hash = filebase64sha256("${path.module}/bin/src_audit_replication.zip")
+  timeout          = 900
+
+  environment {
+    variables = {
+      "API_RATE_LIMITS"    = lookup(var.function_api_rate_limits, "src_audit_replication", var.api_rate_limits)
+      "COPY_TIMEOUT_HOURS" = var.copy_timeout_hours
+      "DESTINATIONS"       = local.destinations
+      "INCREMENTAL"        = var.incremental
+      "LOGLEVEL"           = var.log_level
+      "MAX_LAG_HOURS"      = var.max_lag_hours
+      "PATTERN"            = var.pattern
+      "SCAN_WORKERS"       = var.scan_workers
+      "SOURCE_REGIONS"     = join(",", var.src_regions)
+      "SRC_ACCOUNT"        = var.src_account_id
+      "SRC_REGION"         = var.src_region
+      "TRACE_EXPORTER"     = var.trace_exporter
+    }
+  }
+}
+
+resource "aws_lambda_permission" "allow_cloudwatch_audit" {
+  statement_id  = "AllowExecutionFromCloudWatch"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.src_audit_replication.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.src_audit_replication.arn
+}
+
+# Triggered periodically to continue a backfill of missed snapshots, started by
+# invoking it with {"since": "<ISO 8601 time>"}
+resource "aws_lambda_function" "src_backfill_snapshots" {
+  provider = aws.src
+
+  description      = "Replicates missed snapshots in waves"
+  filename         = "${path.module}/bin/src_backfill_snapshots.zip"
+  function_name    = "rds_replication_src_backfill_snapshots"
+  handler          = "src_backfill_snapshots.lambda_handler"
+  memory_size      = 256
+  role             = aws_iam_role.src_lambda_cross_account_execution_role.arn
+  runtime          = var.lambda_runtime
+  source_code_hash = filebase64sha256("${path.module}/bin/src_backfill_snapshots.zip")
+  timeout          = 900
+
+  environment {
+    variables = {
+      "API_RATE_LIMITS"    = lookup(var.function_api_rate_limits, "src_backfill_snapshots", var.api_rate_limits)
+      "BATCH_SIZE"         = var.batch_size
+      "DESTINATIONS"       = local.destinations
+      "LEDGER"             = "dynamodb://${aws_dynamodb_table.replication_ledger.name}"
+      "LOGLEVEL"           = var.log_level
+      "PATTERN"            = var.pattern
+      "PUBLISH_BATCH_SIZE" = var.publish_batch_size
+      "SCAN_WORKERS"       = var.scan_workers
+      "SNS_TOPIC_ARN"      = aws_sns_topic.rds_snapshots.arn
+      "SOURCE_REGIONS"     = join(",", var.src_regions)
+      "SRC_ACCOUNT"        = var.src_account_id
+      "SRC_REGION"         = var.src_region
+      "TRACE_EXPORTER"     = var.trace_exporter
+      "WAVE_SIZE"          = var.backfill_wave_size
+    }
+  }
+}
+
+resource "aws_lambda_permission" "allow_cloudwatch_backfill" {
+  statement_id  = "AllowExecutionFromCloudWatch"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.src_backfill_snapshots.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.src_backfill_snapshots.arn
+}
@@ -1,12 +1,30 @@
 # Step function for RDS snapshot sharing
 # Steps are:
+# 0. wait until src_schedule_copy admits the replication
 # 1. source: make a snapshot copy "snapshot1"
-# 2. source: share snapshot1
-# 3. destination: copy snapshot1
-# 4. source: delete snapshot1
+# 2. source: wait until snapshot1 is available
+# 3. source: share snapshot1
+# 4. destination: copy snapshot1
+# 5. destination: wait until the copy is available
+# 6. source: delete snapshot1
+# 7. release the admission, also when one of the steps failed
+# When a step fails, the copies of every snapshot of the replication are
+# deleted before the admission is released, as the failed execution would
+# leave them behind.
+#
+# The waits are loops of a status check, which estimates the remaining copy
+# time from PercentProgress, and a Wait state for that long.
+#
+# With dispatcher every task invokes the published version of
+# src_dispatcher, with the stage to run and the input of the stage, instead of
+# the function of the stage.
 #
 # Result: snapshot has been copied to destination account
 
+locals {
+  dispatcher_arn = join("", aws_lambda_function.src_dispatcher[*].qualified_arn)
+}
+
 resource "aws_sfn_state_machine" "src_rds_snapshot_sharing" {
   provider = aws.src
 
@@ -16,11 +34,64 @@ resource "aws_sfn_state_machine" "src_rds_snapshot_sharing" {
   definition = <<EOF
 {
   "Comment": "Shares RDS snapshots with a different account",
-  "StartAt": "SrcCopySnapshot",
+  "StartAt": "AdmitCopy",
   "States": {
+    "AdmitCopy": {
+      "Type": "Task",
+%{ if var.dispatcher ~}
+      "Resource": "${local.dispatcher_arn}",
+      "Parameters": {
+        "Stage": "src_schedule_copy",
+        "Input": {
+          "action": "admit",
+          "event.$": "$"
+        }
+      },
+%{ else ~}
+      "Resource": "${aws_lambda_function.src_schedule_copy.arn}",
+      "Parameters": {
+        "action": "admit",
+        "event.$": "$"
+      },
+%{ endif ~}
+      "ResultPath": "$.admission",
+      "Retry": [
+        {
+          "ErrorEquals": [ "States.ALL" ],
+          "IntervalSeconds": 30,
+          "MaxAttempts": 20,
+          "BackoffRate": 1
+        }
+      ],
+      "Next": "CopyAdmitted"
+    },
+    "CopyAdmitted": {
+      "Type": "Choice",
+      "Choices": [
+        {
+          "Variable": "$.admission.admitted",
+          "BooleanEquals": true,
+          "Next": "SrcCopySnapshot"
+        }
+      ],
+      "Default": "WaitForAdmission"
+    },
+    "WaitForAdmission": {
+      "Type": "Wait",
+      "SecondsPath": "$.admission.wait_seconds",
+      "Next": "AdmitCopy"
+    },
     "SrcCopySnapshot": {
       "Type": "Task",
+%{ if var.dispatcher ~}
+      "Resource": "${local.dispatcher_arn}",
+      "Parameters": {
+        "Stage": "src_copy_snapshot",
+        "Input.$": "$"
+      },
+%{ else ~}
       "Resource": "${aws_lambda_function.src_copy_snapshot.arn}",
+%{ endif ~}
       "Retry": [
         {
           "ErrorEquals": [ "SnapshotNotFoundException" ],
@@ -41,11 +112,88 @@ resource "aws_sfn_state_machine" "src_rds_snapshot_sharing" {
           "BackoffRate": 1
         }
       ],
-      "Next": "SrcShareSnapshot"
+      "Catch": [
+        {
+          "ErrorEquals": [ "States.ALL" ],
+          "ResultPath": "$.error",
+          "Next": "DeleteFailedCopies"
+        }
+      ],
+      "Next": "CheckSrcCopy"
+    },
+    "CheckSrcCopy": {
+      "Type": "Task",
+%{ if var.dispatcher ~}
+      "Resource": "${local.dispatcher_arn}",
+      "Parameters": {
+        "Stage": "src_check_copy_status",
+        "Input": {
+          "snapshot": "local_copy",
+          "event.$": "$"
+        }
+      },
+%{ else ~}
+      "Resource": "${aws_lambda_function.src_check_copy_status.arn}",
+      "Parameters": {
+        "snapshot": "local_copy",
+        "event.$": "$"
+      },
+%{ endif ~}
+      "ResultPath": "$.copy_status",
+      "Retry": [
+        {
+          "ErrorEquals": [ "SnapshotNotFoundException" ],
+          "IntervalSeconds": 300,
+          "MaxAttempts": 1,
+          "BackoffRate": 1
+        },
+        {
+          "ErrorEquals": [ "SnapshotCopyFailedException" ],
+          "MaxAttempts": 0
+        },
+        {
+          "ErrorEquals": [ "States.ALL" ],
+          "IntervalSeconds": 30,
+          "MaxAttempts": 20,
+          "BackoffRate": 1
+        }
+      ],
+      "Catch": [
+        {
+          "ErrorEquals": [ "States.ALL" ],
+          "ResultPath": "$.error",
+          "Next": "DeleteFailedCopies"
+        }
+      ],
+      "Next": "SrcCopyAvailable"
+    },
+    "SrcCopyAvailable": {
+      "Type": "Choice",
+      "Choices": [
+        {
+          "Variable": "$.copy_status.available",
+          "BooleanEquals": true,
+          "Next": "SrcShareSnapshot"
+        }
+      ],
+      "Default": "WaitSrcCopy"
+    },
+    "WaitSrcCopy": {
+      "Type": "Wait",
+      "SecondsPath": "$.copy_status.wait_seconds",
+      "Next": "CheckSrcCopy"
     },
     "SrcShareSnapshot": {
       "Type": "Task",
+%{ if var.dispatcher ~}
+      "Resource": "${local.dispatcher_arn}",
+      "Parameters": {
+        "Stage": "src_share_snapshot",
+        "Input.$": "$"
+      },
+%{ else ~}
       "Resource": "${aws_lambda_function.src_share_snapshot.arn}",
+%{ endif ~}
       "Retry": [
         {
           "ErrorEquals": [ "SnapshotNotFoundException" ],
@@ -66,11 +214,26 @@ resource "aws_sfn_state_machine" "src_rds_snapshot_sharing" {
           "BackoffRate": 1
         }
       ],
+      "Catch": [
+        {
+          "ErrorEquals": [ "States.ALL" ],
+          "ResultPath": "$.error",
+          "Next": "DeleteFailedCopies"
+        }
+      ],
       "Next": "DstCopySnapshot"
     },
     "DstCopySnapshot": {
       "Type": "Task",
+%{ if var.dispatcher ~}
+      "Resource": "${local.dispatcher_arn}",
+      "Parameters": {
+        "Stage": "dst_copy_snapshot",
+        "Input.$": "$"
+      },
+%{ else ~}
       "Resource": "${aws_lambda_function.dst_copy_snapshot.arn}",
+%{ endif ~}
       "Retry": [
         {
           "ErrorEquals": [ "SnapshotNotFoundException" ],
@@ -91,11 +254,88 @@ resource "aws_sfn_state_machine" "src_rds_snapshot_sharing" {
           "BackoffRate": 1
         }
       ],
-      "Next": "SrcDeleteSnapshot"
+      "Catch": [
+        {
+          "ErrorEquals": [ "States.ALL" ],
+          "ResultPath": "$.error",
+          "Next": "DeleteFailedCopies"
+        }
+      ],
+      "Next": "CheckDstCopy"
+    },
+    "CheckDstCopy": {
+      "Type": "Task",
+%{ if var.dispatcher ~}
+      "Resource": "${local.dispatcher_arn}",
+      "Parameters": {
+        "Stage": "src_check_copy_status",
+        "Input": {
+          "snapshot": "dst_copy",
+          "event.$": "$"
+        }
+      },
+%{ else ~}
+      "Resource": "${aws_lambda_function.src_check_copy_status.arn}",
+      "Parameters": {
+        "snapshot": "dst_copy",
+        "event.$": "$"
+      },
+%{ endif ~}
+      "ResultPath": "$.copy_status",
+      "Retry": [
+        {
+          "ErrorEquals": [ "SnapshotNotFoundException" ],
+          "IntervalSeconds": 300,
+          "MaxAttempts": 1,
+          "BackoffRate": 1
+        },
+        {
+          "ErrorEquals": [ "SnapshotCopyFailedException" ],
+          "MaxAttempts": 0
+        },
+        {
+          "ErrorEquals": [ "States.ALL" ],
+          "IntervalSeconds": 30,
+          "MaxAttempts": 20,
+          "BackoffRate": 1
+        }
+      ],
+      "Catch": [
+        {
+          "ErrorEquals": [ "States.ALL" ],
+          "ResultPath": "$.error",
+          "Next": "DeleteFailedCopies"
+        }
+      ],
+      "Next": "DstCopyAvailable"
+    },
+    "DstCopyAvailable": {
+      "Type": "Choice",
+      "Choices": [
+        {
+          "Variable": "$.copy_status.available",
+          "BooleanEquals": true,
+          "Next": "SrcDeleteSnapshot"
+        }
+      ],
+      "Default": "WaitDstCopy"
+    },
+    "WaitDstCopy": {
+      "Type": "Wait",
+      "SecondsPath": "$.copy_status.wait_seconds",
+      "Next": "CheckDstCopy"
     },
     "SrcDeleteSnapshot": {
       "Type": "Task",
+%{ if var.dispatcher ~}
+      "Resource": "${local.dispatcher_arn}",
+      "Parameters": {
+        "Stage": "src_delete_snapshot",
+        "Input.$": "$"
+      },
+%{ else ~}
       "Resource": "${aws_lambda_function.src_delete_snapshot.arn}",
+%{ endif ~}
       "Retry": [
         {
           "ErrorEquals": [ "SnapshotNotFoundException" ],
@@ -116,7 +356,113 @@ resource "aws_sfn_state_machine" "src_rds_snapshot_sharing" {
           "BackoffRate": 1
         }
       ],
+      "Catch": [
+        {
+          "ErrorEquals": [ "States.ALL" ],
+          "ResultPath": "$.error",
+          "Next": "DeleteFailedCopies"
+        }
+      ],
+      "Next": "ReleaseCopy"
+    },
+    "ReleaseCopy": {
+      "Type": "Task",
+%{ if var.dispatcher ~}
+      "Resource": "${local.dispatcher_arn}",
+      "Parameters": {
+        "Stage": "src_schedule_copy",
+        "Input": {
+          "action": "release",
+          "event.$": "$"
+        }
+      },
+%{ else ~}
+      "Resource": "${aws_lambda_function.src_schedule_copy.arn}",
+      "Parameters": {
+        "action": "release",
+        "event.$": "$"
+      },
+%{ endif ~}
+      "ResultPath": null,
+      "Retry": [
+        {
+          "ErrorEquals": [ "States.ALL" ],
+          "IntervalSeconds": 30,
+          "MaxAttempts": 20,
+          "BackoffRate": 1
+        }
+      ],
       "End": true
+    },
+    "DeleteFailedCopies": {
+      "Type": "Task",
+%{ if var.dispatcher ~}
+      "Resource": "${local.dispatcher_arn}",
+      "Parameters": {
+        "Stage": "src_delete_snapshot",
+        "Input": {
+          "action": "cleanup",
+          "event.$": "$"
+        }
+      },
+%{ else ~}
+      "Resource": "${aws_lambda_function.src_delete_snapshot.arn}",
+      "Parameters": {
+        "action": "cleanup",
+        "event.$": "$"
+      },
+%{ endif ~}
+      "ResultPath": "$.cleanup",
+      "Retry": [
+        {
+          "ErrorEquals": [ "States.ALL" ],
+          "IntervalSeconds": 30,
+          "MaxAttempts": 3,
+          "BackoffRate": 2
+        }
+      ],
+      "Catch": [
+        {
+          "ErrorEquals": [ "States.ALL" ],
+          "ResultPath": "$.cleanup",
+          "Next": "ReleaseFailedCopy"
+        }
+      ],
+      "Next": "ReleaseFailedCopy"
+    },
+    "ReleaseFailedCopy": {
+      "Type": "Task",
+%{ if var.dispatcher ~}
+      "Resource": "${local.dispatcher_arn}",
+      "Parameters": {
+        "Stage": "src_schedule_copy",
+        "Input": {
+          "action": "release",
+          "event.$": "$"
+        }
+      },
+%{ else ~}
+      "Resource": "${aws_lambda_function.src_schedule_copy.arn}",
+      "Parameters": {
+        "action": "release",
+        "event.$": "$"
+      },
+%{ endif ~}
+      "ResultPath": null,
+      "Retry": [
+        {
+          "ErrorEquals": [ "States.ALL" ],
+          "IntervalSeconds": 30,
+          "MaxAttempts": 20,
+          "BackoffRate": 1
+        }
+      ],
+      "Next": "ReplicationFailed"
+    },
+    "ReplicationFailed": {
+      "Type": "Fail",
+      "Error": "ReplicationFailed",
+      "Cause": "A step of the replication failed, see $.error of the execution history"
     }
   }
 }
@@ -124,3 +470,56 @@ EOF
 
 }
 
+
+# Step function for replicating batches of RDS snapshots
+# Every batch is replicated by one execution of rds_snapshot_sharing, whose
+# lambda functions process all snapshots of the batch concurrently. At most
+# batch_concurrency batches are replicated at the same time, and a failed batch
+# does not stop the others.
+resource "aws_sfn_state_machine" "src_rds_snapshot_sharing_batch" {
+  provider = aws.src
+
+  name     = "rds_snapshot_sharing_batch"
+  role_arn = aws_iam_role.src_state_execution_role.arn
+
+  definition = <<EOF
+{
+  "Comment": "Shares batches of RDS snapshots with a different account",
+  "StartAt": "ReplicateBatches",
+  "States": {
+    "ReplicateBatches": {
+      "Type": "Map",
+      "ItemsPath": "$.Batches",
+      "MaxConcurrency": ${var.batch_concurrency},
+      "Iterator": {
+        "StartAt": "ReplicateBatch",
+        "States": {
+          "ReplicateBatch": {
+            "Type": "Task",
+            "Resource": "arn:aws:states:::states:startExecution.sync",
+            "Parameters": {
+              "StateMachineArn": "${aws_sfn_state_machine.src_rds_snapshot_sharing.id}",
+              "Input.$": "$"
+            },
+            "Catch": [
+              {
+                "ErrorEquals": [ "States.ALL" ],
+                "ResultPath": "$.error",
+                "Next": "BatchFailed"
+              }
+            ],
+            "End": true
+          },
+          "BatchFailed": {
+            "Type": "Pass",
+            "End": true
+          }
+        }
+      },
+      "End": true
+    }
+  }
+}
+EOF
+
+}
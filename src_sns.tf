@@ -12,8 +12,11 @@ resource "aws_db_event_subscription" "snapshots" {
   sns_topic = aws_sns_topic.rds_snapshots.arn
 }
 
-# Every event triggers src_backup_event lambda.
+# Every event triggers src_backup_event lambda, unless the events are queued
+# for it by src_sqs.tf
 resource "aws_sns_topic_subscription" "rds_snapshots_lambda_subscription" {
+  count = var.event_queue ? 0 : 1
+
   endpoint  = aws_lambda_function.src_backup_event.arn
   protocol  = "lambda"
   topic_arn = aws_sns_topic.rds_snapshots.arn
@@ -0,0 +1,75 @@
+# SQS for source account
+# With event_queue the RDS events are queued for src_backup_event, which then
+# handles them in batches and reports the events it failed to handle, so that
+# only those are retried. Events failing 5 times end up in the dead letter
+# queue.
+resource "aws_sqs_queue" "rds_snapshots_dead_letter" {
+  provider = aws.src
+  count    = var.event_queue ? 1 : 0
+
+  name                      = "rds_snapshots_dead_letter"
+  message_retention_seconds = 1209600
+}
+
+resource "aws_sqs_queue" "rds_snapshots" {
+  provider = aws.src
+  count    = var.event_queue ? 1 : 0
+
+  name = "rds_snapshots"
+  # 6 times the timeout of src_backup_event, as recommended for lambda
+  visibility_timeout_seconds = 1800
+  redrive_policy             = <<EOF
+{
+  "deadLetterTargetArn": "${aws_sqs_queue.rds_snapshots_dead_letter[0].arn}",
+  "maxReceiveCount": 5
+}
+EOF
+
+}
+
+resource "aws_sqs_queue_policy" "rds_snapshots" {
+  provider = aws.src
+  count    = var.event_queue ? 1 : 0
+
+  queue_url = aws_sqs_queue.rds_snapshots[0].id
+  policy    = <<EOF
+{
+  "Version": "2012-10-17",
+  "Statement": [
+    {
+      "Effect": "Allow",
+      "Principal": {
+        "Service": "sns.amazonaws.com"
+      },
+      "Action": "sqs:SendMessage",
+      "Resource": "${aws_sqs_queue.rds_snapshots[0].arn}",
+      "Condition": {
+        "ArnEquals": {
+          "aws:SourceArn": "${aws_sns_topic.rds_snapshots.arn}"
+        }
+      }
+    }
+  ]
+}
+EOF
+
+}
+
+resource "aws_sns_topic_subscription" "rds_snapshots_queue_subscription" {
+  provider = aws.src
+  count    = var.event_queue ? 1 : 0
+
+  endpoint  = aws_sqs_queue.rds_snapshots[0].arn
+  protocol  = "sqs"
+  topic_arn = aws_sns_topic.rds_snapshots.arn
+}
+
+resource "aws_lambda_event_source_mapping" "rds_snapshots_queue" {
+  provider = aws.src
+  count    = var.event_queue ? 1 : 0
+
+  event_source_arn        = aws_sqs_queue.rds_snapshots[0].arn
+  function_name           = aws_lambda_function.src_backup_event.arn
+  batch_size              = var.event_queue_batch_size
+  function_response_types = ["ReportBatchItemFailures"]
+}
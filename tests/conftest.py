@@ -0,0 +1,68 @@
+'''
+Copyright 2019  Pinguin AG, Mattis Haase
+
+Licensed under the Apache License, Version 2.0 (the "License").
+'''
+
+# conftest.py
+# Shared setup of the tests. The lambda functions read their configuration
+# when they are imported, so the environment is set before any of them is.
+# AWS calls go to tools/fake_aws.py, no AWS account is needed:
+#   python -m pytest tests
+
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+sys.path.insert(0, os.path.join(ROOT, 'tools'))
+
+ACCOUNT    = '123456789012'
+SRC_REGION = 'eu-central-1'
+DST_REGION = 'eu-west-1'
+
+os.environ.update({
+    'AWS_ACCESS_KEY_ID'     : 'AKIATEST',
+    'AWS_SECRET_ACCESS_KEY' : 'test',
+    'AWS_DEFAULT_REGION'    : SRC_REGION,
+    'API_RATE_LIMITS'       : '',
+    'BACKUP_LAST_N'         : '3',
+    'DST_ACCOUNT'           : ACCOUNT,
+    'DST_ARN'               : 'arn:aws:iam::{}:role/test'.format(ACCOUNT),
+    'DST_REGION'            : DST_REGION,
+    'LEDGER'                : 'sqlite://:memory:',
+    'LOGLEVEL'              : 'ERROR',
+    'PATTERN'               : '.*',
+    'REGION'                : SRC_REGION,
+    'RETENTION'             : '7',
+    'SNS_TOPIC_ARN'         : 'arn:aws:sns:{}:{}:rds_snapshots'.format(SRC_REGION, ACCOUNT),
+    'SRC_ACCOUNT'           : ACCOUNT,
+    'SRC_REGION'            : SRC_REGION,
+    'STATE_MACHINE_ARN'     : 'arn:aws:states:{}:{}:stateMachine:rds_snapshot_sharing'.format(SRC_REGION, ACCOUNT),
+})
+os.environ.pop('AWS_ENDPOINT_URL', None)
+os.environ.pop('TRACE_EXPORTER', None)
+
+import pytest
+
+import common
+import fake_aws
+
+from ledger import FileLedger, SQLiteLedger
+
+@pytest.fixture
+def fake():
+    """An empty fake AWS, which every client of the lambda functions calls"""
+    fake = fake_aws.FakeAWS()
+    previous_factory = common.set_client_factory(fake.client_factory)
+    previous_sink = common.set_metrics_sink(common.MemorySink())
+    yield fake
+    common.set_client_factory(previous_factory)
+    common.set_metrics_sink(previous_sink)
+
+@pytest.fixture(params=['sqlite', 'file'])
+def ledger(request, tmp_path):
+    """An empty ledger of every local backend"""
+    if request.param == 'sqlite':
+        return SQLiteLedger(':memory:')
+    return FileLedger(str(tmp_path / 'ledger.json'))
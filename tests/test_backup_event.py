@@ -0,0 +1,66 @@
+'''
+Copyright 2019  Pinguin AG, Mattis Haase
+
+Licensed under the Apache License, Version 2.0 (the "License").
+'''
+
+import json
+
+import pytest
+
+import fake_aws
+import src_backup_event
+
+from common import EXECUTION_NAME_LENGTH, execution_name
+from ledger import LEDGER_FAILED, SQLiteLedger
+
+ARN = 'arn:aws:rds:eu-central-1:123456789012:cluster-snapshot:rds:cluster-0000-2019-06-30-03-00'
+
+def test_execution_is_named_after_its_snapshot():
+    name = execution_name([ARN])
+    assert name.startswith('rds-cluster-0000-2019-06-30-03-00-1-')
+    assert name == execution_name([ARN])
+    assert execution_name([ARN], attempt=2) != name
+
+def test_execution_name_of_a_batch_does_not_depend_on_the_order():
+    other = ARN.replace('0000', '0001')
+    assert execution_name([ARN, other]) == execution_name([other, ARN])
+    assert execution_name([ARN, other]).startswith('batch-2-')
+
+def test_long_execution_names_stay_unique():
+    long_arns = [ARN.replace('cluster-0000', 'cluster-{}-{}'.format('x' * 80, index)) for index in range(2)]
+    names = [execution_name([arn]) for arn in long_arns]
+    assert all(len(name) <= EXECUTION_NAME_LENGTH for name in names)
+    assert names[0] != names[1]
+
+@pytest.fixture
+def replication_ledger(fake, monkeypatch):
+    fake.populate(1, 1)
+    ledger = SQLiteLedger(':memory:')
+    monkeypatch.setattr(src_backup_event, 'LEDGER', ledger)
+    return ledger
+
+def only_snapshot(fake):
+    return next(iter(fake.region(fake_aws.SRC_REGION).cluster_snapshots.values()))
+
+def snapshot_event(snapshot):
+    return {'Records': [{'Sns': {'Message': json.dumps({
+        'Event Source'  : 'db-cluster-snapshot',
+        'Event Message' : 'Automated snapshot created',
+        'Source ID'     : snapshot['DBClusterSnapshotIdentifier']
+    })}}]}
+
+def test_duplicate_events_start_one_replication(fake, replication_ledger):
+    snapshot = only_snapshot(fake)
+    src_backup_event.lambda_handler(snapshot_event(snapshot), None)
+    src_backup_event.lambda_handler(snapshot_event(snapshot), None)
+    assert len(fake.executions) == 1
+    assert replication_ledger.get(snapshot['DBClusterSnapshotArn'])['attempt'] == 1
+
+def test_failed_replication_is_started_again_under_a_new_name(fake, replication_ledger):
+    snapshot = only_snapshot(fake)
+    src_backup_event.lambda_handler(snapshot_event(snapshot), None)
+    replication_ledger.set_state(snapshot['DBClusterSnapshotArn'], LEDGER_FAILED)
+    src_backup_event.lambda_handler(snapshot_event(snapshot), None)
+    assert len(fake.executions) == 2
+    assert replication_ledger.get(snapshot['DBClusterSnapshotArn'])['attempt'] == 2
@@ -0,0 +1,46 @@
+'''
+Copyright 2019  Pinguin AG, Mattis Haase
+
+Licensed under the Apache License, Version 2.0 (the "License").
+'''
+
+import pytest
+
+import src_delete_snapshot
+
+from ledger import LEDGER_COPYING, LEDGER_DONE, LEDGER_FAILED, SQLiteLedger
+
+ARN = 'arn:aws:rds:eu-central-1:123456789012:cluster-snapshot:rds:cluster-{}-2019-06-30-03-00'
+
+def snapshot_event(index):
+    return {
+        'SourceType'       : 'cluster-snapshot',
+        'SourceIdentifier' : 'rds:cluster-{}-2019-06-30-03-00'.format(index),
+        'SourceArn'        : ARN.format(index)
+    }
+
+@pytest.fixture
+def replication_ledger(fake, monkeypatch):
+    ledger = SQLiteLedger(':memory:')
+    monkeypatch.setattr(src_delete_snapshot, 'LEDGER', ledger)
+    return ledger
+
+def test_cleanup_marks_unfinished_replications_failed(fake, replication_ledger):
+    for index in range(3):
+        replication_ledger.claim(ARN.format(index), 3600)
+    replication_ledger.set_state(ARN.format(1), LEDGER_COPYING)
+    replication_ledger.set_state(ARN.format(2), LEDGER_DONE)
+
+    state = {'Snapshots': [snapshot_event(index) for index in range(3)], 'error': {'Error': 'States.TaskFailed'}}
+    assert src_delete_snapshot.lambda_handler({'action': 'cleanup', 'event': state}, None) == {'leftover': []}
+
+    assert replication_ledger.get(ARN.format(0))['state'] == LEDGER_FAILED
+    assert replication_ledger.get(ARN.format(1))['state'] == LEDGER_FAILED
+    assert replication_ledger.get(ARN.format(2))['state'] == LEDGER_DONE
+
+def test_failed_replication_can_be_claimed_again_at_once(fake, replication_ledger):
+    replication_ledger.claim(ARN.format(0), 3600)
+    src_delete_snapshot.lambda_handler({'action': 'cleanup', 'event': snapshot_event(0)}, None)
+    # The attempt goes up, so the next execution gets a new name
+    assert replication_ledger.claim(ARN.format(0), 3600)['attempt'] == 2
+    assert replication_ledger.claim(ARN.format(0), 3600) is None
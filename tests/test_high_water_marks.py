@@ -0,0 +1,97 @@
+'''
+Copyright 2019  Pinguin AG, Mattis Haase
+
+Licensed under the Apache License, Version 2.0 (the "License").
+'''
+
+from datetime import timedelta
+
+import pytest
+
+import fake_aws
+import src_check_aurora_backups
+
+from ledger import SQLiteLedger
+from src_check_aurora_backups import HIGH_WATER_MARKS, advance_marks, mark_of, merge_marks
+
+NEWEST = fake_aws.NEWEST_SNAPSHOT
+
+def snapshot(identifier, create_time):
+    return {'DBClusterSnapshotArn': 'arn:' + identifier, 'SnapshotCreateTime': create_time}
+
+def test_mark_advances_to_the_newest_handled_snapshot():
+    older, newer = snapshot('older', NEWEST - timedelta(days=1)), snapshot('newer', NEWEST)
+    results = [([older, newer], [older['SnapshotCreateTime'], newer['SnapshotCreateTime']])]
+    assert advance_marks([('eu-central-1', 'cluster')], results, [older, newer]) == {'cluster': mark_of(NEWEST)}
+
+def test_mark_stays_behind_unpublished_snapshots():
+    oldest = snapshot('oldest', NEWEST - timedelta(days=2))
+    older = snapshot('older', NEWEST - timedelta(days=1))
+    newer = snapshot('newer', NEWEST)
+    examined = [oldest['SnapshotCreateTime'], older['SnapshotCreateTime'], newer['SnapshotCreateTime']]
+    results = [([older, newer], examined)]
+    assert advance_marks([('eu-central-1', 'cluster')], results, [newer]) == {'cluster': mark_of(oldest['SnapshotCreateTime'])}
+    assert advance_marks([('eu-central-1', 'cluster')], [([oldest], examined[:1])], []) == {}
+
+def test_marks_of_other_regions_are_keyed_by_region():
+    newer = snapshot('newer', NEWEST)
+    results = [([], [newer['SnapshotCreateTime']])]
+    assert advance_marks([('us-east-1', 'cluster')], results, []) == {'us-east-1:cluster': mark_of(NEWEST)}
+
+def test_marks_only_move_forward():
+    marks = {'a': mark_of(NEWEST), 'b': mark_of(NEWEST - timedelta(days=1))}
+    merge_marks(marks, {'a': mark_of(NEWEST - timedelta(days=1)), 'b': mark_of(NEWEST)}, None)
+    assert marks == {'a': mark_of(NEWEST), 'b': mark_of(NEWEST)}
+
+def test_marks_of_vanished_clusters_are_dropped():
+    marks = {'a': mark_of(NEWEST), 'gone': mark_of(NEWEST)}
+    merge_marks(marks, {}, ['a'])
+    assert marks == {'a': mark_of(NEWEST)}
+
+@pytest.fixture
+def marks_ledger(fake, monkeypatch):
+    """A fake with two clusters of ten snapshots, checked into an empty ledger"""
+    fake.populate(2, 10)
+    ledger = SQLiteLedger(':memory:')
+    monkeypatch.setattr(src_check_aurora_backups, 'LEDGER', ledger)
+    return ledger
+
+def check(fake, event=None):
+    """Runs the check, returns the number of published snapshot events"""
+    published = len(fake.messages)
+    src_check_aurora_backups.lambda_handler(event or {}, None)
+    return len(fake.messages) - published
+
+def test_handler_advances_the_marks(fake, marks_ledger):
+    assert check(fake) == 6
+    assert marks_ledger.get_document(HIGH_WATER_MARKS)[0] == {'cluster-0000': mark_of(NEWEST), 'cluster-0001': mark_of(NEWEST)}
+    # Snapshots behind the marks are not even examined again
+    assert check(fake) == 0
+    assert check(fake, {'full_scan': True}) == 0
+
+    created = NEWEST + timedelta(days=1)
+    fake.region(fake_aws.SRC_REGION).add('cluster-snapshot', fake.cluster_snapshot(
+        fake_aws.SRC_REGION, 'rds:cluster-0001-new', 'cluster-0001', created, 'automated'
+    ))
+    assert check(fake) == 1
+    assert marks_ledger.get_document(HIGH_WATER_MARKS)[0]['cluster-0001'] == mark_of(created)
+
+def test_handler_keeps_marks_behind_failed_publishes(fake, marks_ledger, monkeypatch):
+    submit_events = src_check_aurora_backups.submit_events
+    monkeypatch.setattr(src_check_aurora_backups, 'submit_events', lambda events: [])
+    check(fake)
+    assert marks_ledger.get_document(HIGH_WATER_MARKS)[0] == {}
+    # The next check publishes them again
+    monkeypatch.setattr(src_check_aurora_backups, 'submit_events', submit_events)
+    assert check(fake) == 6
+
+def test_marks_skip_the_ledger_but_not_the_listing(fake, marks_ledger, monkeypatch):
+    check(fake)
+    describes = fake.calls['rds.DescribeDBClusterSnapshots']
+    looked_up = []
+    is_replicated = src_check_aurora_backups.is_replicated
+    monkeypatch.setattr(src_check_aurora_backups, 'is_replicated', lambda snapshot: looked_up.append(snapshot) or is_replicated(snapshot))
+    check(fake)
+    # RDS cannot list snapshots by create time
+    assert fake.calls['rds.DescribeDBClusterSnapshots'] == 2 * describes
+    assert looked_up == []
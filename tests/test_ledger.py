@@ -0,0 +1,95 @@
+'''
+Copyright 2019  Pinguin AG, Mattis Haase
+
+Licensed under the Apache License, Version 2.0 (the "License").
+'''
+
+import time
+
+import pytest
+
+from common import SnapshotSharingException
+from ledger import LEDGER_COPYING, LEDGER_DONE, LEDGER_PENDING
+
+ARN = 'arn:aws:rds:eu-central-1:123456789012:cluster-snapshot:rds:cluster-2019-06-30-03-00'
+
+def advance_clock(monkeypatch, seconds):
+    """Lets seconds pass for the ledger"""
+    now = time.time() + seconds
+    monkeypatch.setattr(time, 'time', lambda: now)
+
+def test_claim_is_exclusive(ledger):
+    entry = ledger.claim(ARN, 3600)
+    assert entry['state'] == LEDGER_PENDING
+    assert entry['attempt'] == 1
+    assert ledger.claim(ARN, 3600) is None
+    assert ledger.get(ARN)['state'] == LEDGER_PENDING
+
+def test_released_snapshot_can_be_claimed_again(ledger):
+    ledger.claim(ARN, 3600)
+    ledger.release(ARN)
+    assert ledger.get(ARN) is None
+    assert ledger.claim(ARN, 3600)['attempt'] == 1
+
+def test_stale_replication_is_reclaimed(ledger, monkeypatch):
+    ledger.claim(ARN, 3600)
+    ledger.set_state(ARN, LEDGER_COPYING)
+    assert ledger.claim(ARN, 3600) is None
+    advance_clock(monkeypatch, 3601)
+    entry = ledger.claim(ARN, 3600)
+    assert entry['state'] == LEDGER_PENDING
+    assert entry['attempt'] == 2
+
+def test_done_snapshot_is_never_reclaimed(ledger, monkeypatch):
+    ledger.claim(ARN, 3600)
+    ledger.set_state(ARN, LEDGER_DONE)
+    advance_clock(monkeypatch, 3601)
+    assert ledger.claim(ARN, 3600) is None
+    assert ledger.get(ARN)['state'] == LEDGER_DONE
+
+def test_document_is_only_written_at_the_version_it_was_read(ledger):
+    assert ledger.get_document('doc') == ({}, 0)
+    assert ledger.put_document('doc', {'a': 1}, 0)
+    assert ledger.get_document('doc') == ({'a': 1}, 1)
+    # Another writer stored version 1 in the meantime
+    assert not ledger.put_document('doc', {'a': 2}, 0)
+    assert ledger.get_document('doc') == ({'a': 1}, 1)
+
+def test_update_document_retries_on_conflicts(ledger):
+    ledger.put_document('doc', {'n': 0}, 0)
+    calls = []
+
+    def increment(document):
+        calls.append(dict(document))
+        if len(calls) == 1:
+            # A concurrent writer gets in between reading and writing
+            ledger.put_document('doc', {'n': 10}, 1)
+        document['n'] += 1
+        return document['n']
+
+    assert ledger.update_document('doc', increment) == 11
+    assert calls == [{'n': 0}, {'n': 10}]
+    assert ledger.get_document('doc') == ({'n': 11}, 3)
+
+def test_update_document_gives_up(ledger):
+    def conflict(document):
+        version = ledger.get_document('doc')[1]
+        ledger.put_document('doc', {'n': version}, version)
+        document['changed'] = True
+
+    with pytest.raises(SnapshotSharingException):
+        ledger.update_document('doc', conflict, attempts=3)
+
+def test_unchanged_document_is_not_written(ledger):
+    ledger.put_document('doc', {'a': 1}, 0)
+    assert ledger.update_document('doc', lambda document: 'read') == 'read'
+    assert ledger.get_document('doc') == ({'a': 1}, 1)
+
+def test_collections(ledger):
+    ledger.put_document('waiting:a', {'weight': 1}, 0, collection='waiting')
+    ledger.update_document('waiting:b', lambda document: document.update(weight=2), collection='waiting')
+    ledger.put_document('other', {'weight': 3}, 0)
+    assert ledger.list_documents('waiting') == {'waiting:a': {'weight': 1}, 'waiting:b': {'weight': 2}}
+    ledger.delete_document('waiting:a')
+    assert ledger.list_documents('waiting') == {'waiting:b': {'weight': 2}}
+    assert ledger.get_document('waiting:a') == ({}, 0)
@@ -0,0 +1,84 @@
+'''
+Copyright 2019  Pinguin AG, Mattis Haase
+
+Licensed under the Apache License, Version 2.0 (the "License").
+'''
+
+import pytest
+
+from common import get_client, instrument_handler
+from metrics import MAX_METRIC_VALUES, METRICS, METRICS_NAMESPACE, put_metric
+
+class Throttled(object):
+    """Stands in for the random numbers of the fake, throttles the first request only"""
+
+    def __init__(self):
+        self.requests = 0
+
+    def random(self):
+        self.requests += 1
+        return 0.0 if self.requests == 1 else 1.0
+
+@pytest.fixture
+def records(fake):
+    """The metric records the handlers write to the MemorySink of the fake"""
+    return METRICS.sink.records
+
+def record_of(records, operation=None):
+    matching = [record for record in records if record.get('Operation') == operation]
+    assert len(matching) == 1
+    return matching[0]
+
+def units(record):
+    return dict((metric['Name'], metric['Unit']) for metric in record['_aws']['CloudWatchMetrics'][0]['Metrics'])
+
+@instrument_handler
+def storage_handler(event, context):
+    put_metric('AllocatedStorage', 20, 'Gigabytes')
+    put_metric('AllocatedStorage', 30, 'Gigabytes')
+
+@instrument_handler
+def describe_handler(event, context):
+    get_client('rds').describe_db_cluster_snapshots(SnapshotType='automated')
+
+@instrument_handler
+def failing_handler(event, context):
+    raise ValueError('failed')
+
+@instrument_handler
+def busy_handler(event, context):
+    for value in range(MAX_METRIC_VALUES + 50):
+        put_metric('AllocatedStorage', value, 'Gigabytes')
+
+def test_handler_metrics_are_embedded_metric_format_records(records):
+    storage_handler({}, None)
+    record = record_of(records)
+    metrics = record['_aws']['CloudWatchMetrics'][0]
+    assert metrics['Namespace'] == METRICS_NAMESPACE
+    assert metrics['Dimensions'] == [['Function']]
+    assert units(record) == {'AllocatedStorage': 'Gigabytes', 'Duration': 'Milliseconds', 'Errors': 'Count'}
+    assert record['Function'] == 'test_metrics'
+    assert record['AllocatedStorage'] == [20, 30]
+    assert record['Errors'] == 0
+    assert isinstance(record['_aws']['Timestamp'], int)
+
+def test_failed_invocations_count_as_errors(records):
+    with pytest.raises(ValueError):
+        failing_handler({}, None)
+    assert record_of(records)['Errors'] == 1
+
+def test_api_calls_are_counted_with_their_retries_by_operation(fake, records):
+    fake.throttle_rate = 0.5
+    fake.random = Throttled()
+    describe_handler({}, None)
+    record = record_of(records, 'rds.DescribeDBClusterSnapshots')
+    assert record['_aws']['CloudWatchMetrics'][0]['Dimensions'] == [['Function', 'Operation']]
+    assert record['Function'] == 'test_metrics'
+    assert units(record) == {'Calls': 'Count', 'Latency': 'Milliseconds', 'Retries': 'Count', 'Throttles': 'Count'}
+    assert (record['Calls'], record['Retries'], record['Throttles']) == (1, 1, 1)
+    assert fake.calls['rds.DescribeDBClusterSnapshots'] == 2
+
+def test_values_beyond_the_cloudwatch_limit_go_to_further_records(records):
+    busy_handler({}, None)
+    storage = [record['AllocatedStorage'] for record in records if 'AllocatedStorage' in record]
+    assert storage == [list(range(MAX_METRIC_VALUES)), list(range(MAX_METRIC_VALUES, MAX_METRIC_VALUES + 50))]
@@ -0,0 +1,114 @@
+'''
+Copyright 2019  Pinguin AG, Mattis Haase
+
+Licensed under the Apache License, Version 2.0 (the "License").
+'''
+
+import json
+
+from datetime import datetime, timedelta, timezone
+
+import dst_delete_old_snapshots
+import fake_aws
+
+from dst_delete_old_snapshots import Group, RetentionPolicy, Snapshot, get_snapshots, group_of, plan_retention
+
+NOW = datetime(2019, 6, 30, 12, 0, tzinfo=timezone.utc)
+
+def daily_snapshots(group, days):
+    """One snapshot a day at 03:00, newest first, the newest taken today"""
+    return [
+        Snapshot(
+            'replication-123456789012-rds-{}-{:03d}'.format(group, day),
+            NOW.replace(hour=3) - timedelta(days=day),
+            'cluster'
+        )
+        for day in range(days)
+    ]
+
+def kept(plan):
+    return dict((planned.snapshot.identifier, planned.reason) for planned in plan['keep'])
+
+def deleted(plan):
+    return set(planned.snapshot.identifier for planned in plan['delete'])
+
+def test_keeps_the_last_snapshots():
+    snapshots = daily_snapshots('db', 10)
+    plan = plan_retention({'db': snapshots}, RetentionPolicy(3, 0, 0, 0, 0), NOW)
+    assert kept(plan) == dict((snapshot.identifier, 'last') for snapshot in snapshots[:3])
+    assert deleted(plan) == set(snapshot.identifier for snapshot in snapshots[3:])
+
+def test_keeps_the_newest_snapshot_of_every_period():
+    # 2019-06-30 is a Sunday, so 2019-06-24 starts the week before
+    snapshots = daily_snapshots('db', 70)
+    plan = plan_retention({'db': snapshots}, RetentionPolicy(1, 3, 2, 3, 0), NOW)
+    identifiers = dict((snapshot.create_time.date().isoformat(), snapshot.identifier) for snapshot in snapshots)
+    assert kept(plan) == {
+        identifiers['2019-06-30'] : 'last',
+        identifiers['2019-06-29'] : 'daily',
+        identifiers['2019-06-28'] : 'daily',
+        identifiers['2019-06-23'] : 'weekly',
+        identifiers['2019-05-31'] : 'monthly',
+        identifiers['2019-04-30'] : 'monthly',
+    }
+    assert len(deleted(plan)) == 64
+
+def test_max_age_expires_all_but_the_newest_snapshot():
+    snapshots = daily_snapshots('db', 40)
+    plan = plan_retention({'db': snapshots}, RetentionPolicy(1, 0, 0, 12, 10), NOW)
+    assert kept(plan) == {snapshots[0].identifier: 'last'}
+
+    old = daily_snapshots('db', 40)[20:]
+    plan = plan_retention({'db': old}, RetentionPolicy(3, 0, 0, 0, 10), NOW)
+    assert kept(plan) == {old[0].identifier: 'last'}
+
+def test_plans_every_group_on_its_own():
+    plan = plan_retention(
+        {'a': daily_snapshots('a', 5), 'b': daily_snapshots('b', 2)},
+        RetentionPolicy(2, 0, 0, 0, 0),
+        NOW
+    )
+    assert sorted(kept(plan)) == sorted(snapshot.identifier for snapshot in daily_snapshots('a', 2) + daily_snapshots('b', 2))
+    assert set(planned.group for planned in plan['delete']) == {'a'}
+
+def test_order_of_the_listing_does_not_matter():
+    snapshots = daily_snapshots('db', 20)
+    policy = RetentionPolicy(2, 3, 2, 1, 0)
+    assert kept(plan_retention({'db': list(reversed(snapshots))}, policy, NOW)) == kept(plan_retention({'db': snapshots}, policy, NOW))
+
+def test_dry_run_writes_the_whole_plan_whatever_the_log_level(fake, monkeypatch, capsys):
+    snapshots = daily_snapshots('db', 30)
+    group = Group('cluster', '123456789012', None, 'db')
+    monkeypatch.setattr(dst_delete_old_snapshots, 'get_snapshots', lambda: {group: snapshots})
+    monkeypatch.setattr(dst_delete_old_snapshots, 'POLICY', RetentionPolicy(3, 0, 0, 0, 0))
+    monkeypatch.setattr(dst_delete_old_snapshots, 'DRY_RUN', True)
+    plan = dst_delete_old_snapshots.lambda_handler({}, None)
+    assert len(plan['delete']) == 27
+    written = [json.loads(line) for line in capsys.readouterr().out.splitlines() if 'RetentionPlan' in line]
+    assert written == [{'RetentionPlan': plan}]
+    assert not fake.calls
+
+def test_groups_are_databases_of_one_source_region_and_kind():
+    assert group_of('cluster', 'mydb', 'replication-123456789012-rds-mydb-2019-06-30-03-00') == Group('cluster', '123456789012', None, 'mydb')
+    assert group_of('cluster', 'mydb', 'replication-123456789012-us-east-1-rds-mydb-2019-06-30-03-00') == Group('cluster', '123456789012', 'us-east-1', 'mydb')
+    assert group_of('instance', 'mydb', 'replication-123456789012-us-gov-west-1-rds-mydb-2019-06-30-03-00').region == 'us-gov-west-1'
+
+def test_same_named_databases_of_two_regions_are_planned_apart(fake):
+    region = fake.region(fake_aws.DST_REGION)
+    for day in range(5):
+        create_time = NOW.replace(hour=3) - timedelta(days=day)
+        name = 'rds-mydb-2019-06-{:02d}-03-00'.format(30 - day)
+        for prefix in ('replication-123456789012-', 'replication-123456789012-us-east-1-'):
+            region.add('cluster-snapshot', fake.cluster_snapshot(fake_aws.DST_REGION, prefix + name, 'mydb', create_time, 'manual'))
+        region.add('snapshot', fake.db_snapshot(fake_aws.DST_REGION, 'replication-123456789012-' + name, 'mydb', create_time, 'manual'))
+
+    snapshots = get_snapshots()
+    assert set(snapshots) == {
+        Group('cluster', '123456789012', None, 'mydb'),
+        Group('cluster', '123456789012', 'us-east-1', 'mydb'),
+        Group('instance', '123456789012', None, 'mydb'),
+    }
+    plan = plan_retention(snapshots, RetentionPolicy(2, 1, 0, 0, 0), NOW)
+    for group in snapshots:
+        assert sorted(planned.reason for planned in plan['keep'] if planned.group == group) == ['last', 'last']
+        assert len([planned for planned in plan['delete'] if planned.group == group]) == 3
@@ -0,0 +1,123 @@
+'''
+Copyright 2019  Pinguin AG, Mattis Haase
+
+Licensed under the Apache License, Version 2.0 (the "License").
+'''
+
+import pytest
+
+import src_schedule_copy
+
+from ledger import COPY_QUEUE_WAITING, SQLiteLedger
+from src_schedule_copy import admit, release, wait_seconds
+
+NOW = 1561863600
+
+def waiting_entry(tier=0, size=10, weight=1, enqueued_at=NOW, regions=('eu-west-1',)):
+    return {
+        'tier'        : tier,
+        'size'        : size,
+        'weight'      : weight,
+        'regions'     : list(regions),
+        'enqueued_at' : enqueued_at,
+        'seen_at'     : NOW
+    }
+
+def admitted(queue, waiting, key, now=NOW):
+    """Asks for admission like the handler, which forgets admitted replications"""
+    admission = admit(queue, waiting, key, now)
+    if admission['admitted']:
+        waiting.pop(key, None)
+    return admission
+
+@pytest.fixture(autouse=True)
+def budget(monkeypatch):
+    monkeypatch.setattr(src_schedule_copy, 'COPY_BUDGET', 2)
+
+def test_admits_no_more_than_the_budget():
+    queue, waiting = {}, {key: waiting_entry(enqueued_at=NOW + index) for index, key in enumerate('abc')}
+    assert admitted(queue, waiting, 'a')['admitted']
+    assert admitted(queue, waiting, 'b')['admitted']
+    admission = admitted(queue, waiting, 'c')
+    assert not admission['admitted']
+    assert admission['position'] == 0
+    assert sorted(queue['inflight']) == ['a', 'b']
+
+def test_release_frees_the_slots():
+    queue, waiting = {}, {key: waiting_entry(enqueued_at=NOW + index) for index, key in enumerate('abc')}
+    for key in 'abc':
+        admitted(queue, waiting, key)
+    release(queue, 'a')
+    assert admitted(queue, waiting, 'c')['admitted']
+    assert sorted(queue['inflight']) == ['b', 'c']
+
+def test_admits_by_tier_then_size_then_waiting_time():
+    queue = {'inflight': {'running': {'weight': 2, 'regions': ['eu-west-1'], 'admitted_at': NOW}}}
+    waiting = {
+        'old-large'  : waiting_entry(size=500, enqueued_at=NOW - 60),
+        'new-small'  : waiting_entry(size=5, enqueued_at=NOW),
+        'old-small'  : waiting_entry(size=5, enqueued_at=NOW - 60),
+        'prod-large' : waiting_entry(tier=0, size=900),
+    }
+    for key in ('old-large', 'new-small', 'old-small'):
+        waiting[key]['tier'] = 1
+    positions = dict((key, admitted(queue, waiting, key)['position']) for key in waiting)
+    assert positions == {'prod-large': 0, 'old-small': 1, 'new-small': 2, 'old-large': 3}
+
+def test_overdue_replications_go_ahead_of_smaller_ones():
+    queue = {'inflight': {'running': {'weight': 2, 'regions': ['eu-west-1'], 'admitted_at': NOW}}}
+    overdue = NOW - src_schedule_copy.MAX_QUEUE_HOURS * 3600 - 1
+    waiting = {'small': waiting_entry(size=5), 'overdue': waiting_entry(size=500, enqueued_at=overdue)}
+    assert admitted(queue, waiting, 'overdue')['position'] == 0
+    assert admitted(queue, waiting, 'small')['position'] == 1
+
+def test_slot_is_kept_for_the_replication_ahead():
+    queue = {'inflight': {'running': {'weight': 1, 'regions': ['eu-west-1'], 'admitted_at': NOW}}}
+    waiting = {'first': waiting_entry(size=5), 'second': waiting_entry(size=50)}
+    assert not admitted(queue, waiting, 'second')['admitted']
+    assert admitted(queue, waiting, 'first')['admitted']
+
+def test_batch_larger_than_the_budget_runs_alone():
+    queue, waiting = {}, {'batch': waiting_entry(weight=5), 'single': waiting_entry(enqueued_at=NOW + 1)}
+    assert admitted(queue, waiting, 'batch')['admitted']
+    assert not admitted(queue, waiting, 'single')['admitted']
+    release(queue, 'batch')
+    assert admitted(queue, waiting, 'single')['admitted']
+
+def test_admission_is_repeatable():
+    queue, waiting = {}, {'a': waiting_entry()}
+    assert admitted(queue, waiting, 'a')['admitted']
+    assert admitted(queue, {'a': waiting_entry()}, 'a')['admitted']
+    assert list(queue['inflight']) == ['a']
+
+def test_wait_grows_with_position_and_time_waited():
+    minimum = src_schedule_copy.ADMISSION_MIN_WAIT_SECONDS
+    maximum = src_schedule_copy.ADMISSION_MAX_WAIT_SECONDS
+    entry = waiting_entry()
+    assert wait_seconds(entry, 0, NOW) == minimum
+    assert wait_seconds(entry, 3, NOW) == 4 * minimum
+    assert wait_seconds(entry, 0, NOW + 5 * minimum) == 5 * minimum
+    assert wait_seconds(entry, 1000, NOW) == maximum
+    assert wait_seconds(entry, 0, NOW + 100 * maximum) == maximum
+
+def test_handler_keeps_the_queue_in_the_ledger(monkeypatch):
+    ledger = SQLiteLedger(':memory:')
+    monkeypatch.setattr(src_schedule_copy, 'LEDGER', ledger)
+    monkeypatch.setattr(src_schedule_copy, 'COPY_BUDGET', 1)
+    events = [
+        {
+            'SourceIdentifier' : 'rds:cluster-{}-2019-06-30-03-00'.format(index),
+            'SourceArn'        : 'arn:aws:rds:eu-central-1:123456789012:cluster-snapshot:rds:cluster-{}-2019-06-30-03-00'.format(index)
+        }
+        for index in range(2)
+    ]
+
+    def handle(action, event):
+        return src_schedule_copy.lambda_handler({'action': action, 'event': event}, None)
+
+    assert handle('admit', events[0])['admitted']
+    assert not handle('admit', events[1])['admitted']
+    assert len(ledger.list_documents(COPY_QUEUE_WAITING)) == 1
+    handle('release', events[0])
+    assert handle('admit', events[1])['admitted']
+    assert ledger.list_documents(COPY_QUEUE_WAITING) == {}
@@ -0,0 +1,90 @@
+'''
+Copyright 2019  Pinguin AG, Mattis Haase
+
+Licensed under the Apache License, Version 2.0 (the "License").
+'''
+
+import pytest
+
+import common
+
+from common import get_client, instrument_handler
+from tracing import (
+    SPAN_KIND_CLIENT, SPAN_KIND_PRODUCER, SPAN_KIND_SERVER, STATUS_ERROR,
+    MemoryTraceExporter, set_trace_exporter, trace_replication
+)
+
+@pytest.fixture
+def exporter():
+    exporter = MemoryTraceExporter()
+    previous = set_trace_exporter(exporter)
+    yield exporter
+    set_trace_exporter(previous)
+
+def spans_by_name(exporter):
+    return dict((span['name'], span) for span in exporter.spans)
+
+@instrument_handler
+def describe_handler(event, context):
+    get_client('rds').describe_db_cluster_snapshots(SnapshotType='automated')
+    return {'described': True}
+
+@instrument_handler
+def start_handler(event, context):
+    return trace_replication({'SourceIdentifier': 'rds:cluster-2019-06-30-03-00'})
+
+@instrument_handler
+def failing_handler(event, context):
+    raise ValueError('failed')
+
+def test_api_calls_are_children_of_the_handler_span(fake, exporter):
+    describe_handler({}, None)
+    spans = spans_by_name(exporter)
+    handler = spans['test_tracing']
+    call = spans['rds.DescribeDBClusterSnapshots']
+    assert handler['kind'] == SPAN_KIND_SERVER
+    assert 'parentSpanId' not in handler
+    assert call['kind'] == SPAN_KIND_CLIENT
+    assert call['traceId'] == handler['traceId']
+    assert call['parentSpanId'] == handler['spanId']
+
+def test_step_continues_the_trace_of_the_replication(fake, exporter):
+    execution_input = start_handler({}, None)
+    replication = spans_by_name(exporter)['replication']
+    assert replication['kind'] == SPAN_KIND_PRODUCER
+    assert execution_input['Trace']['trace_id'] == replication['traceId']
+    assert execution_input['Trace']['span_id'] == replication['spanId']
+
+    exporter.spans = []
+    result = describe_handler({'event': execution_input}, None)
+    step = spans_by_name(exporter)['test_tracing']
+    assert step['traceId'] == replication['traceId']
+    assert step['parentSpanId'] == replication['spanId']
+    assert result['Trace']['trace_id'] == replication['traceId']
+    assert result['Trace']['step'] == 'test_tracing'
+
+def test_failed_handler_span_has_error_status(fake, exporter):
+    with pytest.raises(ValueError):
+        failing_handler({}, None)
+    assert spans_by_name(exporter)['test_tracing']['status'] == {'code': STATUS_ERROR, 'message': 'failed'}
+
+def test_exporter_errors_do_not_fail_the_handler(fake):
+    class BrokenExporter(object):
+        def export(self, request):
+            raise IOError('collector unreachable')
+
+    previous = set_trace_exporter(BrokenExporter())
+    try:
+        assert describe_handler({}, None) == {'described': True}
+    finally:
+        set_trace_exporter(previous)
+
+def test_nothing_is_traced_without_an_exporter(fake):
+    previous = set_trace_exporter(None)
+    try:
+        execution_input = {'SourceIdentifier': 'rds:cluster-2019-06-30-03-00'}
+        assert start_handler({}, None) == execution_input
+        assert 'Trace' not in describe_handler({}, None)
+        assert common.TRACER.spans == []
+    finally:
+        set_trace_exporter(previous)
@@ -0,0 +1,73 @@
+'''
+Copyright 2019  Pinguin AG, Mattis Haase
+
+Licensed under the Apache License, Version 2.0 (the "License").
+'''
+
+# audit_replication.py
+# Runs the audit of src_audit_replication locally with the AWS credentials of
+# the environment, which have to be allowed to describe the snapshots of the
+# source account and to assume the roles of the destinations. Prints the JSON
+# report, or writes it to a file, and exits with 1 if a database lags behind.
+#
+# Usage: python tools/audit_replication.py --src-account ID --src-region R
+#            --dst-account ID --dst-region R --dst-role ARN [--pattern P]
+#            [--destinations JSON] [--max-lag-hours N]
+#            [--copy-timeout-hours N] [--incremental] [--output FILE]
+
+import argparse
+import json
+import os
+import sys
+
+from datetime import datetime, timezone
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+
+def main():
+    parser = argparse.ArgumentParser(description='Reports replication lag, missing copies and stuck intermediate copies')
+    parser.add_argument('--src-account', required=True, help='source account id')
+    parser.add_argument('--src-region', required=True, help='source region')
+    parser.add_argument('--dst-account', help='destination account id')
+    parser.add_argument('--dst-region', help='destination region')
+    parser.add_argument('--dst-role', help='role of the destination account to assume')
+    parser.add_argument('--destinations', default='', help='all destinations as JSON list of {account_id, region, role_arn}')
+    parser.add_argument('--pattern', default='.*', help='regex of the replicated snapshots')
+    parser.add_argument('--max-lag-hours', type=int, default=26, help='lag after which a database is reported as lagging')
+    parser.add_argument('--copy-timeout-hours', type=int, default=72, help='age after which an intermediate copy is stuck')
+    parser.add_argument('--incremental', action='store_true', help='the replication keeps the newest intermediate copies')
+    parser.add_argument('--output', help='file to write the report to instead of stdout')
+    arguments = parser.parse_args()
+    if not arguments.destinations and not (arguments.dst_account and arguments.dst_region and arguments.dst_role):
+        parser.error('either --destinations or --dst-account, --dst-region and --dst-role are required')
+
+    os.environ.update({
+        'DESTINATIONS'       : arguments.destinations,
+        'DST_ACCOUNT'        : arguments.dst_account or '',
+        'DST_ARN'            : arguments.dst_role or '',
+        'DST_REGION'         : arguments.dst_region or '',
+        'COPY_TIMEOUT_HOURS' : str(arguments.copy_timeout_hours),
+        'INCREMENTAL'        : str(arguments.incremental).lower(),
+        'MAX_LAG_HOURS'      : str(arguments.max_lag_hours),
+        'PATTERN'            : arguments.pattern,
+        'SRC_ACCOUNT'        : arguments.src_account,
+        'SRC_REGION'         : arguments.src_region,
+    })
+    os.environ.setdefault('LOGLEVEL', 'WARNING')
+
+    # Imported once the environment is set, the handler reads it on import
+    import src_audit_replication
+
+    report = src_audit_replication.audit(datetime.now(timezone.utc))
+    if arguments.output:
+        with open(arguments.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    print(json.dumps(report['summary']), file=sys.stderr)
+    sys.exit(1 if report['summary']['lagging'] else 0)
+
+if __name__ == '__main__':
+    main()
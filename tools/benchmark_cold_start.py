@@ -0,0 +1,224 @@
+'''
+Copyright 2019  Pinguin AG, Mattis Haase
+
+Licensed under the Apache License, Version 2.0 (the "License").
+'''
+
+# benchmark_cold_start.py
+# Measures how long every lambda function takes to import, to handle its first
+# event and to handle a second event in the same container. Every run starts a
+# fresh python process, like a cold Lambda container, and all AWS calls go to a
+# local stub endpoint, so no AWS account is needed.
+#
+# Usage: python tools/benchmark_cold_start.py [--runs N] [handler ...]
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+ACCOUNT    = '123456789012'
+SRC_REGION = 'eu-central-1'
+DST_REGION = 'eu-west-1'
+
+ENVIRONMENT = {
+    'AWS_ACCESS_KEY_ID'     : 'AKIABENCHMARK',
+    'AWS_SECRET_ACCESS_KEY' : 'benchmark',
+    'AWS_DEFAULT_REGION'    : SRC_REGION,
+    'BACKUP_LAST_N'         : '3',
+    'DST_ACCOUNT'           : ACCOUNT,
+    'DST_ARN'               : 'arn:aws:iam::{}:role/benchmark'.format(ACCOUNT),
+    'DST_REGION'            : DST_REGION,
+    'LOGLEVEL'              : 'ERROR',
+    'PATTERN'               : '.*',
+    'REGION'                : SRC_REGION,
+    'RETENTION'             : '7',
+    'SNS_TOPIC_ARN'         : 'arn:aws:sns:{}:{}:rds_snapshots'.format(SRC_REGION, ACCOUNT),
+    'SRC_ACCOUNT'           : ACCOUNT,
+    'SRC_REGION'            : SRC_REGION,
+    'STATE_MACHINE_ARN'     : 'arn:aws:states:{}:{}:stateMachine:rds_snapshot_sharing'.format(SRC_REGION, ACCOUNT),
+}
+
+SNAPSHOT = {
+    'SourceType'       : 'db-snapshot',
+    'SourceIdentifier' : 'rds:db-2019-01-01-00-00',
+    'SourceArn'        : 'arn:aws:rds:{}:{}:snapshot:rds:db-2019-01-01-00-00'.format(SRC_REGION, ACCOUNT),
+    'local_copy_snapshot_identifier' : 'rds-replication-rds-db-2019-01-01-00-00',
+    'dst_snapshot_identifier'        : 'replication-{}-rds-db-2019-01-01-00-00'.format(ACCOUNT),
+}
+
+EVENTS = {
+    # Announces the snapshot every describe call of the stub returns
+    'src_backup_event' : {
+        'Records': [{'Sns': {'Message': json.dumps({
+            'Event Source'  : 'db-snapshot',
+            'Event Message' : 'Automated snapshot created',
+            'Source ID'     : 'replication-{}-db'.format(ACCOUNT)
+        })}}]
+    },
+    'src_audit_replication'    : {},
+    'src_backfill_snapshots'   : {'since': '2019-01-01'},
+    'src_check_aurora_backups' : {},
+    'src_schedule_copy'        : {'action': 'admit', 'event': SNAPSHOT},
+    'src_copy_snapshot'        : SNAPSHOT,
+    'src_check_copy_status'    : {'snapshot': 'local_copy', 'event': SNAPSHOT},
+    'src_share_snapshot'       : SNAPSHOT,
+    'dst_copy_snapshot'        : SNAPSHOT,
+    'src_delete_snapshot'      : SNAPSHOT,
+    'src_dispatcher'           : {'Stage': 'src_copy_snapshot', 'Input': SNAPSHOT},
+    'dst_delete_old_snapshots' : {},
+}
+
+# Environment variables which only some handlers need
+HANDLER_ENVIRONMENT = {
+    # A backfill keeps its checkpoint in the ledger
+    'src_backfill_snapshots' : {'LEDGER': 'sqlite://:memory:'},
+}
+
+DB_SNAPSHOT = '''<DBSnapshot>
+  <DBSnapshotIdentifier>replication-{account}-db</DBSnapshotIdentifier>
+  <DBInstanceIdentifier>db</DBInstanceIdentifier>
+  <DBSnapshotArn>arn:aws:rds:{region}:{account}:snapshot:replication-{account}-db</DBSnapshotArn>
+  <SnapshotCreateTime>2019-01-01T00:00:00Z</SnapshotCreateTime>
+  <Status>available</Status>
+  <PercentProgress>100</PercentProgress>
+  <TagList/>
+</DBSnapshot>'''.format(account=ACCOUNT, region=SRC_REGION)
+
+DB_CLUSTER_SNAPSHOT = '''<DBClusterSnapshot>
+  <DBClusterSnapshotIdentifier>replication-{account}-cluster</DBClusterSnapshotIdentifier>
+  <DBClusterIdentifier>cluster</DBClusterIdentifier>
+  <DBClusterSnapshotArn>arn:aws:rds:{region}:{account}:cluster-snapshot:replication-{account}-cluster</DBClusterSnapshotArn>
+  <SnapshotCreateTime>2019-01-01T00:00:00Z</SnapshotCreateTime>
+  <Status>available</Status>
+  <PercentProgress>100</PercentProgress>
+  <TagList/>
+</DBClusterSnapshot>'''.format(account=ACCOUNT, region=SRC_REGION)
+
+# Result elements of the query API actions the handlers call, everything else
+# gets an empty result
+QUERY_RESULTS = {
+    'AssumeRole'                 : '''<Credentials>
+  <AccessKeyId>ASIABENCHMARK</AccessKeyId>
+  <SecretAccessKey>benchmark</SecretAccessKey>
+  <SessionToken>benchmark</SessionToken>
+  <Expiration>2099-01-01T00:00:00Z</Expiration>
+</Credentials>''',
+    'CopyDBClusterSnapshot'      : DB_CLUSTER_SNAPSHOT,
+    'CopyDBSnapshot'             : DB_SNAPSHOT,
+    'DescribeDBClusters'         : '<DBClusters><DBCluster><DBClusterIdentifier>cluster</DBClusterIdentifier></DBCluster></DBClusters>',
+    'DescribeDBClusterSnapshots' : '<DBClusterSnapshots>{}</DBClusterSnapshots>'.format(DB_CLUSTER_SNAPSHOT),
+    'DescribeDBSnapshots'        : '<DBSnapshots>{}</DBSnapshots>'.format(DB_SNAPSHOT),
+    'PublishBatch'               : '<Successful><member><Id>0</Id><MessageId>1</MessageId></member></Successful><Failed/>',
+}
+
+# Responses of the JSON API actions the handlers call
+JSON_RESULTS = {
+    'StartExecution' : {
+        'executionArn' : 'arn:aws:states:{}:{}:execution:rds_snapshot_sharing:1'.format(SRC_REGION, ACCOUNT),
+        'startDate'    : 1546300800
+    },
+}
+
+# Runs in the fresh python process
+CHILD = '''
+import json
+import sys
+import time
+
+started = time.perf_counter()
+module = __import__(sys.argv[1])
+imported = time.perf_counter()
+module.lambda_handler(json.loads(sys.argv[2]), None)
+first = time.perf_counter()
+module.lambda_handler(json.loads(sys.argv[2]), None)
+second = time.perf_counter()
+print(json.dumps({
+    'import' : imported - started,
+    'first'  : first - imported,
+    'warm'   : second - first
+}))
+'''
+
+class StubEndpoint(BaseHTTPRequestHandler):
+    """Answers AWS query and JSON API requests with canned responses"""
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+        target = self.headers.get('X-Amz-Target')
+        if target:
+            action = target.split('.')[-1]
+            payload = json.dumps(JSON_RESULTS.get(action, {}))
+            content_type = 'application/x-amz-json-1.0'
+        else:
+            action = parse_qs(body)['Action'][0]
+            payload = '<{0}Response><{0}Result>{1}</{0}Result></{0}Response>'.format(
+                action,
+                QUERY_RESULTS.get(action, '')
+            )
+            content_type = 'text/xml'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload.encode())
+
+    def log_message(self, format, *args):
+        pass
+
+def measure(handler, endpoint_url):
+    """Runs a handler once in a fresh python process
+
+    Arguments:
+        handler {str} -- module name of the handler
+        endpoint_url {str} -- URL of the stub endpoint
+
+    Returns:
+        dict -- import, first and warm durations in seconds
+    """
+    environment = dict(os.environ, **ENVIRONMENT)
+    environment.update(HANDLER_ENVIRONMENT.get(handler, {}))
+    environment['AWS_ENDPOINT_URL'] = endpoint_url
+    environment['PYTHONPATH'] = SRC
+    result = subprocess.run(
+        [sys.executable, '-c', CHILD, handler, json.dumps(EVENTS[handler])],
+        env                = environment,
+        stdout             = subprocess.PIPE,
+        stderr             = subprocess.PIPE,
+        universal_newlines = True
+    )
+    if result.returncode:
+        raise RuntimeError('{} failed:\n{}'.format(handler, result.stderr))
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold start benchmark of the lambda functions')
+    parser.add_argument('--runs', type=int, default=5, help='cold starts per handler')
+    parser.add_argument('handlers', nargs='*', default=sorted(EVENTS), help='handlers to benchmark')
+    arguments = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubEndpoint)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint_url = 'http://127.0.0.1:{}'.format(server.server_port)
+
+    print('{:<26} {:>10} {:>10} {:>10}'.format('handler', 'import ms', 'first ms', 'warm ms'))
+    for handler in arguments.handlers:
+        runs = [measure(handler, endpoint_url) for _ in range(arguments.runs)]
+        print('{:<26} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+            handler,
+            statistics.median(run['import'] for run in runs) * 1000,
+            statistics.median(run['first'] for run in runs) * 1000,
+            statistics.median(run['warm'] for run in runs) * 1000
+        ))
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
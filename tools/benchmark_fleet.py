@@ -0,0 +1,186 @@
+'''
+Copyright 2019  Pinguin AG, Mattis Haase
+
+Licensed under the Apache License, Version 2.0 (the "License").
+'''
+
+# benchmark_fleet.py
+# Runs the lambda functions in process against the fake AWS of fake_aws.py
+# with a fleet of the given size, and reports wall time, API calls by
+# operation and peak memory of every handler. Wall time is measured in one
+# pass and peak memory in a second one with tracemalloc, which slows python
+# down considerably.
+#
+# Usage: python tools/benchmark_fleet.py [--clusters N] [--snapshots N]
+#            [--latency MS] [--throttle-rate R] [--rate-limits L]
+#            [--ledger URL] [handler ...]
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+
+from benchmark_cold_start import ENVIRONMENT, SRC_REGION
+
+# Environment variables which differ between the lambda functions, as set by
+# src_lambda.tf
+HANDLER_ENVIRONMENT = {}
+
+# The replication pipeline, every step gets the result of the previous one and
+# the copy checks store theirs in copy_status, like the step function does
+PIPELINE = (
+    ('src_copy_snapshot', None),
+    ('src_check_copy_status', 'local_copy'),
+    ('src_share_snapshot', None),
+    ('dst_copy_snapshot', None),
+    ('src_check_copy_status', 'dst_copy'),
+    ('src_delete_snapshot', None),
+)
+
+HANDLERS = ['src_check_aurora_backups', 'dst_delete_old_snapshots', 'src_audit_replication', 'src_backup_event', 'pipeline']
+
+def load_handler(name):
+    """Imports a handler module with its environment
+
+    Arguments:
+        name {str} -- module name of the handler
+
+    Returns:
+        module -- handler module
+    """
+    if name not in sys.modules:
+        environment = dict(os.environ)
+        os.environ.update(HANDLER_ENVIRONMENT.get(name, {}))
+        __import__(name)
+        os.environ.clear()
+        os.environ.update(environment)
+    return sys.modules[name]
+
+def run_handler(module, event, fake, traced):
+    """Runs a single handler and measures it
+
+    Arguments:
+        module {module} -- handler module
+        event {dict} -- Lambda event object
+        fake {FakeAWS} -- fake AWS the handler talks to
+        traced {bool} -- measure peak memory instead of wall time
+
+    Returns:
+        tuple -- result of the handler, dict of measurements
+    """
+    fake.calls.clear()
+    fake.throttles.clear()
+    if traced:
+        tracemalloc.start()
+    started = time.perf_counter()
+    result = module.lambda_handler(event, None)
+    elapsed = time.perf_counter() - started
+    measurement = {
+        'calls'     : dict(fake.calls),
+        'throttles' : sum(fake.throttles.values())
+    }
+    if traced:
+        measurement['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    else:
+        measurement['seconds'] = elapsed
+    return result, measurement
+
+def run_suite(handlers, arguments, fake, traced):
+    """Runs the handlers against a freshly populated fleet
+
+    Returns:
+        list -- (name, measurement) tuples
+    """
+    import common
+    results = []
+    for handler in handlers:
+        fake.reset()
+        fake.populate(arguments.clusters, arguments.snapshots, replicated_tag='rds-replication-replicated')
+        if handler == 'pipeline':
+            snapshot = next(iter(fake.region(SRC_REGION).cluster_snapshots.values()))
+            event = common.trace_replication({
+                'SourceType'       : 'db-cluster-snapshot',
+                'SourceIdentifier' : snapshot['DBClusterSnapshotIdentifier'],
+                'SourceArn'        : snapshot['DBClusterSnapshotArn'],
+                'Snapshot'         : common.snapshot_descriptor(snapshot)._asdict()
+            })
+            for step, copy in PIPELINE:
+                step_event = event
+                if copy:
+                    step_event = {'snapshot': copy, 'event': event}
+                result, measurement = run_handler(load_handler(step), step_event, fake, traced)
+                if copy:
+                    event = dict(event, copy_status=result)
+                else:
+                    event = result
+                results.append(('  ' + step, measurement))
+            continue
+        event = {}
+        if handler == 'src_backup_event':
+            snapshot = next(iter(fake.region(SRC_REGION).cluster_snapshots.values()))
+            event = {'Records': [{'Sns': {'Message': json.dumps({
+                'Event Source'  : 'db-cluster-snapshot',
+                'Event Message' : 'Automated snapshot created',
+                'Source ID'     : snapshot['DBClusterSnapshotIdentifier']
+            })}}]}
+        results.append((handler, run_handler(load_handler(handler), event, fake, traced)[1]))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Fleet scale benchmark of the lambda functions')
+    parser.add_argument('--clusters', type=int, default=500, help='Aurora clusters of the fleet')
+    parser.add_argument('--snapshots', type=int, default=20000, help='automated snapshots of the fleet')
+    parser.add_argument('--latency', type=float, default=20, help='milliseconds every API call takes')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of API calls that are throttled')
+    parser.add_argument('--rate-limits', default=None, help='API_RATE_LIMITS of the handlers, e.g. "rds=50"')
+    parser.add_argument('--ledger', default='', help='replication ledger, e.g. "sqlite://:memory:"')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random throttling')
+    parser.add_argument('handlers', nargs='*', default=HANDLERS, help='handlers to benchmark, pipeline runs all replication steps')
+    arguments = parser.parse_args()
+
+    os.environ.update(ENVIRONMENT)
+    os.environ.pop('AWS_ENDPOINT_URL', None)
+    os.environ['LEDGER'] = arguments.ledger
+    if arguments.rate_limits is not None:
+        os.environ['API_RATE_LIMITS'] = arguments.rate_limits
+
+    # Imported once the environment is set, handlers read it on import
+    import common
+    import fake_aws
+
+    fake = fake_aws.FakeAWS(
+        latency       = arguments.latency / 1000,
+        throttle_rate = arguments.throttle_rate,
+        seed          = arguments.seed
+    )
+    common.set_client_factory(fake.client_factory)
+    common.set_metrics_sink(common.MemorySink())
+
+    timed = run_suite(arguments.handlers, arguments, fake, traced=False)
+    traced = run_suite(arguments.handlers, arguments, fake, traced=True)
+
+    print('{} clusters, {} snapshots, {:g} ms latency, {:g} throttle rate'.format(
+        arguments.clusters, arguments.snapshots, arguments.latency, arguments.throttle_rate
+    ))
+    print('{:<28} {:>10} {:>8} {:>10} {:>10}'.format('handler', 'wall ms', 'calls', 'throttled', 'peak MB'))
+    for (name, timing), (_, memory) in zip(timed, traced):
+        print('{:<28} {:>10.1f} {:>8} {:>10} {:>10.1f}'.format(
+            name,
+            timing['seconds'] * 1000,
+            sum(timing['calls'].values()),
+            timing['throttles'],
+            memory['peak_bytes'] / 1024 / 1024
+        ))
+    print('\nAPI calls by operation')
+    for name, timing in timed:
+        for operation, count in sorted(timing['calls'].items()):
+            print('{:<28} {:<40} {:>8}'.format(name, operation, count))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,450 @@
+'''
+Copyright 2019  Pinguin AG, Mattis Haase
+
+Licensed under the Apache License, Version 2.0 (the "License").
+'''
+
+# fake_aws.py
+# In-process stand-in for the RDS, SNS, STS and Step Functions calls of the
+# lambda functions. The handlers keep using real boto3 clients: a botocore
+# before-send hook answers every request from an in-memory fleet instead of
+# sending it, so request serialization, response parsing, retries, rate
+# limiting and metrics all run as they would against AWS.
+#
+# Usage:
+#   fake = FakeAWS(latency=0.02, throttle_rate=0.01)
+#   fake.populate(clusters=500, snapshots=20000)
+#   common.set_client_factory(fake.client_factory)
+
+import json
+import random
+import threading
+import time
+import uuid
+
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from xml.sax.saxutils import escape
+
+import common
+
+from botocore.awsrequest import AWSResponse
+
+ACCOUNT    = '123456789012'
+SRC_REGION = 'eu-central-1'
+DST_REGION = 'eu-west-1'
+
+# Error codes of a throttled request by service
+THROTTLING_CODES = {
+    'rds'           : 'Throttling',
+    'sns'           : 'Throttling',
+    'sts'           : 'Throttling',
+    'stepfunctions' : 'ThrottlingException',
+}
+
+# The newest snapshot of the generated fleet
+NEWEST_SNAPSHOT = datetime(2019, 6, 30, 3, 0, tzinfo=timezone.utc)
+
+class FakeError(Exception):
+    """An API error returned to the client"""
+
+    def __init__(self, code, message=''):
+        super(FakeError, self).__init__(code)
+        self.code    = code
+        self.message = message
+
+class RawBody(object):
+    """Raw response body as botocore reads it"""
+
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+# Collection, identifier and parent key of the snapshots of each ARN type
+SNAPSHOT_KINDS = {
+    'cluster-snapshot' : ('cluster_snapshots', 'DBClusterSnapshotIdentifier', 'DBClusterIdentifier'),
+    'snapshot'         : ('db_snapshots', 'DBSnapshotIdentifier', 'DBInstanceIdentifier'),
+}
+
+class Region(object):
+    """Snapshots, clusters and tags of one region of an account
+
+    Snapshots are also indexed by cluster or instance, so that describe calls
+    of a large fleet do not have to scan all snapshots.
+    """
+
+    def __init__(self, name, account=ACCOUNT):
+        self.name              = name
+        self.account           = account
+        self.clusters          = {}
+        self.cluster_snapshots = {}
+        self.db_snapshots      = {}
+        self.by_parent         = {}
+        self.tags              = {}
+        self.shared            = {}
+
+    def add(self, kind, snapshot):
+        collection, identifier_key, parent_key = SNAPSHOT_KINDS[kind]
+        getattr(self, collection)[snapshot[identifier_key]] = snapshot
+        self.by_parent.setdefault((kind, snapshot[parent_key]), {})[snapshot[identifier_key]] = snapshot
+
+    def remove(self, kind, identifier):
+        collection, _, parent_key = SNAPSHOT_KINDS[kind]
+        snapshot = getattr(self, collection).pop(identifier)
+        del self.by_parent[(kind, snapshot[parent_key])][identifier]
+        return snapshot
+
+class FakeAWS(object):
+    """In-memory RDS, SNS, STS and Step Functions of all regions and accounts
+
+    Clients created with a role work on the account of the role, all others
+    on ACCOUNT.
+
+    Arguments:
+        latency {float} -- seconds every request takes
+        throttle_rate {float} -- share of requests answered with a throttling error
+        seed {int} -- seed of the random throttling
+    """
+
+    def __init__(self, latency=0.0, throttle_rate=0.0, seed=0):
+        self.latency       = latency
+        self.throttle_rate = throttle_rate
+        self.random        = random.Random(seed)
+        self.lock          = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        """Forgets all resources and counters"""
+        with self.lock:
+            self.regions    = {}
+            self.executions = {}
+            self.messages   = []
+            self.calls      = Counter()
+            self.throttles  = Counter()
+
+    def region(self, name, account=ACCOUNT):
+        with self.lock:
+            if (account, name) not in self.regions:
+                self.regions[(account, name)] = Region(name, account)
+            return self.regions[(account, name)]
+
+    def populate(self, clusters, snapshots, src_region=SRC_REGION, dst_region=DST_REGION, replicated_tag=None):
+        """Creates a fleet of Aurora clusters with daily automated snapshots
+
+        The automated snapshots are spread evenly over the clusters, one per
+        day. For every one of them the destination region gets the replicated
+        snapshot the replication would have left behind, half of them of DB
+        instances and half of DB clusters.
+
+        Arguments:
+            clusters {int} -- number of clusters
+            snapshots {int} -- number of automated snapshots
+            src_region {str} -- region of the clusters
+            dst_region {str} -- region of the replicated snapshots
+            replicated_tag {str} -- tag key of already replicated snapshots, if
+                every second snapshot should carry it
+        """
+        source = self.region(src_region)
+        destination = self.region(dst_region)
+        for index in range(clusters):
+            identifier = 'cluster-{:04d}'.format(index)
+            source.clusters[identifier] = {
+                'DBClusterIdentifier' : identifier,
+                'DBClusterArn'        : self.arn(src_region, 'cluster', identifier),
+                'Engine'              : 'aurora-postgresql',
+                'Status'              : 'available'
+            }
+        for index in range(snapshots):
+            cluster = 'cluster-{:04d}'.format(index % max(clusters, 1))
+            create_time = NEWEST_SNAPSHOT - timedelta(days=index // max(clusters, 1))
+            identifier = 'rds:{}-{}'.format(cluster, create_time.strftime('%Y-%m-%d-%H-%M'))
+            snapshot = self.cluster_snapshot(src_region, identifier, cluster, create_time, 'automated')
+            if replicated_tag and index % 2:
+                snapshot['TagList'].append({'Key': replicated_tag, 'Value': 'true'})
+            source.add('cluster-snapshot', snapshot)
+
+            replica = 'replication-{}-{}'.format(ACCOUNT, identifier.replace(':', '-'))
+            if index % 2:
+                destination.add('cluster-snapshot', self.cluster_snapshot(
+                    dst_region, replica, cluster, create_time, 'manual'
+                ))
+            else:
+                replica = replica.replace('cluster', 'db')
+                destination.add('snapshot', self.db_snapshot(
+                    dst_region, replica, cluster.replace('cluster', 'db'), create_time, 'manual'
+                ))
+
+    def arn(self, region, kind, identifier, account=ACCOUNT):
+        return 'arn:aws:rds:{}:{}:{}:{}'.format(region, account, kind, identifier)
+
+    def cluster_snapshot(self, region, identifier, cluster, create_time, snapshot_type, account=ACCOUNT):
+        return {
+            'DBClusterSnapshotIdentifier' : identifier,
+            'DBClusterIdentifier'         : cluster,
+            'DBClusterSnapshotArn'        : self.arn(region, 'cluster-snapshot', identifier, account),
+            'SnapshotCreateTime'          : create_time,
+            'Engine'                      : 'aurora-postgresql',
+            'AllocatedStorage'            : 100,
+            'Status'                      : 'available',
+            'PercentProgress'             : 100,
+            'SnapshotType'                : snapshot_type,
+            'StorageEncrypted'            : False,
+            'TagList'                     : []
+        }
+
+    def db_snapshot(self, region, identifier, instance, create_time, snapshot_type, account=ACCOUNT):
+        return {
+            'DBSnapshotIdentifier' : identifier,
+            'DBInstanceIdentifier' : instance,
+            'DBSnapshotArn'        : self.arn(region, 'snapshot', identifier, account),
+            'SnapshotCreateTime'   : create_time,
+            'Engine'               : 'postgres',
+            'AllocatedStorage'     : 100,
+            'Status'               : 'available',
+            'PercentProgress'      : 100,
+            'SnapshotType'         : snapshot_type,
+            'Encrypted'            : False,
+            'TagList'              : []
+        }
+
+    def client_factory(self, service, region_name=None, role_arn=None):
+        """Creates a boto3 client answered by this fake, see common.set_client_factory"""
+        client = common.create_client(service, region_name, role_arn)
+        region = region_name or client.meta.region_name
+        account = ACCOUNT
+        if role_arn:
+            account = role_arn.split(':')[4]
+
+        def keep_params(params=None, model=None, context=None, **kwargs):
+            context['fake_operation'] = model.name
+            context['fake_params']    = dict(params)
+
+        def answer(request=None, **kwargs):
+            return self.respond(service, region, account, client.meta.service_model, request)
+
+        client.meta.events.register('before-parameter-build', keep_params)
+        client.meta.events.register_last('before-send', answer)
+        return client
+
+    def respond(self, service, region, account, service_model, request):
+        """Answers a single request like the AWS API would"""
+        operation = service_model.operation_model(request.context['fake_operation'])
+        params = request.context['fake_params']
+        key = '{}.{}'.format(service, operation.name)
+        with self.lock:
+            self.calls[key] += 1
+            throttled = self.random.random() < self.throttle_rate
+            if throttled:
+                self.throttles[key] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        try:
+            if throttled:
+                raise FakeError(THROTTLING_CODES.get(service, 'Throttling'), 'Rate exceeded')
+            with self.lock:
+                result = getattr(self, operation.name)(self.region(region, account), params)
+            status, body = 200, self._serialize(service_model, operation, result)
+        except FakeError as e:
+            status, body = 400, self._serialize_error(service_model, e)
+        content_type = 'text/xml'
+        if service_model.protocol == 'json':
+            content_type = 'application/x-amz-json-1.0'
+        return AWSResponse(request.url, status, {'Content-Type': content_type}, RawBody(body.encode()))
+
+    def _serialize(self, service_model, operation, result):
+        if service_model.protocol == 'json':
+            return json.dumps(result, default=_epoch)
+        shape = operation.output_shape
+        wrapper = shape.serialization.get('resultWrapper', operation.name + 'Result') if shape else None
+        inner = ''
+        if shape:
+            inner = '<{0}>{1}</{0}>'.format(wrapper, _members_xml(shape, result))
+        return '<{0}Response>{1}<ResponseMetadata><RequestId>{2}</RequestId></ResponseMetadata></{0}Response>'.format(
+            operation.name, inner, uuid.uuid4()
+        )
+
+    def _serialize_error(self, service_model, error):
+        if service_model.protocol == 'json':
+            return json.dumps({'__type': error.code, 'message': error.message})
+        return '<ErrorResponse><Error><Type>Sender</Type><Code>{}</Code><Message>{}</Message></Error></ErrorResponse>'.format(
+            error.code, escape(error.message)
+        )
+
+    # RDS
+
+    def DescribeDBClusters(self, region, params):
+        return _page(list(region.clusters.values()), 'DBClusters', params)
+
+    def DescribeDBClusterSnapshots(self, region, params):
+        snapshots = _describe(region, 'cluster-snapshot', params, 'DBClusterSnapshotNotFoundFault')
+        return _page(snapshots, 'DBClusterSnapshots', params)
+
+    def DescribeDBSnapshots(self, region, params):
+        snapshots = _describe(region, 'snapshot', params, 'DBSnapshotNotFound')
+        return _page(snapshots, 'DBSnapshots', params)
+
+    def CopyDBClusterSnapshot(self, region, params):
+        source = self._find(params['SourceDBClusterSnapshotIdentifier'], region, 'cluster_snapshots', 'DBClusterSnapshotNotFoundFault', region.account)
+        target = params['TargetDBClusterSnapshotIdentifier']
+        if target in region.cluster_snapshots:
+            raise FakeError('DBClusterSnapshotAlreadyExistsFault', target)
+        copy = self.cluster_snapshot(region.name, target, source['DBClusterIdentifier'], datetime.now(timezone.utc), 'manual', region.account)
+        region.add('cluster-snapshot', copy)
+        return {'DBClusterSnapshot': copy}
+
+    def CopyDBSnapshot(self, region, params):
+        source = self._find(params['SourceDBSnapshotIdentifier'], region, 'db_snapshots', 'DBSnapshotNotFound', region.account)
+        target = params['TargetDBSnapshotIdentifier']
+        if target in region.db_snapshots:
+            raise FakeError('DBSnapshotAlreadyExists', target)
+        copy = self.db_snapshot(region.name, target, source['DBInstanceIdentifier'], datetime.now(timezone.utc), 'manual', region.account)
+        region.add('snapshot', copy)
+        return {'DBSnapshot': copy}
+
+    def DeleteDBClusterSnapshot(self, region, params):
+        identifier = params['DBClusterSnapshotIdentifier']
+        if identifier not in region.cluster_snapshots:
+            raise FakeError('DBClusterSnapshotNotFoundFault', identifier)
+        return {'DBClusterSnapshot': region.remove('cluster-snapshot', identifier)}
+
+    def DeleteDBSnapshot(self, region, params):
+        identifier = params['DBSnapshotIdentifier']
+        if identifier not in region.db_snapshots:
+            raise FakeError('DBSnapshotNotFound', identifier)
+        return {'DBSnapshot': region.remove('snapshot', identifier)}
+
+    def ModifyDBClusterSnapshotAttribute(self, region, params):
+        identifier = params['DBClusterSnapshotIdentifier']
+        self._find(identifier, region, 'cluster_snapshots', 'DBClusterSnapshotNotFoundFault')
+        region.shared.setdefault(identifier, set()).update(params.get('ValuesToAdd') or [])
+        return {'DBClusterSnapshotAttributesResult': {'DBClusterSnapshotIdentifier': identifier}}
+
+    def ModifyDBSnapshotAttribute(self, region, params):
+        identifier = params['DBSnapshotIdentifier']
+        self._find(identifier, region, 'db_snapshots', 'DBSnapshotNotFound')
+        region.shared.setdefault(identifier, set()).update(params.get('ValuesToAdd') or [])
+        return {'DBSnapshotAttributesResult': {'DBSnapshotIdentifier': identifier}}
+
+    def ListTagsForResource(self, region, params):
+        return {'TagList': list(region.tags.get(params['ResourceName'], []))}
+
+    def AddTagsToResource(self, region, params):
+        region.tags.setdefault(params['ResourceName'], []).extend(params['Tags'])
+        kind = params['ResourceName'].split(':')[5]
+        if kind in SNAPSHOT_KINDS:
+            collection = SNAPSHOT_KINDS[kind][0]
+            self._find(params['ResourceName'], region, collection, 'DBSnapshotNotFound')['TagList'].extend(params['Tags'])
+        return {}
+
+    def _find(self, identifier, region, collection, not_found, account=None):
+        """Looks up a snapshot by identifier or ARN
+
+        ARNs may point to another region or account, snapshots of another
+        account are only found if they are shared with account.
+        """
+        if identifier.startswith('arn:'):
+            parts = identifier.split(':')
+            region, identifier = self.region(parts[3], parts[4]), ':'.join(parts[6:])
+        snapshots = getattr(region, collection)
+        if identifier not in snapshots:
+            raise FakeError(not_found, identifier)
+        if account and account != region.account and account not in region.shared.get(identifier, ()):
+            raise FakeError(not_found, identifier)
+        return snapshots[identifier]
+
+    # SNS
+
+    def Publish(self, region, params):
+        self.messages.append(params['Message'])
+        return {'MessageId': str(uuid.uuid4())}
+
+    def PublishBatch(self, region, params):
+        successful = []
+        for entry in params['PublishBatchRequestEntries']:
+            self.messages.append(entry['Message'])
+            successful.append({'Id': entry['Id'], 'MessageId': str(uuid.uuid4())})
+        return {'Successful': successful, 'Failed': []}
+
+    # STS
+
+    def AssumeRole(self, region, params):
+        return {
+            'Credentials': {
+                'AccessKeyId'     : 'ASIAFAKE',
+                'SecretAccessKey' : 'fake',
+                'SessionToken'    : 'fake',
+                'Expiration'      : datetime.now(timezone.utc) + timedelta(hours=1)
+            }
+        }
+
+    # Step Functions
+
+    def StartExecution(self, region, params):
+        name = params.get('name') or str(uuid.uuid4())
+        arn = '{}:{}'.format(params['stateMachineArn'].replace(':stateMachine:', ':execution:'), name)
+        if arn in self.executions and self.executions[arn] != params['input']:
+            raise FakeError('ExecutionAlreadyExists', arn)
+        self.executions[arn] = params['input']
+        return {'executionArn': arn, 'startDate': datetime.now(timezone.utc)}
+
+def _describe(region, kind, params, not_found):
+    """Filters snapshots like the RDS describe calls do"""
+    collection, identifier_key, parent_key = SNAPSHOT_KINDS[kind]
+    snapshots = getattr(region, collection)
+    if params.get(identifier_key):
+        if params[identifier_key] not in snapshots:
+            raise FakeError(not_found, params[identifier_key])
+        return [snapshots[params[identifier_key]]]
+    if params.get(parent_key):
+        snapshots = region.by_parent.get((kind, params[parent_key]), {})
+    for describe_filter in params.get('Filters') or []:
+        if describe_filter['Name'] == 'db-{}-id'.format(kind):
+            snapshots = dict(
+                (identifier, snapshots[identifier])
+                for identifier in describe_filter['Values'] if identifier in snapshots
+            )
+    return [
+        snapshot for snapshot in snapshots.values()
+        if not params.get('SnapshotType') or snapshot['SnapshotType'] == params['SnapshotType']
+    ]
+
+def _page(items, result_key, params):
+    """Returns one page of a describe call, up to MaxRecords items"""
+    start = int(params.get('Marker') or 0)
+    end = start + int(params.get('MaxRecords') or 100)
+    result = {result_key: items[start:end]}
+    if end < len(items):
+        result['Marker'] = str(end)
+    return result
+
+def _members_xml(shape, value):
+    """Serializes the members of a structure like the query protocol"""
+    xml = []
+    for name, member in shape.members.items():
+        if name in value and value[name] is not None:
+            xml.append(_to_xml(member, value[name], member.serialization.get('name', name)))
+    return ''.join(xml)
+
+def _to_xml(shape, value, name):
+    if shape.type_name == 'structure':
+        return '<{0}>{1}</{0}>'.format(name, _members_xml(shape, value))
+    if shape.type_name == 'list':
+        member_name = shape.member.serialization.get('name', 'member')
+        items = ''.join(_to_xml(shape.member, item, member_name) for item in value)
+        if shape.serialization.get('flattened'):
+            return items
+        return '<{0}>{1}</{0}>'.format(name, items)
+    if shape.type_name == 'timestamp':
+        text = value.isoformat() if isinstance(value, datetime) else str(value)
+    elif shape.type_name == 'boolean':
+        text = 'true' if value else 'false'
+    else:
+        text = escape(str(value))
+    return '<{0}>{1}</{0}>'.format(name, text)
+
+def _epoch(value):
+    if isinstance(value, datetime):
+        return value.timestamp()
+    raise TypeError(value)
@@ -0,0 +1,759 @@
+'''
+Copyright 2019  Pinguin AG, Mattis Haase
+
+Licensed under the Apache License, Version 2.0 (the "License").
+'''
+
+# simulate_state_machine.py
+# Replays the step functions of src_sfn.tf with a virtual clock, to see how
+# their retries and waits play out before changing them in production. The
+# Amazon States Language definitions are read from the Terraform file, so an
+# edited copy of it can be compared with the deployed one. Every Task runs the
+# real lambda handler in process against the fake AWS of fake_aws.py, whose
+# snapshot copies take a while:
+# 1. snapshot sizes are drawn from a lognormal distribution around
+#    --size-median, copies take --copy-base-seconds plus --seconds-per-gib per
+#    GiB times a lognormal jitter, and fail with --copy-failure-rate
+# 2. at most --copy-limit copies are in progress per region and account, like
+#    the RDS quota of concurrent snapshot copies
+# 3. snapshots are announced to src_backup_event at random times within
+#    --arrival-hours, which starts the executions
+# 4. every lambda invocation takes --invocation-seconds and fails with
+#    --lambda-error-rate as Lambda.ServiceException
+# time.time is the virtual clock, so the handlers compute their waits as they
+# would in AWS while nothing really waits.
+#
+# Supported are Task (lambda functions and states:startExecution.sync), Choice,
+# Wait, Pass, Map, Succeed and Fail states with Retry, Catch, InputPath,
+# Parameters, ResultSelector, ResultPath and OutputPath on plain paths.
+#
+# Usage: python tools/simulate_state_machine.py [--snapshots N] [--arrival-hours H]
+#            [--size-median GIB] [--size-sigma S] [--seconds-per-gib S]
+#            [--copy-failure-rate R] [--lambda-error-rate R] [--batch-size N]
+#            [--var NAME=VALUE] [--env NAME=VALUE] [--terraform FILE]
+
+import argparse
+import heapq
+import importlib
+import itertools
+import json
+import math
+import os
+import random
+import re
+import sys
+import time
+import uuid
+
+from collections import Counter, namedtuple
+from datetime import datetime, timezone
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SRC = os.path.join(ROOT, 'src')
+sys.path.insert(0, SRC)
+
+from benchmark_cold_start import ACCOUNT, ENVIRONMENT, SRC_REGION
+
+# Step Functions fails executions whose history grows beyond this many events
+HISTORY_LIMIT = 25000
+
+# The simulation starts the morning after the automated snapshots of the night
+SIMULATION_START = datetime(2019, 7, 1, 4, 0, tzinfo=timezone.utc).timestamp()
+
+# Lambda retries failed asynchronous invocations, like the SNS deliveries to
+# src_backup_event, twice
+ASYNC_RETRY_SECONDS = (60, 120)
+
+# Statuses of snapshot copies in progress, by ARN type
+COPYING_STATUSES = {'cluster-snapshot': 'copying', 'snapshot': 'pending'}
+
+Sleep = namedtuple('Sleep', ['seconds'])
+Join = namedtuple('Join', ['processes', 'concurrency'])
+
+class StatesError(Exception):
+    """An error of a state, as Step Functions reports it"""
+
+    def __init__(self, error, cause=''):
+        super(StatesError, self).__init__(error)
+        self.error = error
+        self.cause = cause
+
+class VirtualClock(object):
+    """Time of the simulation, replaces time.time while it runs"""
+
+    def __init__(self, now=SIMULATION_START):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def datetime(self):
+        return datetime.fromtimestamp(self.now, timezone.utc)
+
+# Terraform
+
+def read_variables(path):
+    """Returns the scalar defaults of the variables of a Terraform file"""
+    with open(path) as tf_file:
+        text = tf_file.read()
+    return dict(
+        (name, json.loads(value))
+        for name, value in re.findall(r'variable "(\w+)" \{\s*default\s*=\s*(true|false|-?[\d.]+|"[^"]*")\s*\}', text)
+    )
+
+def read_state_machines(path, variables):
+    """Reads the step function definitions of a Terraform file
+
+    The %{ if var.x ~} directives and ${...} references of the heredocs are
+    rendered like Terraform would, references to lambda functions and step
+    functions become ARNs named after their Terraform resource.
+
+    Arguments:
+        path {str} -- Terraform file
+        variables {dict} -- values of the Terraform variables
+
+    Returns:
+        dict -- (name, definition) by state machine ARN
+    """
+    with open(path) as tf_file:
+        text = tf_file.read()
+    resources = re.findall(r'resource "aws_sfn_state_machine" "(\w+)" \{(.*?\nEOF)\n', text, re.S)
+    names = dict((label, re.search(r'\bname\s*=\s*"([^"]+)"', body).group(1)) for label, body in resources)
+    local_values = dict(re.findall(r'^\s*(\w+)\s*=\s*(.+?)\s*$', ''.join(re.findall(r'\nlocals \{(.*?)\n\}', text, re.S)), re.M))
+
+    def resolve(expression):
+        if expression.startswith('var.'):
+            value = variables[expression[4:]]
+            return value if isinstance(value, str) else json.dumps(value)
+        if expression.startswith('local.'):
+            return resolve(local_values[expression[6:]])
+        function = re.search(r'aws_lambda_function\.(\w+)', expression)
+        if function:
+            arn = 'arn:aws:lambda:{}:{}:function:{}'.format(SRC_REGION, ACCOUNT, function.group(1))
+            return arn + ':1' if 'qualified_arn' in expression else arn
+        state_machine = re.search(r'aws_sfn_state_machine\.(\w+)', expression)
+        if state_machine:
+            return state_machine_arn(names[state_machine.group(1)])
+        raise ValueError('Cannot resolve ${{{}}}'.format(expression))
+
+    machines = {}
+    for label, body in resources:
+        template = re.search(r'definition\s*=\s*<<EOF\n(.*)\nEOF', body, re.S).group(1)
+        lines, rendered = [], [True]
+        for line in template.split('\n'):
+            directive = re.match(r'\s*%\{\s*(if|else|endif)\s*(.*?)\s*~?\}\s*$', line)
+            if not directive:
+                if all(rendered):
+                    lines.append(line)
+                continue
+            keyword, condition = directive.groups()
+            if keyword == 'if':
+                if not condition.startswith('var.'):
+                    raise ValueError('Unsupported condition {}'.format(condition))
+                rendered.append(bool(variables[condition[4:]]))
+            elif keyword == 'else':
+                rendered[-1] = not rendered[-1]
+            else:
+                rendered.pop()
+        definition = re.sub(r'\$\{([^}]+)\}', lambda match: resolve(match.group(1).strip()), '\n'.join(lines))
+        machines[state_machine_arn(names[label])] = (names[label], json.loads(definition))
+    return machines
+
+def state_machine_arn(name):
+    return 'arn:aws:states:{}:{}:stateMachine:{}'.format(SRC_REGION, ACCOUNT, name)
+
+# Paths
+
+def read_path(data, path):
+    """Returns the value of a plain path like $.copy_status.available"""
+    if path is None:
+        return {}
+    if path == '$':
+        return data
+    if not path.startswith('$.'):
+        raise StatesError('States.Runtime', 'Unsupported path {}'.format(path))
+    value = data
+    for key in path[2:].split('.'):
+        if not isinstance(value, dict) or key not in value:
+            raise StatesError('States.Runtime', 'Invalid path {}'.format(path))
+        value = value[key]
+    return value
+
+def write_path(data, path, value):
+    """Returns a copy of data with value at path, as ResultPath does"""
+    if path is None:
+        return data
+    if path == '$':
+        return value
+    data = json.loads(json.dumps(data))
+    target = data
+    keys = path[2:].split('.')
+    for key in keys[:-1]:
+        target = target.setdefault(key, {})
+    target[keys[-1]] = value
+    return data
+
+def apply_parameters(template, data):
+    """Fills in the keys ending with .$ of Parameters or ResultSelector"""
+    if isinstance(template, dict):
+        result = {}
+        for key, value in template.items():
+            if key.endswith('.$'):
+                result[key[:-2]] = read_path(data, value)
+            else:
+                result[key] = apply_parameters(value, data)
+        return result
+    if isinstance(template, list):
+        return [apply_parameters(value, data) for value in template]
+    return template
+
+def state_input(state, data):
+    effective = read_path(data, state.get('InputPath', '$'))
+    if 'Parameters' in state:
+        effective = apply_parameters(state['Parameters'], effective)
+    return effective
+
+def state_output(state, data, result):
+    if 'ResultSelector' in state:
+        result = apply_parameters(state['ResultSelector'], result)
+    return read_path(write_path(data, state.get('ResultPath', '$'), result), state.get('OutputPath', '$'))
+
+def error_matches(error_equals, error):
+    if error in error_equals:
+        return True
+    if error == 'States.Runtime':
+        return False
+    return 'States.ALL' in error_equals or ('States.TaskFailed' in error_equals and error != 'States.Timeout')
+
+CHOICE_OPERATORS = {
+    'BooleanEquals'            : lambda value, expected: value is expected,
+    'StringEquals'             : lambda value, expected: value == expected,
+    'NumericEquals'            : lambda value, expected: value == expected,
+    'NumericLessThan'          : lambda value, expected: value < expected,
+    'NumericLessThanEquals'    : lambda value, expected: value <= expected,
+    'NumericGreaterThan'       : lambda value, expected: value > expected,
+    'NumericGreaterThanEquals' : lambda value, expected: value >= expected,
+}
+
+def choice_matches(rule, data):
+    if 'And' in rule:
+        return all(choice_matches(inner, data) for inner in rule['And'])
+    if 'Or' in rule:
+        return any(choice_matches(inner, data) for inner in rule['Or'])
+    if 'Not' in rule:
+        return not choice_matches(rule['Not'], data)
+    if 'IsPresent' in rule:
+        try:
+            read_path(data, rule['Variable'])
+        except StatesError:
+            return not rule['IsPresent']
+        return rule['IsPresent']
+    for operator, compare in CHOICE_OPERATORS.items():
+        if operator in rule:
+            return compare(read_path(data, rule['Variable']), rule[operator])
+    raise StatesError('States.Runtime', 'Unsupported choice rule {}'.format(sorted(rule)))
+
+# Fake AWS with snapshot copies that take time
+
+def simulated_aws(clock, rng, arguments):
+    """Returns a FakeAWS whose snapshot copies progress with the virtual clock
+
+    Arguments:
+        clock {VirtualClock} -- time of the simulation
+        rng {Random} -- random numbers of the copy durations and failures
+        arguments {Namespace} -- command line arguments
+
+    Returns:
+        FakeAWS -- which also collects the executions started, in started
+    """
+    import fake_aws
+
+    class SimulatedAWS(fake_aws.FakeAWS):
+
+        def reset(self):
+            super(SimulatedAWS, self).reset()
+            self.copies  = []
+            self.started = []
+
+        def respond(self, service, region, account, service_model, request):
+            with self.lock:
+                self.advance()
+            return super(SimulatedAWS, self).respond(service, region, account, service_model, request)
+
+        def advance(self):
+            """Moves the copies in progress on to the current time"""
+            for copy in list(self.copies):
+                elapsed = clock.now - copy['started']
+                if elapsed < copy['duration']:
+                    copy['snapshot']['PercentProgress'] = int(100 * elapsed / copy['duration'])
+                    continue
+                copy['snapshot']['Status'] = 'failed' if copy['fails'] else 'available'
+                copy['snapshot']['PercentProgress'] = 100
+                self.copies.remove(copy)
+
+        def copy(self, region, kind, params, source_key, target_key):
+            collection, identifier_key, _ = fake_aws.SNAPSHOT_KINDS[kind]
+            if sum(1 for copy in self.copies if copy['region'] is region) >= arguments.copy_limit:
+                raise fake_aws.FakeError('SnapshotQuotaExceeded', 'Too many snapshot copies in progress')
+            source = self._find(params[source_key], region, collection, 'DBSnapshotNotFound')
+            result = getattr(super(SimulatedAWS, self), 'CopyDB{}'.format(
+                'ClusterSnapshot' if kind == 'cluster-snapshot' else 'Snapshot'
+            ))(region, params)
+            snapshot = getattr(region, collection)[params[target_key]]
+            duration = (arguments.copy_base_seconds + arguments.seconds_per_gib * source['AllocatedStorage']) \
+                * math.exp(rng.gauss(0, arguments.copy_jitter))
+            snapshot.update({
+                'AllocatedStorage'   : source['AllocatedStorage'],
+                'SnapshotCreateTime' : clock.datetime(),
+                'Status'             : COPYING_STATUSES[kind],
+                'PercentProgress'    : 0
+            })
+            self.copies.append({
+                'region'   : region,
+                'snapshot' : snapshot,
+                'started'  : clock.now,
+                'duration' : duration,
+                'fails'    : rng.random() < arguments.copy_failure_rate
+            })
+            return result
+
+        def CopyDBClusterSnapshot(self, region, params):
+            return self.copy(region, 'cluster-snapshot', params, 'SourceDBClusterSnapshotIdentifier', 'TargetDBClusterSnapshotIdentifier')
+
+        def CopyDBSnapshot(self, region, params):
+            return self.copy(region, 'snapshot', params, 'SourceDBSnapshotIdentifier', 'TargetDBSnapshotIdentifier')
+
+        def StartExecution(self, region, params):
+            new = '{}:{}'.format(params['stateMachineArn'].replace(':stateMachine:', ':execution:'), params.get('name')) not in self.executions
+            result = super(SimulatedAWS, self).StartExecution(region, params)
+            if new:
+                self.started.append((params['stateMachineArn'], result['executionArn'], json.loads(params['input'])))
+            return result
+
+    return SimulatedAWS(throttle_rate=arguments.throttle_rate, seed=arguments.seed)
+
+# Simulation
+
+class Execution(object):
+    """A step function execution and what it took"""
+
+    def __init__(self, arn, machine, execution_input, arrived_at, started_at):
+        self.arn         = arn
+        self.machine     = machine
+        self.input       = execution_input
+        self.arrived_at  = arrived_at
+        self.started_at  = started_at
+        self.ended_at    = None
+        self.status      = 'RUNNING'
+        self.error       = None
+        self.caught      = None
+        self.output      = None
+        self.invocations = 0
+        self.events      = 0
+
+    def add_events(self, count):
+        self.events += count
+        if self.events > HISTORY_LIMIT:
+            raise StatesError('States.Runtime', 'The execution reached the limit of {} history events'.format(HISTORY_LIMIT))
+
+    def size(self):
+        """Returns the GiB of the snapshots the execution replicates"""
+        snapshots = self.input.get('Snapshots', [self.input])
+        return sum((snapshot.get('Snapshot') or {}).get('allocated_storage') or 0 for snapshot in snapshots)
+
+class Simulator(object):
+    """Runs step function executions as processes on the virtual clock
+
+    A process is a generator which yields Sleep to let time pass and Join to
+    run other processes and wait for their results.
+
+    Arguments:
+        clock {VirtualClock} -- time of the simulation
+        machines {dict} -- (name, definition) by state machine ARN
+        aws {FakeAWS} -- fake AWS of the handlers
+        rng {Random} -- random numbers of the lambda errors
+        arguments {Namespace} -- command line arguments
+    """
+
+    def __init__(self, clock, machines, aws, rng, arguments):
+        self.clock       = clock
+        self.machines    = machines
+        self.aws         = aws
+        self.rng         = rng
+        self.arguments   = arguments
+        self.queue       = []
+        self.sequence    = itertools.count()
+        self.executions  = []
+        self.invocations = Counter()
+        self.visits      = Counter()
+        self.retries     = Counter()
+        self.lost        = 0
+
+    def schedule(self, at, process, value=None):
+        heapq.heappush(self.queue, (at, next(self.sequence), process, value))
+
+    def start(self, generator, done=None, at=None):
+        self.schedule(self.clock.now if at is None else at, (generator, done))
+
+    def run(self):
+        while self.queue:
+            at, _, process, value = heapq.heappop(self.queue)
+            self.clock.now = max(self.clock.now, at)
+            generator, done = process
+            try:
+                command = generator.send(value)
+            except StopIteration as stop:
+                if done:
+                    done(stop.value)
+                continue
+            if isinstance(command, Sleep):
+                self.schedule(self.clock.now + max(command.seconds, 0), process)
+            else:
+                self.join(process, command)
+
+    def join(self, parent, command):
+        """Runs processes, at most concurrency at a time, and resumes parent with their results"""
+        results = [None] * len(command.processes)
+        pending = list(enumerate(command.processes))
+        running = [0]
+
+        def start_next():
+            index, generator = pending.pop(0)
+            running[0] += 1
+            def done(result):
+                results[index] = result
+                running[0] -= 1
+                if pending:
+                    start_next()
+                elif not running[0]:
+                    self.schedule(self.clock.now, parent, results)
+            self.start(generator, done)
+
+        if not pending:
+            self.schedule(self.clock.now, parent, results)
+        for _ in range(min(command.concurrency or len(pending), len(pending))):
+            start_next()
+
+    def deliver(self, snapshots):
+        """Announces snapshots to src_backup_event and starts the executions it asks for"""
+        message = {
+            'Event Source'  : 'db-cluster-snapshot',
+            'Event Message' : 'Automated snapshot created'
+        }
+        # Batches are announced in one event, like src_check_aurora_backups does
+        if len(snapshots) == 1:
+            message['Source ID']  = snapshots[0]['DBClusterSnapshotIdentifier']
+            message['Source ARN'] = snapshots[0]['DBClusterSnapshotArn']
+        else:
+            message['Source IDs']  = [snapshot['DBClusterSnapshotIdentifier'] for snapshot in snapshots]
+            message['Source ARNs'] = [snapshot['DBClusterSnapshotArn'] for snapshot in snapshots]
+        records = [{'Sns': {'Message': json.dumps(message)}}]
+        arrived_at = self.clock.now
+        for retry_seconds in ASYNC_RETRY_SECONDS + (None,):
+            try:
+                yield from self.invoke_lambda(None, 'src_backup_event', {'Records': records})
+                break
+            except StatesError as e:
+                if retry_seconds is None:
+                    self.lost += len(snapshots)
+                    print('src_backup_event failed: {} {}'.format(e.error, e.cause), file=sys.stderr)
+                else:
+                    yield Sleep(retry_seconds)
+        started, self.aws.started = self.aws.started, []
+        for machine_arn, execution_arn, execution_input in started:
+            self.start(self.execute(machine_arn, execution_arn, execution_input, arrived_at))
+
+    def execute(self, machine_arn, execution_arn, execution_input, arrived_at):
+        """Process of a whole execution, returns the Execution"""
+        name, definition = self.machines[machine_arn]
+        execution = Execution(execution_arn, name, execution_input, arrived_at, self.clock.now)
+        self.executions.append(execution)
+        try:
+            execution.output = yield from self.run_states(execution, definition, execution_input)
+            execution.status = 'SUCCEEDED'
+        except StatesError as e:
+            execution.status = 'FAILED'
+            execution.error = e.error
+        execution.ended_at = self.clock.now
+        return execution
+
+    def run_states(self, execution, definition, data):
+        """Runs the states of a definition from StartAt, returns the output"""
+        name = definition['StartAt']
+        while True:
+            state = definition['States'][name]
+            kind = state['Type']
+            self.visits[(execution.machine, name)] += 1
+            execution.add_events(2)
+            try:
+                if kind == 'Task':
+                    data = yield from self.task_state(execution, name, state, data)
+                elif kind == 'Map':
+                    data = yield from self.map_state(execution, state, data)
+                elif kind == 'Pass':
+                    data = state_output(state, data, state.get('Result', state_input(state, data)))
+                elif kind == 'Wait':
+                    if 'SecondsPath' in state:
+                        seconds = read_path(read_path(data, state.get('InputPath', '$')), state['SecondsPath'])
+                    else:
+                        seconds = state['Seconds']
+                    yield Sleep(seconds)
+                elif kind == 'Choice':
+                    effective = read_path(data, state.get('InputPath', '$'))
+                    rule = next((rule for rule in state['Choices'] if choice_matches(rule, effective)), None)
+                    if rule is None and 'Default' not in state:
+                        raise StatesError('States.NoChoiceMatched', name)
+                    name = rule['Next'] if rule else state['Default']
+                    data = read_path(effective, state.get('OutputPath', '$'))
+                    continue
+                elif kind == 'Succeed':
+                    return read_path(data, state.get('OutputPath', '$'))
+                elif kind == 'Fail':
+                    raise StatesError(state.get('Error', 'States.Fail'), state.get('Cause', ''))
+                else:
+                    raise StatesError('States.Runtime', 'Unsupported state type {}'.format(kind))
+            except StatesError as e:
+                catcher = next((
+                    catcher for catcher in state.get('Catch', [])
+                    if kind in ('Task', 'Map') and error_matches(catcher['ErrorEquals'], e.error)
+                ), None)
+                if catcher is None:
+                    raise
+                execution.caught = e.error
+                data = write_path(data, catcher.get('ResultPath', '$'), {'Error': e.error, 'Cause': e.cause})
+                name = catcher['Next']
+                continue
+            if state.get('End'):
+                return data
+            name = state['Next']
+
+    def task_state(self, execution, name, state, data):
+        """Runs a Task state with its retries, returns the output"""
+        effective = state_input(state, data)
+        attempts = Counter()
+        while True:
+            try:
+                execution.add_events(3)
+                result = yield from self.invoke(execution, state['Resource'], effective)
+                return state_output(state, data, result)
+            except StatesError as e:
+                index = next((
+                    index for index, retrier in enumerate(state.get('Retry', []))
+                    if error_matches(retrier['ErrorEquals'], e.error)
+                ), None)
+                if index is None:
+                    raise
+                retrier = state['Retry'][index]
+                if attempts[index] >= retrier.get('MaxAttempts', 3):
+                    raise
+                delay = retrier.get('IntervalSeconds', 1) * retrier.get('BackoffRate', 2.0) ** attempts[index]
+                delay = min(delay, retrier.get('MaxDelaySeconds', delay))
+                if retrier.get('JitterStrategy') == 'FULL':
+                    delay = self.rng.uniform(0, delay)
+                attempts[index] += 1
+                self.retries[(execution.machine, name, e.error)] += 1
+                yield Sleep(delay)
+
+    def map_state(self, execution, state, data):
+        """Runs the iterations of a Map state, returns the output"""
+        items = read_path(read_path(data, state.get('InputPath', '$')), state.get('ItemsPath', '$'))
+        iterator = state.get('Iterator') or state['ItemProcessor']
+        selector = state.get('ItemSelector', state.get('Parameters'))
+
+        def iteration(item):
+            if selector is not None:
+                item = apply_parameters(selector, item)
+            try:
+                output = yield from self.run_states(execution, iterator, item)
+            except StatesError as e:
+                return e
+            return output
+
+        results = yield Join([iteration(item) for item in items], state.get('MaxConcurrency', 0))
+        for result in results:
+            if isinstance(result, StatesError):
+                raise result
+        return state_output(state, data, results)
+
+    def invoke(self, execution, resource, effective):
+        """Runs the resource of a Task, returns its result"""
+        if resource == 'arn:aws:states:::states:startExecution.sync':
+            name = str(uuid.uuid4())
+            child_arn = '{}:{}'.format(effective['StateMachineArn'].replace(':stateMachine:', ':execution:'), name)
+            child, = yield Join([self.execute(effective['StateMachineArn'], child_arn, effective['Input'], execution.arrived_at)], 1)
+            if child.status != 'SUCCEEDED':
+                raise StatesError('States.TaskFailed', 'Execution {} failed with {}'.format(child_arn, child.error))
+            return {'ExecutionArn': child_arn, 'Output': json.dumps(child.output), 'Status': child.status}
+        if ':function:' not in resource:
+            raise StatesError('States.Runtime', 'Unsupported resource {}'.format(resource))
+        function = resource.split(':function:')[1].split(':')[0]
+        result = yield from self.invoke_lambda(execution, function, effective)
+        return result
+
+    def invoke_lambda(self, execution, function, event):
+        """Runs a lambda handler in process, the invocation takes --invocation-seconds"""
+        self.invocations[function] += 1
+        if execution:
+            execution.invocations += 1
+        error = None
+        if self.rng.random() < self.arguments.lambda_error_rate:
+            error = StatesError('Lambda.ServiceException', 'Simulated lambda error')
+        else:
+            try:
+                result = importlib.import_module(function).lambda_handler(json.loads(json.dumps(event)), None)
+                result = json.loads(json.dumps(result))
+            except Exception as e:
+                error = StatesError(type(e).__name__, str(e))
+        yield Sleep(self.arguments.invocation_seconds)
+        if error:
+            raise error
+        return result
+
+# Report
+
+def percentile(values, share):
+    """Nearest rank percentile of sorted values"""
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, max(0, int(math.ceil(share * len(values))) - 1))]
+
+def print_report(simulator, arguments):
+    replications = [
+        execution for execution in simulator.executions
+        if execution.machine == simulator.machines[ENVIRONMENT['STATE_MACHINE_ARN']][0]
+    ]
+    print('{} snapshots arriving within {:g} h, median {:g} GiB, {:g} s + {:g} s/GiB per copy, batches of {}'.format(
+        arguments.snapshots, arguments.arrival_hours, arguments.size_median,
+        arguments.copy_base_seconds, arguments.seconds_per_gib, arguments.batch_size
+    ))
+    print('{} executions of {}, {} did not finish, {} snapshots were never replicated'.format(
+        len(replications), simulator.machines[ENVIRONMENT['STATE_MACHINE_ARN']][0],
+        sum(1 for execution in replications if execution.status == 'RUNNING'),
+        simulator.lost
+    ))
+    if not replications:
+        return
+
+    def summary(executions):
+        hours = sorted((execution.ended_at - execution.arrived_at) / 3600 for execution in executions if execution.status == 'SUCCEEDED')
+        invocations = sorted(execution.invocations for execution in executions)
+        failed = sum(1 for execution in executions if execution.status == 'FAILED')
+        return '{:>6} {:>9.1f} {:>8.2f} {:>8.2f} {:>8.2f} {:>12.1f} {:>8}'.format(
+            len(executions), 100.0 * failed / len(executions),
+            percentile(hours, 0.5), percentile(hours, 0.9), percentile(hours, 0.99),
+            sum(invocations) / len(invocations), percentile(invocations, 0.9)
+        )
+
+    header = '{:<18} {:>6} {:>9} {:>8} {:>8} {:>8} {:>12} {:>8}'.format(
+        'size GiB', 'runs', 'failed %', 'p50 h', 'p90 h', 'p99 h', 'invocations', 'p90'
+    )
+    print('\ncompletion time from snapshot event to end of replication, lambda invocations per replication')
+    print(header)
+    print('{:<18} {}'.format('all', summary(replications)))
+    sizes = sorted(execution.size() for execution in replications)
+    bounds = [percentile(sizes, share) for share in (0.25, 0.5, 0.75)] + [sizes[-1]]
+    lower = -1
+    for bound in bounds:
+        bucket = [execution for execution in replications if lower < execution.size() <= bound]
+        if bucket:
+            print('{:<18} {}'.format('{} - {}'.format(max(lower + 1, sizes[0]), bound), summary(bucket)))
+        lower = bound
+
+    causes = Counter(execution.caught or execution.error for execution in replications if execution.status == 'FAILED')
+    if causes:
+        print('\nfailed replications by error')
+        for error, count in causes.most_common():
+            print('  {:<40} {:>8}'.format(error, count))
+
+    print('\nlambda invocations by function')
+    for function, count in sorted(simulator.invocations.items()):
+        print('  {:<40} {:>8}'.format(function, count))
+    print('\nstate visits and retries by error')
+    for (machine, state), count in sorted(simulator.visits.items()):
+        print('  {:<28} {:<24} {:>8}'.format(machine, state, count))
+        for (retry_machine, retry_state, error), retries in sorted(simulator.retries.items()):
+            if (retry_machine, retry_state) == (machine, state):
+                print('  {:<28} {:<24} {:>8} retries of {}'.format('', '', retries, error))
+
+def parse_assignments(values):
+    """Parses NAME=VALUE arguments, values are JSON if they parse as JSON"""
+    assignments = {}
+    for value in values:
+        name, _, text = value.partition('=')
+        try:
+            assignments[name] = json.loads(text)
+        except ValueError:
+            assignments[name] = text
+    return assignments
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulates the replication step functions with a virtual clock')
+    parser.add_argument('--terraform', default=os.path.join(ROOT, 'src_sfn.tf'), help='Terraform file with the step functions')
+    parser.add_argument('--var', action='append', default=[], help='Terraform variable, e.g. "dispatcher=true"')
+    parser.add_argument('--env', action='append', default=[], help='environment of the handlers, e.g. "COPY_BUDGET=10"')
+    parser.add_argument('--snapshots', type=int, default=200, help='snapshots to replicate')
+    parser.add_argument('--arrival-hours', type=float, default=1, help='hours over which the snapshot events arrive')
+    parser.add_argument('--batch-size', type=int, default=1, help='snapshots per event, more than 1 runs the batch step function')
+    parser.add_argument('--size-median', type=float, default=100, help='median snapshot size in GiB')
+    parser.add_argument('--size-sigma', type=float, default=1.0, help='sigma of the lognormal snapshot sizes')
+    parser.add_argument('--copy-base-seconds', type=float, default=300, help='seconds every snapshot copy takes')
+    parser.add_argument('--seconds-per-gib', type=float, default=10, help='seconds a snapshot copy takes per GiB')
+    parser.add_argument('--copy-jitter', type=float, default=0.3, help='sigma of the lognormal factor of the copy durations')
+    parser.add_argument('--copy-failure-rate', type=float, default=0.0, help='share of snapshot copies that fail')
+    parser.add_argument('--copy-limit', type=int, default=20, help='snapshot copies in progress per region and account')
+    parser.add_argument('--invocation-seconds', type=float, default=1, help='seconds every lambda invocation takes')
+    parser.add_argument('--lambda-error-rate', type=float, default=0.0, help='share of lambda invocations that fail')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of API calls that are throttled')
+    parser.add_argument('--ledger', default='sqlite://:memory:', help='replication ledger, needed for admission control')
+    parser.add_argument('--seed', type=int, default=0, help='seed of all random numbers')
+    arguments = parser.parse_args()
+
+    # The variables of a copy of src_sfn.tf are those of the module, unless it comes with its own
+    io_tf = os.path.join(os.path.dirname(arguments.terraform), 'io.tf')
+    variables = read_variables(io_tf if os.path.exists(io_tf) else os.path.join(ROOT, 'io.tf'))
+    variables.update(parse_assignments(arguments.var))
+    machines = read_state_machines(arguments.terraform, variables)
+
+    os.environ.update(ENVIRONMENT)
+    os.environ.pop('AWS_ENDPOINT_URL', None)
+    os.environ.update({
+        'API_RATE_LIMITS' : '',
+        'LEDGER'          : arguments.ledger,
+        'LOGLEVEL'        : 'CRITICAL',
+        'BATCH_SIZE'      : str(arguments.batch_size),
+    })
+    if arguments.batch_size > 1:
+        os.environ['BATCH_STATE_MACHINE_ARN'] = state_machine_arn('rds_snapshot_sharing_batch')
+    os.environ.update((name, str(value)) for name, value in parse_assignments(arguments.env).items())
+
+    clock = VirtualClock()
+    time.time = clock.time
+
+    # Imported once the environment is set, handlers read it on import
+    import common
+
+    rng = random.Random(arguments.seed)
+    aws = simulated_aws(clock, rng, arguments)
+    common.set_client_factory(aws.client_factory)
+    common.set_metrics_sink(common.MemorySink())
+
+    simulator = Simulator(clock, machines, aws, rng, arguments)
+    source = aws.region(SRC_REGION)
+    arrivals = []
+    for index in range(arguments.snapshots):
+        create_time = clock.datetime()
+        identifier = 'rds:cluster-{:04d}-{}'.format(index, create_time.strftime('%Y-%m-%d-%H-%M'))
+        snapshot = aws.cluster_snapshot(SRC_REGION, identifier, 'cluster-{:04d}'.format(index), create_time, 'automated')
+        snapshot['AllocatedStorage'] = max(1, int(round(arguments.size_median * math.exp(rng.gauss(0, arguments.size_sigma)))))
+        source.add('cluster-snapshot', snapshot)
+        arrivals.append((rng.uniform(0, arguments.arrival_hours * 3600), snapshot))
+    arrivals.sort(key=lambda arrival: arrival[0])
+    for start in range(0, len(arrivals), arguments.batch_size):
+        batch = arrivals[start:start + arguments.batch_size]
+        simulator.start(simulator.deliver([snapshot for _, snapshot in batch]), at=clock.now + batch[-1][0])
+
+    simulator.run()
+    print_report(simulator, arguments)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+'''
+Copyright 2019  Pinguin AG, Mattis Haase
+
+Licensed under the Apache License, Version 2.0 (the "License").
+'''
+
+# trace_timeline.py
+# Prints the timeline of replication traces from OTLP/JSON files, as written
+# with TRACE_EXPORTER=file://<path>. Every span is listed with its offset from
+# the start of the trace, its duration and its parent as indentation. The
+# summary tells where the time went: in the steps, in the Wait states of the
+# step function, in transitions and retries between the steps, in retry waits
+# of API calls and in waits for the API rate limiters. Spans are nested, so
+# the time of a span is also counted in the step or API call it belongs to.
+#
+# Usage: python tools/trace_timeline.py FILE [FILE ...] [--trace ID] [--depth N]
+
+import argparse
+import json
+
+from collections import defaultdict
+
+# Span names which are time spent waiting, see common.Tracer
+WAITS = ('stepfunctions.wait', 'stepfunctions.transition', 'retry.wait', 'ratelimit.wait')
+
+def read_spans(paths):
+    """Reads the spans of OTLP/JSON files, one export request per line
+
+    Arguments:
+        paths {list} -- file paths
+
+    Returns:
+        dict -- spans by trace id
+    """
+    traces = defaultdict(list)
+    for path in paths:
+        with open(path) as trace_file:
+            for line in trace_file:
+                if not line.strip():
+                    continue
+                for resource_spans in json.loads(line)['resourceSpans']:
+                    for scope_spans in resource_spans['scopeSpans']:
+                        for span in scope_spans['spans']:
+                            traces[span['traceId']].append(span)
+    return traces
+
+def seconds(span, key):
+    return int(span[key]) / 1e9
+
+def duration(span):
+    return seconds(span, 'endTimeUnixNano') - seconds(span, 'startTimeUnixNano')
+
+def print_trace(trace_id, spans, depth):
+    """Prints the timeline and summary of a trace"""
+    start = min(seconds(span, 'startTimeUnixNano') for span in spans)
+    end = max(seconds(span, 'endTimeUnixNano') for span in spans)
+    span_ids = set(span['spanId'] for span in spans)
+    children = defaultdict(list)
+    for span in spans:
+        parent = span.get('parentSpanId')
+        children[parent if parent in span_ids else None].append(span)
+
+    print('trace {} {:.1f} s'.format(trace_id, end - start))
+    def walk(parent, level):
+        for span in sorted(children[parent], key=lambda span: int(span['startTimeUnixNano'])):
+            failed = ' FAILED {}'.format(span['status'].get('message', '')) if span.get('status', {}).get('code') == 2 else ''
+            print('{:>10.3f} {:>10.3f}  {}{}{}'.format(
+                seconds(span, 'startTimeUnixNano') - start,
+                duration(span),
+                '  ' * level,
+                span['name'],
+                failed
+            ))
+            if level + 1 < depth:
+                walk(span['spanId'], level + 1)
+    print('{:>10} {:>10}  {}'.format('offset s', 'duration s', 'span'))
+    walk(None, 0)
+
+    totals = defaultdict(float)
+    for span in spans:
+        if span['name'] in WAITS:
+            totals[span['name']] += duration(span)
+        elif span.get('kind') == 2:
+            totals['steps'] += duration(span)
+        elif span.get('kind') == 3 and span.get('parentSpanId') in span_ids:
+            totals['api calls'] += duration(span)
+    print('summary')
+    for name, total in sorted(totals.items(), key=lambda item: -item[1]):
+        print('  {:<26} {:>10.1f} s {:>6.1f} %'.format(name, total, 100 * total / max(end - start, 1e-9)))
+    print()
+
+def main():
+    parser = argparse.ArgumentParser(description='Prints the timeline of replication traces')
+    parser.add_argument('files', nargs='+', help='OTLP/JSON files written by the file trace exporter')
+    parser.add_argument('--trace', help='only this trace id')
+    parser.add_argument('--depth', type=int, default=3, help='levels of spans to list')
+    arguments = parser.parse_args()
+
+    traces = read_spans(arguments.files)
+    for trace_id, spans in sorted(traces.items(), key=lambda item: min(int(span['startTimeUnixNano']) for span in item[1])):
+        if not arguments.trace or trace_id == arguments.trace:
+            print_trace(trace_id, spans, arguments.depth)
+
+if __name__ == '__main__':
+    main()